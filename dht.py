@@ -0,0 +1,549 @@
+import asyncio
+import collections
+import hashlib
+import json
+import os
+import random
+import time
+
+# Bits in node ids and keys
+ID_BITS = 160
+# Nodes per k-bucket, and how many closest nodes a lookup converges on
+K = 8
+# Queries a lookup keeps in flight at once
+ALPHA = 3
+# Seconds to wait for the reply to a query
+RPC_TIMEOUT = 1.0
+# Seconds a stored record lasts unless the peer holding the file publishes it again
+RECORD_TTL = 3600
+# Seconds between republishing what we share, well within RECORD_TTL
+REPUBLISH_INTERVAL = 1200
+# Seconds between maintenance rounds
+MAINTENANCE_INTERVAL = 60
+# Seconds a bucket may go without hearing from any of its nodes before it is refreshed
+BUCKET_REFRESH = 900
+# Most records one FIND_VALUE reply carries
+MAX_VALUES = 16
+# Most records stored under one key, the ones closest to expiry are dropped first
+MAX_RECORDS = 256
+# Keys an announce publishes at once
+ANNOUNCE_CONCURRENCY = 8
+
+
+def random_id():
+    """
+    :return: a random node id
+    :rtype: int
+    """
+    return int.from_bytes(os.urandom(ID_BITS // 8), 'big')
+
+def content_key(file_id=None, digest=None):
+    """
+    Gives the key records of a file are stored under: its content digest
+    if given, otherwise its file id
+
+    :param file_id: id of the file
+    :type file_id: String
+    :param digest: hex sha256 of the content
+    :type digest: String
+    :return: the key
+    :rtype: int
+    """
+    name = f"digest:{digest}" if digest is not None else f"id:{file_id}"
+    return int.from_bytes(hashlib.sha1(name.encode()).digest(), 'big')
+
+def valid_address(ip, port):
+    """
+    :param ip: ip address taken from a remote reply
+    :param port: port taken from a remote reply
+    :return: whether (ip, port) is something we can send to
+    :rtype: bool
+    """
+    return isinstance(ip, str) and type(port) is int and 0 < port < 1 << 16
+
+
+class DHTNode:
+    """
+    DHTNode, a Kademlia node run over the peer's UDP socket, so peers can
+    find each other and the holders of a file without a tracker
+
+    Nodes are kept in k-buckets by the XOR distance of their id to ours,
+    least recently seen first. A node that would overflow a bucket only
+    replaces its oldest node if that one fails to answer a ping, so long
+    lived nodes are preferred. Lookups query the closest nodes known to the
+    target, ALPHA at a time, each reply bringing closer nodes, until the K
+    closest have all answered: about log2(network size) / log2(K) rounds.
+
+    Peers publish a record per shared file under the key of its content
+    digest and of its file id, at the K nodes closest to each key. Records
+    expire after RECORD_TTL unless republished. A STORE must carry the
+    token its sender got from a FIND_VALUE of ours, and the record is for
+    the address the STORE came from, so a peer can only publish itself.
+
+    Messages are CONTROL packets "DHT:" followed by JSON: queries
+    {"y": "q", "t": transaction, "id": sender id, "q": kind, ...} and
+    replies {"y": "r", "t": transaction, "id": sender id, ...}.
+
+    Attributes:
+        node_id: our id
+        address: our (ip, port), as other peers reach us
+        name: our peer name, published with our records
+        send: function sending a CONTROL message text to an (ip, port)
+        buckets: ID_BITS OrderedDicts of node id -> (ip, port), least recently seen first
+        touched: time.monotonic() each bucket last heard from one of its nodes
+        challenged: indexes of full buckets whose oldest node is being pinged
+        challenges: tasks pinging those oldest nodes, kept so they are not garbage collected
+        pending: transaction -> (future of the reply, address queried)
+        records: key -> {(ip, port, file_id): [name, digest, expiry time]}
+        published: (file_id, digest) of every file we publish
+        last_publish: time.monotonic() of the last republish
+        rpcs: number of queries sent
+        last_lookup: {'rpcs', 'hops'} of the last lookup, for measuring
+    """
+
+    def __init__(self, send, address, name, node_id=None):
+        """
+        Constructor for DHTNode
+
+        :param send: function sending a CONTROL message text to an (ip, port)
+        :type send: callable
+        :param address: our (ip, port), as other peers reach us
+        :type address: tuple
+        :param name: our peer name
+        :type name: String
+        :param node_id: our id, None for a random one
+        :type node_id: int
+        """
+        self.node_id = random_id() if node_id is None else node_id
+        self.address = tuple(address)
+        self.name = name
+        self.send = send
+        self.buckets = [collections.OrderedDict() for _ in range(ID_BITS)]
+        self.touched = [0.0] * ID_BITS
+        self.challenged = set()
+        self.challenges = set()
+        self.pending = {}
+        self.next_transaction = 0
+        self.records = {}
+        self.published = set()
+        self.last_publish = time.monotonic()
+        self.secret = os.urandom(16)
+        self.rpcs = 0
+        self.last_lookup = None
+
+    def bucket_of(self, node_id):
+        """
+        :param node_id: id of another node
+        :type node_id: int
+        :return: index of the bucket that node belongs in
+        :rtype: int
+        """
+        return (node_id ^ self.node_id).bit_length() - 1
+
+    def __len__(self):
+        return sum(len(bucket) for bucket in self.buckets)
+
+    def seen(self, node_id, address):
+        """
+        Records that a node was heard from
+
+        :param node_id: id of the node
+        :type node_id: int
+        :param address: (ip, port) it was heard from
+        :type address: tuple
+        """
+        if node_id == self.node_id or not 0 <= node_id < 1 << ID_BITS:
+            return
+        index = self.bucket_of(node_id)
+        bucket = self.buckets[index]
+        self.touched[index] = time.monotonic()
+        if node_id in bucket:
+            bucket[node_id] = address
+            bucket.move_to_end(node_id)
+        elif len(bucket) < K:
+            bucket[node_id] = address
+        elif index not in self.challenged:
+            self.challenged.add(index)
+            task = asyncio.get_running_loop().create_task(self.challenge(index, node_id, address))
+            self.challenges.add(task)
+            task.add_done_callback(self.challenges.discard)
+
+    async def challenge(self, index, node_id, address):
+        """
+        Pings the least recently seen node of a full bucket, and replaces it
+        with the new node if it does not answer
+
+        :param index: index of the full bucket
+        :type index: int
+        :param node_id: id of the node that wants in
+        :type node_id: int
+        :param address: (ip, port) of that node
+        :type address: tuple
+        """
+        try:
+            bucket = self.buckets[index]
+            if len(bucket) < K:
+                bucket[node_id] = address
+                return
+            oldest, oldest_address = next(iter(bucket.items()))
+            if await self.query(oldest_address, 'ping') is None:
+                bucket.pop(oldest, None)
+                if len(bucket) < K:
+                    bucket[node_id] = address
+        finally:
+            self.challenged.discard(index)
+
+    def forget(self, address):
+        """
+        Drops a node that failed to answer
+
+        :param address: (ip, port) of the node
+        :type address: tuple
+        """
+        for bucket in self.buckets:
+            for node_id, node_address in bucket.items():
+                if node_address == address:
+                    del bucket[node_id]
+                    return
+
+    def closest(self, target, count=K, exclude=None):
+        """
+        :param target: id or key to measure distance to
+        :type target: int
+        :param count: most nodes to give
+        :type count: int
+        :param exclude: (ip, port) to leave out, e.g. the node asking
+        :type exclude: tuple
+        :return: the known nodes closest to target, list of (node id, (ip, port))
+        :rtype: list
+        """
+        nodes = [(node_id, address) for bucket in self.buckets for node_id, address in bucket.items()
+                 if address != exclude]
+        nodes.sort(key=lambda node: node[0] ^ target)
+        return nodes[:count]
+
+    def addresses(self, count):
+        """
+        :param count: most nodes to pick
+        :type count: int
+        :return: addresses of up to 'count' known nodes picked at random
+        :rtype: list
+        """
+        nodes = [address for bucket in self.buckets for address in bucket.values()]
+        return random.sample(nodes, min(count, len(nodes)))
+
+    def token(self, ip):
+        """
+        :param ip: address of the node asking
+        :type ip: String
+        :return: the token that node must present to STORE with us
+        :rtype: String
+        """
+        return hashlib.sha1(self.secret + ip.encode()).hexdigest()[:16]
+
+    def message(self, kind, transaction, **fields):
+        """
+        Forms a DHT message
+
+        :param kind: "q" for a query, "r" for a reply
+        :type kind: String
+        :param transaction: id matching a reply to its query
+        :type transaction: String
+        :return: the CONTROL message text
+        :rtype: String
+        """
+        fields.update(y=kind, t=transaction, id=format(self.node_id, 'x'))
+        return "DHT:" + json.dumps(fields, separators=(',', ':'))
+
+    async def query(self, address, kind, **fields):
+        """
+        Sends a query and waits for its reply
+
+        :param address: (ip, port) of the node
+        :type address: tuple
+        :param kind: "ping", "find_node", "find_value" or "store"
+        :type kind: String
+        :return: the reply, or None if the node did not answer within RPC_TIMEOUT
+        :rtype: dict
+        """
+        transaction = format(self.next_transaction, 'x')
+        self.next_transaction += 1
+        reply = asyncio.get_running_loop().create_future()
+        self.pending[transaction] = (reply, address)
+        self.rpcs += 1
+        self.send(self.message('q', transaction, q=kind, **fields), address)
+        try:
+            return await asyncio.wait_for(reply, RPC_TIMEOUT)
+        except asyncio.TimeoutError:
+            self.forget(address)
+            return None
+        finally:
+            self.pending.pop(transaction, None)
+
+    def handle(self, text, address):
+        """
+        Handles a DHT message that arrived from 'address'
+
+        :param text: the CONTROL message text
+        :type text: String
+        :param address: (ip, port) it came from
+        :type address: tuple
+        :return: the reply text for a query, otherwise None
+        :rtype: String
+        """
+        try:
+            msg = json.loads(text[len("DHT:"):])
+            self.seen(int(msg['id'], 16), address)
+            if msg['y'] == 'q':
+                return self.answer(msg, address)
+            pending = self.pending.get(msg['t'])
+            if pending and pending[1] == address and not pending[0].done():
+                pending[0].set_result(msg)
+        except (ValueError, KeyError, TypeError) as e:
+            print(f"[DHT] Malformed message from {address[0]}:{address[1]}: {e}")
+        return None
+
+    def answer(self, msg, address):
+        """
+        Answers a query
+
+        :param msg: the query
+        :type msg: dict
+        :param address: (ip, port) it came from
+        :type address: tuple
+        :return: the reply text
+        :rtype: String
+        """
+        kind = msg['q']
+        reply = {}
+        if kind == 'find_node':
+            target = int(msg['target'], 16)
+            reply['nodes'] = [[format(node_id, 'x'), ip, port]
+                              for node_id, (ip, port) in self.closest(target, K, address)]
+        elif kind == 'find_value':
+            key = int(msg['key'], 16)
+            reply['nodes'] = [[format(node_id, 'x'), ip, port]
+                              for node_id, (ip, port) in self.closest(key, K, address)]
+            reply['values'] = self.values(key, MAX_VALUES)
+            reply['token'] = self.token(address[0])
+        elif kind == 'store':
+            if msg['token'] != self.token(address[0]):
+                return self.message('r', msg['t'], error="bad token")
+            self.store(int(msg['key'], 16), address, msg['file_id'], msg['name'], msg['digest'])
+        return self.message('r', msg['t'], **reply)
+
+    def store(self, key, address, file_id, name, digest):
+        """
+        Keeps a record that the peer at 'address' holds a file
+
+        :param key: the key it is stored under
+        :type key: int
+        :param address: (ip, port) of the peer holding the file
+        :type address: tuple
+        :param file_id: the id the peer holds it under
+        :type file_id: String
+        :param name: the peer's name
+        :type name: String
+        :param digest: hex sha256 of the content
+        :type digest: String
+        """
+        records = self.records.setdefault(key, {})
+        records[address + (file_id,)] = [name, digest, time.monotonic() + RECORD_TTL]
+        if len(records) > MAX_RECORDS:
+            del records[min(records, key=lambda record: records[record][2])]
+
+    def values(self, key, count):
+        """
+        :param key: the key
+        :type key: int
+        :param count: most records to give
+        :type count: int
+        :return: up to 'count' unexpired records under key picked at random,
+            list of [ip, port, name, file_id, digest]
+        :rtype: list
+        """
+        records = self.records.get(key)
+        if not records:
+            return []
+        now = time.monotonic()
+        found = [[ip, port, name, file_id, digest]
+                 for (ip, port, file_id), (name, digest, expiry) in records.items() if expiry > now]
+        return random.sample(found, min(count, len(found)))
+
+    def expire(self):
+        """
+        Drops every record whose TTL ran out
+        """
+        now = time.monotonic()
+        for key in list(self.records):
+            records = self.records[key]
+            for record in [record for record, entry in records.items() if entry[2] <= now]:
+                del records[record]
+            if not records:
+                del self.records[key]
+
+    async def lookup(self, target, find_value=False, want=None):
+        """
+        Finds the K nodes closest to target, keeping ALPHA queries in flight
+
+        :param target: the id or key looked for
+        :type target: int
+        :param find_value: also collect the records stored under target
+        :type find_value: bool
+        :param want: stop once this many records are found, None to converge
+        :type want: int
+        :return: (closest nodes that answered as (node id, (ip, port), token),
+            records as (ip, port, name, file_id, digest))
+        :rtype: tuple
+        """
+        shortlist = {node_id: (address, 0) for node_id, address in self.closest(target)}
+        queried = set()
+        answered = {}
+        values = {}
+        in_flight = {}
+        kind, field = ('find_value', 'key') if find_value else ('find_node', 'target')
+        hex_target = format(target, 'x')
+        try:
+            while True:
+                for node_id in sorted(shortlist, key=lambda node_id: node_id ^ target)[:K]:
+                    if len(in_flight) >= ALPHA:
+                        break
+                    if node_id not in queried:
+                        queried.add(node_id)
+                        task = asyncio.ensure_future(self.query(shortlist[node_id][0], kind, **{field: hex_target}))
+                        in_flight[task] = node_id
+                if not in_flight:
+                    break
+                done, _ = await asyncio.wait(in_flight, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    node_id = in_flight.pop(task)
+                    reply = task.result()
+                    if reply is None or 'error' in reply:
+                        shortlist.pop(node_id, None)
+                        continue
+                    address, depth = shortlist[node_id]
+                    answered[node_id] = (address, reply.get('token'), depth)
+                    try:
+                        for ip, port, name, file_id, digest in reply.get('values', []):
+                            if valid_address(ip, port) and all(isinstance(field, str)
+                                                               for field in (name, file_id, digest)):
+                                values[(ip, port, file_id)] = (ip, port, name, file_id, digest)
+                        for hex_id, ip, port in reply.get('nodes', []):
+                            if not valid_address(ip, port):
+                                continue
+                            found = int(hex_id, 16)
+                            if found != self.node_id and found not in queried and found not in shortlist:
+                                shortlist[found] = ((ip, port), depth + 1)
+                    except (ValueError, TypeError):
+                        print(f"[DHT] Malformed reply from {address[0]}:{address[1]}")
+                if want is not None and len(values) >= want:
+                    break
+        finally:
+            for task in in_flight:
+                task.cancel()
+
+        closest = sorted(answered, key=lambda node_id: node_id ^ target)[:K]
+        self.last_lookup = {'rpcs': len(queried), 'hops': 1 + max((answered[n][2] for n in closest), default=-1)}
+        return [(node_id, answered[node_id][0], answered[node_id][1]) for node_id in closest], list(values.values())
+
+    async def bootstrap(self, addresses):
+        """
+        Joins the network through some known nodes: pings them, then looks
+        up our own id, which fills our buckets and makes us known to the
+        nodes near us
+
+        :param addresses: (ip, port) of nodes already in the network
+        :type addresses: list
+        :return: number of nodes now known
+        :rtype: int
+        """
+        await asyncio.gather(*(self.query(address, 'ping') for address in addresses))
+        await self.lookup(self.node_id)
+        print(f"[DHT] Joined with {len(self)} nodes known.")
+        return len(self)
+
+    async def publish(self, file_id, digest):
+        """
+        Stores records that we hold a file at the K nodes closest to its
+        content digest and to its file id
+
+        :param file_id: id we share the file under
+        :type file_id: String
+        :param digest: hex sha256 of the content
+        :type digest: String
+        """
+        for key in (content_key(digest=digest), content_key(file_id=file_id)):
+            # Ours too, a lookup that reaches us finds it
+            self.store(key, self.address, file_id, self.name, digest)
+            nodes, _ = await self.lookup(key, find_value=True)
+            await asyncio.gather(*(self.query(address, 'store', key=format(key, 'x'), token=token,
+                                              file_id=file_id, name=self.name, digest=digest)
+                                   for _, address, token in nodes if token))
+
+    async def announce(self, content):
+        """
+        Publishes the files added or changed since the last announce. Records
+        of files no longer served are left to expire.
+
+        :param content: file id -> hex sha256 of the content of every file we serve
+        :type content: dict
+        :return: number of files published
+        :rtype: int
+        """
+        current = set(content.items())
+        added = current - self.published
+        self.published = current
+        await self.publish_all(added)
+        return len(added)
+
+    async def publish_all(self, files):
+        """
+        Publishes files, ANNOUNCE_CONCURRENCY at a time
+
+        :param files: (file_id, digest) of the files
+        :type files: iterable
+        """
+        limit = asyncio.Semaphore(ANNOUNCE_CONCURRENCY)
+
+        async def one(file_id, digest):
+            async with limit:
+                await self.publish(file_id, digest)
+
+        await asyncio.gather(*(one(file_id, digest) for file_id, digest in files))
+
+    async def locate(self, file_id=None, digest=None, limit=MAX_VALUES):
+        """
+        Finds peers holding a file
+
+        :param file_id: id of the file
+        :type file_id: String
+        :param digest: hex sha256 of the content, looked for instead of file_id if given
+        :type digest: String
+        :param limit: stop once this many holders are found
+        :type limit: int
+        :return: list of (ip, port, name, file id, hex digest), not including us
+        :rtype: list
+        """
+        key = content_key(file_id, digest)
+        _, holders = await self.lookup(key, find_value=True, want=limit + 1)
+        known = {(ip, port, fid) for ip, port, _, fid, _ in holders}
+        holders += [tuple(record) for record in self.values(key, MAX_VALUES) if tuple(record[:2] + record[3:4]) not in known]
+        return [holder for holder in holders if tuple(holder[:2]) != self.address][:limit]
+
+    async def maintain(self):
+        """
+        Runs forever: expires records, refreshes buckets not heard from for
+        BUCKET_REFRESH with a lookup of a random id in their range, and
+        republishes our files every REPUBLISH_INTERVAL
+        """
+        while True:
+            await asyncio.sleep(MAINTENANCE_INTERVAL)
+            self.expire()
+            now = time.monotonic()
+            for index, bucket in enumerate(self.buckets):
+                if bucket and now - self.touched[index] > BUCKET_REFRESH:
+                    self.touched[index] = now
+                    await self.lookup(self.node_id ^ (1 << index) ^ random.getrandbits(index))
+            if now - self.last_publish > REPUBLISH_INTERVAL:
+                self.last_publish = now
+                await self.publish_all(self.published)
@@ -1,14 +1,19 @@
 import argparse
+import asyncio
 from os import _exit
-import os.path
+import os
+import signal
 import socket
-import threading
-import sys
-import queue
-from threading import Thread
 
-from receiver_rdt import Receiver, verify_integrity
-from sender_rdt import Sender, convert_receiver_payload, make_checksum
+from receiver_rdt import Receiver
+from sender_rdt import (Sender, LoopScheduler, UploadScheduler, RateLimiter, ChunkRanges, convert_meta_payload,
+                        PIECE_CHUNKS, DEFAULT_CHUNK_SIZE)
+from share_index import ShareIndex, DEFAULT_INDEX_PATH, read_index_page
+from tracker import Tracker, TrackerCluster, TRACKER_PORT
+from pex import PeerTable, GOSSIP_INTERVAL, GOSSIP_FANOUT, MIN_PEERS, TRACKER_RETRY
+from dht import DHTNode, MAINTENANCE_INTERVAL
+import wire
+import random
 import time
 
 
@@ -21,6 +26,15 @@ import time
 #   1. python p2p_command.py --tracker
 #   2. python p2p_command.py
 #
+# Several trackers can share the work, each peer given all of them:
+#   1. python p2p_command.py --tracker --port 9000
+#   2. python p2p_command.py --tracker --port 9001
+#   3. python p2p_command.py --tracker-addr <ip>:9000 --tracker-addr <ip>:9001
+#
+# Or without a tracker, peers finding each other and files over a DHT:
+#   1. python p2p_command.py --dht --port 10001
+#   2. python p2p_command.py --dht --port 10002 --bootstrap <ip>:10001
+#
 
 
 # -----------------------------
@@ -28,50 +42,38 @@ import time
 # -----------------------------
 
 
-PEERS = set()  # This set stores all peer addresses as strings like "ip:port"
+# Receive buffer requested for the peer's UDP socket, the kernel may cap it
+RECV_BUFFER = 4 << 20
+
+# Local index: file_id -> filepath, filled from the shared directories by run_peer
+peer_files = ShareIndex(["shared"])
+
+# Most peers asked of the tracker, picked at random when more are registered
+DISCOVERED_PEERS = 256
+# Most sources of a file asked of the tracker, picked at random when more hold it
+LOCATED_PEERS = 64
 
-# Local index: file_id -> filepath
-peer_files = {
-    "001": "shared/file1.txt",
-    "002": "shared/file2.txt",
-    "003": "shared/file3.txt"
-}
+# Indexes of other peers seen so far: peer address -> {'etag', 'files': {file_id: (size, name)}}
+remote_indexes = {}
+# INDEX pages requested from a peer at once
+INDEX_WINDOW = 16
 
 
 
-def start_tracker(host='0.0.0.0', port=9000):
+def start_tracker(host='0.0.0.0', port=TRACKER_PORT, state_path=None):
     """
     Starts the tracker server that listens for incoming peer registrations.
-    It adds peers to a global set and returns the list of known peers (excluding the caller).
+    Registrations expire unless the peer keeps sending heartbeats, see tracker.Tracker.
+
+    :param state_path: file the tracker's state is saved to and restored from,
+        None for tracker_<port>.json
     """
-    def handle_client(conn, addr):
-        """
-        Handles an individual connection from a peer.
-        Expects a message in the format "REGISTER:<ip>:<port>"
-        Responds with a '|' separated list of all other peers.
-        """
-        data = conn.recv(1024).decode()
-        if data.startswith("REGISTER:"):
-            peer_info = data.split("REGISTER:")[1]
-            ip_port, name = peer_info.rsplit(":", 1)
-            peer_full = f"{ip_port}:{name}"
-            PEERS.add((ip_port, name))
-            print(f"[Tracker] Registered peer: {peer_info}")
-            peer_list = "|".join(f"{ip}:{n}" for ip, n in PEERS if f"{ip}:{n}" != peer_full)
-            conn.send(peer_list.encode())
-        conn.close()
-
-    # Set up TCP server socket
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    s.bind((host, port))
-    s.listen(5)
-    print(f"[Tracker] Running on {host}:{port}")
-    print("[Tracker] Waiting for peers to connect...")
-
-    # Accept connections forever (each handled in a separate thread)
-    while True:
-        conn, addr = s.accept()
-        threading.Thread(target=handle_client, args=(conn, addr)).start()
+    if state_path is None:
+        state_path = f"tracker_{port}.json"
+    tracker = Tracker(host, port, state_path=state_path)
+    # Stopping lets the tracker save its state on the way out
+    signal.signal(signal.SIGTERM, lambda signum, frame: tracker.stop())
+    tracker.serve_forever()
 
 
 # -----------------------------
@@ -79,53 +81,242 @@ def start_tracker(host='0.0.0.0', port=9000):
 # -----------------------------
 
 
-def register_with_tracker(tracker_host, tracker_port, peer_host, peer_port, peer_name):
+def register_with_tracker(client, peer_host, peer_port, peer_name):
     """
-    Connects to the tracker and registers the current peer.
-    Returns a list of other peers in the network.
+    Registers the current peer with the tracker.
+    Returns a list of other peers in the network, a random sample of them
+    if there are more than DISCOVERED_PEERS.
+
+    :param client: connection to the tracker
+    :type client: tracker.TrackerCluster
+    :return: list of (ip, port, name)
+    :rtype: list
     """
-    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     try:
-        s.connect((tracker_host, tracker_port))
-        peer_info = f"{peer_host}:{peer_port}:{peer_name}"
-        s.send(f"REGISTER:{peer_info}".encode())
-        data = s.recv(1024).decode()
-        peer_list = data.split('|') if data else []
-        return peer_list
-    except Exception as e:
+        client.register(peer_host, peer_port, peer_name)
+        peer_list = client.peers(DISCOVERED_PEERS, sample=True)
+        return [peer for peer in peer_list if peer[:2] != (peer_host, peer_port)]
+    except OSError as e:
         print(f"[Error] Could not connect to tracker: {e}")
         return []
-    finally:
-        s.close()
 
 
-def peer_discovery(my_port, my_name):
+def peer_discovery(client, peers):
+    """
+    Uses the tracker to discover other peers in the network: registers with
+    it the first time, afterwards only asks it for a fresh sample of peers.
+    Adds what it finds to the peer table.
+
+    :param client: connection to the tracker
+    :type client: tracker.TrackerCluster
+    :param peers: our peer table
+    :type peers: pex.PeerTable
+    """
+    my_host, my_port, my_name = peers.me
+    peers.last_tracker = time.monotonic()
+    if client.registration is None:
+        peer_list = register_with_tracker(client, my_host, my_port, my_name)
+    else:
+        try:
+            peer_list = client.peers(DISCOVERED_PEERS, sample=True)
+        except OSError as e:
+            print(f"[Error] Could not connect to tracker: {e}")
+            peer_list = []
+
+    for ip, port, name in peer_list:
+        peers.learn(ip, port, name)
+
+
+async def keep_gossiping(receiver, peers, directory):
+    """
+    Swaps peer lists with a few random peers every GOSSIP_INTERVAL, so the
+    peer table stays fresh without asking the tracker. The tracker is only
+    asked again when gossip leaves us knowing too few peers, in DHT mode
+    we gossip with a few nodes of the DHT instead.
+
+    :param receiver: the receiver whose socket gossip is sent from
+    :type receiver: Receiver
+    :param peers: our peer table
+    :type peers: pex.PeerTable
+    :param directory: connection to the tracker, or our node of the DHT
+    :type directory: tracker.TrackerCluster or dht.DHTNode
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        # Jittered so peers started together do not gossip in lockstep
+        await asyncio.sleep(GOSSIP_INTERVAL * random.uniform(0.5, 1.5))
+        peers.expire()
+        targets = peers.targets()
+        if len(peers) < MIN_PEERS and time.monotonic() - peers.last_tracker > TRACKER_RETRY:
+            if isinstance(directory, DHTNode):
+                peers.last_tracker = time.monotonic()
+                targets += directory.addresses(GOSSIP_FANOUT)
+            else:
+                await loop.run_in_executor(None, peer_discovery, directory, peers)
+        for addr in targets:
+            send_control(receiver.soc, addr, peers.gossip(True))
+
+
+def served_content(receiver):
     """
-    Uses the tracker to discover other peers in the network.
-    Returns a dictionary mapping 'peer_id' to (ip, port).
+    :param receiver: the receiver whose downloads we serve pieces of
+    :type receiver: Receiver
+    :return: file_id -> hex digest of the shared files and of the files we
+        are downloading, whose finished pieces we serve
+    :rtype: dict
     """
-    my_host = socket.gethostbyname(socket.gethostname())
-    tracker_host, tracker_port = '127.0.0.1', 9000
+    content = receiver.download_digests()
+    content.update(peer_files.digests())
+    return content
 
-    peer_list = register_with_tracker(tracker_host, tracker_port, my_host, my_port, my_name)
-    
-    # Create dictionary: {'Tempest': ('127.0.0.1', 10001),}
-    peer_dict = {}
-    for entry in peer_list:
-        ip, port, name = entry.split(":")
-        peer_dict[name] = (ip, int(port))
-    return peer_dict
+
+def announce_content(client, content):
+    """
+    Tells the tracker what has changed in the files we serve: the shared
+    files and the finished pieces of files we are downloading.
+
+    :param client: connection to the tracker we registered with
+    :type client: tracker.TrackerCluster
+    :param content: file_id -> hex digest of what we serve, from served_content
+    :type content: dict
+    """
+    if client.registration is None:
+        return
+    try:
+        client.announce(content)
+    except OSError as e:
+        print(f"[Error] Could not announce files to tracker: {e}")
+
+
+async def keep_registered(client, receiver):
+    """
+    Sends the tracker a heartbeat a few times per TTL, so our registration
+    does not expire while we are running, along with what changed in the
+    files we serve
+
+    :param client: connection to the tracker we registered with
+    :type client: tracker.TrackerCluster
+    :param receiver: the receiver whose downloads we serve pieces of
+    :type receiver: Receiver
+    """
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(client.ttl / 3)
+        if client.registration is None:
+            continue
+        try:
+            await loop.run_in_executor(None, client.heartbeat)
+        except OSError as e:
+            print(f"[Error] Tracker heartbeat failed: {e}")
+            continue
+        await loop.run_in_executor(None, announce_content, client, served_content(receiver))
+
+
+async def keep_published(node, receiver):
+    """
+    Publishes what changed in the files we serve to the DHT every
+    MAINTENANCE_INTERVAL, e.g. downloads we started serving pieces of.
+    The node itself republishes everything before its records expire.
+
+    :param node: our node of the DHT
+    :type node: dht.DHTNode
+    :param receiver: the receiver whose downloads we serve pieces of
+    :type receiver: Receiver
+    """
+    while True:
+        await asyncio.sleep(MAINTENANCE_INTERVAL)
+        await node.announce(served_content(receiver))
+
+
+async def publish_content(directory, receiver):
+    """
+    Announces what changed in the files we serve to the tracker or the DHT
+
+    :param directory: connection to the tracker we registered with, or our node of the DHT
+    :type directory: tracker.TrackerCluster or dht.DHTNode
+    :param receiver: the receiver whose downloads we serve pieces of
+    :type receiver: Receiver
+    """
+    if isinstance(directory, DHTNode):
+        published = await directory.announce(served_content(receiver))
+        if published:
+            print(f"[DHT] Published {published} files.")
+    else:
+        await asyncio.get_running_loop().run_in_executor(None, announce_content, directory,
+                                                         served_content(receiver))
+
+
+async def refresh_shares(directory, receiver):
+    """
+    Announces the files we serve, then rescans the shared directories and
+    announces what changed
+
+    :param directory: connection to the tracker we registered with, or our node of the DHT
+    :type directory: tracker.TrackerCluster or dht.DHTNode
+    :param receiver: the receiver whose downloads we serve pieces of
+    :type receiver: Receiver
+    """
+    loop = asyncio.get_running_loop()
+    # What the index already holds is announced without waiting for a long scan
+    await publish_content(directory, receiver)
+    await loop.run_in_executor(None, peer_files.scan)
+    await publish_content(directory, receiver)
+
+
+def locate_sources(client, file_id, digest=None):
+    """
+    Asks the tracker which peers share file_id, instead of asking every peer
+
+    :param client: connection to the tracker
+    :type client: tracker.TrackerCluster
+    :param file_id: the file ID being looked up
+    :type file_id: String
+    :param digest: content the peers must hold, None for any
+    :type digest: String
+    :return: dictionary of peer_name -> (ip, port), None if the tracker could not be reached
+    :rtype: dict
+    """
+    try:
+        holders = client.locate(file_id, digest, LOCATED_PEERS)
+    except OSError as e:
+        print(f"[Error] Could not reach tracker: {e}")
+        return None
+    me = client.registration[:2] if client.registration else None
+    return {name: (ip, port) for ip, port, name, held_id, _ in holders
+            if held_id == file_id and (ip, port) != me}
+
+
+async def find_sources(directory, file_id, digest=None):
+    """
+    Looks up which peers share file_id with the tracker or in the DHT
+
+    :param directory: connection to the tracker, or our node of the DHT
+    :type directory: tracker.TrackerCluster or dht.DHTNode
+    :param file_id: the file ID being looked up
+    :type file_id: String
+    :param digest: content the peers must hold, None for any
+    :type digest: String
+    :return: dictionary of peer_name -> (ip, port), None if the tracker could not
+        be reached or the DHT knows of no holder, records may still be spreading
+    :rtype: dict
+    """
+    if not isinstance(directory, DHTNode):
+        return await asyncio.get_running_loop().run_in_executor(None, locate_sources, directory,
+                                                                file_id, digest)
+    holders = await directory.locate(file_id, digest, LOCATED_PEERS)
+    located = {name: (ip, port) for ip, port, name, held_id, _ in holders if held_id == file_id}
+    return located if located else None
 
 
 def get_index_path(exch_id):
     """
-    Given a file ID, return the absolute file path.
-    
-    :param exch_peer: the peer requesting the file (not used currently)
+    Given a file ID, return the path of the shared file indexed under it.
+
     :param exch_id: the file ID being requested
-    :return: the file path as a string, or empty string if not found
+    :return: the path peer_files holds for the file, or empty string if it
+        is not shared
     """
-    return os.path.abspath(peer_files.get(exch_id, ""))
+    return peer_files.get(exch_id, "")
 
 
 def print_menu():
@@ -135,44 +326,100 @@ def print_menu():
     print('\nAvailable commands:')
     print('i -peer_name          : Display data available from peer')
     print('c -peer_name -id      : Connect to peer and request file with id')
-    print('r                     : Refresh peer discovery')
+    print('c -id                 : Download file with id from every peer that has it')
+    print('r                     : Rescan shared files')
     print('q                     : Quit')
 
 
-def print_index(peer_addr=None, soc=None):
+def fetch_index(peer_addr, timeout=1.0, attempts=3):
     """
-    Displays the list of available files from this peer.
+    Brings our copy of a peer's index up to date. Only the changes since the
+    version we hold are asked for, in pages requested INDEX_WINDOW at a time.
     Uses a separate socket to avoid interference with receiver.
+
+    :param peer_addr: (ip, port) of the peer
+    :type peer_addr: tuple
+    :param timeout: seconds to wait for the pages of one window
+    :type timeout: float
+    :param attempts: windows in a row that may go unanswered before giving up
+    :type attempts: int
+    :return: the updated index {'etag', 'files'}, or None if the peer did not answer
+    :rtype: dict
     """
-    if peer_addr:
-        print(f"[Index] Requesting index from {peer_addr}...")
+    cached = remote_indexes.get(peer_addr)
+    since = cached['etag'] if cached else '-'
+    pages = {}
+    header = None
 
-        # Create a fresh, temporary socket for this request
-        temp_soc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        temp_soc.bind(('', 0))  # OS assigns an available port
+    # Create a fresh, temporary socket for this request
+    temp_soc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    temp_soc.bind(('', 0))  # OS assigns an available port
+    temp_soc.settimeout(timeout)
+    try:
+        misses = 0
+        started = time.time()
+        while header is None or len(pages) < header[2]:
+            wanted = [page for page in range(header[2] if header else 1) if page not in pages][:INDEX_WINDOW]
+            for page in wanted:
+                temp_soc.sendto(wire.encode_control(f"INDEX_REQ:{since},{page}"), peer_addr)
+            progress = False
+            try:
+                while any(page not in pages for page in wanted):
+                    data, _ = temp_soc.recvfrom(wire.MAX_DATAGRAM)
+                    reply = read_index_page(data)
+                    if reply is None:
+                        continue
+                    etag, base, number, count, lines = reply
+                    if header is None:
+                        # Lost pages are noticed after a few round trips rather than 'timeout'
+                        temp_soc.settimeout(min(timeout, max(0.05, 4 * (time.time() - started))))
+                    if header is None or header[0] != etag:
+                        # First page, or the index changed while we were paging through it
+                        header = (etag, base, count)
+                        pages.clear()
+                    pages[number] = lines
+                    progress = True
+            except socket.timeout:
+                misses = 0 if progress else misses + 1
+                if misses == attempts:
+                    return None
+    finally:
+        temp_soc.close()
 
-        try:
-            msg = "INDEX_REQ"
-            chksum = make_checksum(msg.encode())
-            temp_soc.sendto(chksum + msg.encode(), peer_addr)
-
-            temp_soc.settimeout(3)
-            data, _ = temp_soc.recvfrom(4096)
-            chksum = data[:8]
-            payload = data[8:]
-
-            if verify_integrity(chksum, payload):
-                _, index_msg = convert_receiver_payload(payload)
-                print("[Remote Index]")
-                for entry in index_msg.split("|"):
-                    fid, name = entry.split(":")
-                    print(f"ID: {fid} -> {name}")
+    etag, base, _ = header
+    files = dict(cached['files']) if cached and base != '-' else {}
+    for number in range(len(pages)):
+        for line in pages[number]:
+            if line.startswith('-'):
+                files.pop(line[1:], None)
             else:
-                print("[Index] Corrupted response.")
-        except socket.timeout:
-            print("[Index] No response from peer.")
-        finally:
-            temp_soc.close()
+                fid, size, name = line.split("\t", 2)
+                files[fid] = (int(size), name)
+    index = {'etag': etag, 'files': files}
+    if etag != '-':
+        remote_indexes[peer_addr] = index
+    return index
+
+
+def print_index(peer_addr=None, soc=None):
+    """
+    Displays the list of available files from this peer, or from the peer
+    at 'peer_addr'. A peer's index is kept between calls and only refreshed
+    with what changed since.
+    """
+    if peer_addr:
+        print(f"[Index] Requesting index from {peer_addr}...")
+        index = fetch_index(peer_addr)
+        if index is None:
+            index = remote_indexes.get(peer_addr)
+            if index is None:
+                print("[Index] No response from peer.")
+                return
+            print("[Index] No response from peer, showing the last index it sent.")
+        print("[Remote Index]")
+        for fid in sorted(index["files"], key=lambda fid: (len(fid), fid)):
+            size, name = index['files'][fid]
+            print(f"ID: {fid} -> {name} ({size} bytes)")
     else:
         print("\n[Local File Index]")
         for fid, path in peer_files.items():
@@ -182,7 +429,7 @@ def print_index(peer_addr=None, soc=None):
 def exchange_data(peers, peer_name, file_id, receiver, address):
     """
     Sends an EXCH_REQ to the remote peer.
-    The remote peer's receiver will queue a file-sending job in 'exch_req_queue'.
+    The remote peer's receiver will start an upload of the file back to us.
     """
     print(f"[Exchange] Attempting to download file ID {file_id} from {peer_name}...")
 
@@ -191,75 +438,509 @@ def exchange_data(peers, peer_name, file_id, receiver, address):
         return
 
     peer_addr = peers[peer_name]
-    peer_msg = f"EXCH_REQ:{file_id},{address}"
+    receiver.expect_file(file_id)
+    send_exchange_request(receiver.soc, peer_addr, file_id, address, missing_ranges(receiver, file_id),
+                          receiver.codecs, receiver.fec)
+
+    print("[Exchange] EXCH_REQ sent. Receiver will auto-save once the remote peer responds.")
+
+
+def missing_ranges(receiver, file_id):
+    """
+    Works out which chunks of a partly downloaded file still have to be
+    requested, so a resumed download skips the chunks already on disk.
+
+    :param receiver: the Receiver holding the partial download
+    :param file_id: the file ID being requested
+    :return: ChunkRanges of the missing chunks, or None to request the whole file
+    """
+    partial = receiver.partial_file(file_id)
+    if partial is None:
+        return None
+    _, meta, completed = partial
+    if not any(completed):
+        return None
+    return ChunkRanges.from_indexes(i for i in range(meta['chunk_count'])
+                                    if not completed[i >> 3] & (0x80 >> (i & 7)))
+
+
+def send_exchange_request(soc, peer_addr, file_id, address, ranges=None, codecs=None, fec=None):
+    """
+    Sends an EXCH_REQ for a whole file, or only some chunk ranges of it.
+
+    :param soc: the UDP socket the receiver is bound to, data comes back to it
+    :param peer_addr: (ip, port) of the peer holding the file
+    :param file_id: the file ID being requested
+    :param address: "ip:port" of this peer
+    :param ranges: optional ChunkRanges of the chunks wanted
+    :param codecs: optional names of the codecs chunks may be compressed with, most preferred first
+    :param fec: optional (n, k), k parity packets to send after every n data packets
+    """
+    fields = [file_id, address, '' if ranges is None else str(ranges),
+              ';'.join(codecs) if codecs else '', f"{fec[0]}:{fec[1]}" if fec else '']
+    # Trailing fields left empty are dropped
+    while not fields[-1]:
+        fields.pop()
+    peer_msg = "EXCH_REQ:" + ",".join(fields)
 
     # Use the same UDP socket the receiver is bound to
-    s = receiver.soc
-    payload = peer_msg.encode('utf-8')
-    chksum = make_checksum(payload)
-    s.sendto(chksum + payload, peer_addr)
+    soc.sendto(wire.encode_control(peer_msg), peer_addr)
 
-    print("[Exchange] EXCH_REQ sent. Receiver will auto-save once the remote peer responds.")
+
+def request_metadata(peers, file_id, timeout=2.0):
+    """
+    Asks every known peer at once for its metadata of file_id.
+    Uses a separate socket to avoid interference with receiver.
+
+    :param peers: dictionary of peer_name -> (ip, port)
+    :param file_id: the file ID being looked up
+    :param timeout: seconds to wait for replies
+    :return: dictionary of peer_name -> metadata for the peers that have the file
+    """
+    temp_soc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    temp_soc.bind(('', 0))
+    names = {addr: name for name, addr in peers.items()}
+    found = {}
+
+    try:
+        msg = wire.encode_control(f"META_REQ:{file_id}")
+        for addr in names:
+            temp_soc.sendto(msg, addr)
+
+        deadline = time.monotonic() + timeout
+        while len(found) < len(names):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            temp_soc.settimeout(remaining)
+            data, addr = temp_soc.recvfrom(wire.MAX_DATAGRAM)
+            if addr in names and wire.parse_packet(data) == (wire.PACKET_META, 0):
+                _, meta_msg = wire.decode_meta(data)
+                found[names[addr]] = convert_meta_payload(meta_msg)
+    except socket.timeout:
+        pass
+    finally:
+        temp_soc.close()
+    return found
+
+
+def send_control(soc, peer_addr, text):
+    """
+    Sends a checksummed text control message such as BITFIELD_REQ or HAVE.
+
+    :param soc: socket to send from, replies come back to it
+    :param peer_addr: (ip, port) of the peer
+    :param text: the message
+    """
+    soc.sendto(wire.encode_control(text), peer_addr)
+
+
+class SwarmDownload:
+    """
+    SwarmDownload, fetches disjoint chunk ranges of one file from several
+    peers in parallel into the receiver's single reassembly buffer
+
+    The file is split into pieces of PIECE_CHUNKS chunks. Peers advertise
+    which pieces they hold with BITFIELD replies and HAVE updates, so
+    peers that are themselves still downloading the file can serve the
+    pieces they already finished. Every idle source is handed a batch of
+    the pieces it holds, rarest first across the swarm, sized from how fast
+    it delivered its last batch. A source that makes no progress for
+    stall_timeout has its unfinished pieces handed back to the pool and
+    sits out for a while. Once every piece has been handed out, idle sources
+    are asked for the chunks still missing from pieces other sources are
+    working on (endgame), so one slow source cannot hold up the end of the
+    download. Every piece we finish is announced to the swarm with HAVE.
+
+    Attributes:
+        receiver: Receiver the chunks arrive at and piece maps are collected by
+        file_id: the file ID being downloaded
+        peers: peer_name -> (ip, port) of every known peer
+        meta: metadata of the file, sources must match its digest
+        pool: piece numbers not yet handed to any source
+        assigned: peer_name -> state of that source's current batch
+        announced: piece numbers we already sent HAVE for
+    """
+    PIECE_CHUNKS = PIECE_CHUNKS
+    stall_timeout = 5.0
+    # Give up if the whole swarm makes no progress for this long
+    give_up_timeout = 30.0
+    # Seconds of transfer a batch should roughly take at a source's measured rate
+    batch_seconds = 2.0
+    max_batch = 16
+    # How often to ask every peer for its piece bitmap again
+    bitfield_interval = 5.0
+
+    def __init__(self, receiver, file_id, peers, meta, address):
+        self.receiver = receiver
+        self.file_id = file_id
+        self.peers = peers
+        self.meta = meta
+        self.address = address
+        self.piece_count = (meta['chunk_count'] + self.PIECE_CHUNKS - 1) // self.PIECE_CHUNKS
+        self.pool = list(range(self.piece_count))
+        self.assigned = {}
+        self.rates = {}
+        self.benched = {}
+        self.endgame_sent = set()
+        self.announced = set()
+
+    def piece_chunks(self, piece):
+        """
+        :param piece: piece number
+        :type piece: int
+        :return: range of the chunk indexes in that piece
+        :rtype: range
+        """
+        first = piece * self.PIECE_CHUNKS
+        return range(first, min(first + self.PIECE_CHUNKS, self.meta['chunk_count']))
+
+    def missing(self, completed, piece):
+        """
+        :param completed: completion bitmap from Receiver.completed_chunks
+        :type completed: bytearray
+        :param piece: piece number
+        :type piece: int
+        :return: chunk indexes of the piece not yet on disk
+        :rtype: list
+        """
+        return [i for i in self.piece_chunks(piece)
+                if (i >> 3) >= len(completed) or not completed[i >> 3] & (0x80 >> (i & 7))]
+
+    def source_pieces(self):
+        """
+        Collects the piece bitmaps of known peers that hold our content
+
+        :return: peer_name -> piece bitmap
+        :rtype: dict
+        """
+        names = {addr: name for name, addr in self.peers.items()}
+        maps = dict(self.receiver.piece_maps.get(self.file_id, {}))
+        return {names[addr]: entry['pieces'] for addr, entry in maps.items()
+                if addr in names and entry['digest'] == self.meta['digest'] and any(entry['pieces'])}
+
+    def request(self, name, pieces, completed):
+        """
+        Asks a source for the missing chunks of some pieces
+
+        :param name: peer_name of the source
+        :param pieces: piece numbers to request
+        :param completed: completion bitmap from Receiver.completed_chunks
+        :return: number of chunks requested
+        :rtype: int
+        """
+        wanted = [i for piece in sorted(pieces) for i in self.missing(completed, piece)]
+        if wanted:
+            ranges = ChunkRanges.from_indexes(wanted)
+            send_exchange_request(self.receiver.soc, self.peers[name], self.file_id, self.address, ranges,
+                                  self.receiver.codecs, self.receiver.fec)
+        return len(wanted)
+
+    def assign(self, name, holds, availability, completed, now):
+        """
+        Hands an idle source its next batch of pieces it holds, rarest first
+        from the pool or, in endgame, from pieces other sources are still
+        working on
+
+        :param name: peer_name of the idle source
+        :param holds: that source's piece bitmap
+        :param availability: piece number -> number of sources holding it
+        :param completed: completion bitmap from Receiver.completed_chunks
+        :param now: current time.monotonic()
+        """
+        def has(piece):
+            return (piece >> 3) < len(holds) and holds[piece >> 3] & (0x80 >> (piece & 7))
+
+        pieces = []
+        candidates = [p for p in self.pool if has(p)]
+        if candidates:
+            rate = self.rates.get(name)
+            batch = 1
+            if rate:
+                batch = int(rate * self.batch_seconds / self.PIECE_CHUNKS)
+            batch = max(1, min(self.max_batch, batch))
+            # Random tie break so peers downloading together spread over different pieces
+            random.shuffle(candidates)
+            candidates.sort(key=lambda p: availability[p])
+            pieces = candidates[:batch]
+            taken = set(pieces)
+            self.pool = [p for p in self.pool if p not in taken]
+        elif not self.pool:
+            for other in self.assigned.values():
+                for piece in other['pieces']:
+                    if has(piece) and (name, piece) not in self.endgame_sent and self.missing(completed, piece):
+                        self.endgame_sent.add((name, piece))
+                        pieces.append(piece)
+        if not pieces:
+            return
+        count = self.request(name, pieces, completed)
+        self.assigned[name] = {'pieces': pieces, 'chunks': count, 'started': now,
+                               'progress': now, 'left': count}
+
+    def announce(self, completed, sources):
+        """
+        Sends HAVE to the swarm for every piece finished since the last call
+
+        :param completed: completion bitmap from Receiver.completed_chunks
+        :param sources: peer_name -> piece bitmap of the current sources
+        """
+        for piece in range(self.piece_count):
+            if piece not in self.announced and not self.missing(completed, piece):
+                self.announced.add(piece)
+                for name in sources:
+                    send_control(self.receiver.soc, self.peers[name],
+                                 f"HAVE:{self.file_id},{self.meta['digest']},{piece}")
+
+    async def run(self):
+        """
+        Keeps every source busy until the receiver has saved the file
+        """
+        print(f"[Swarm] Downloading {self.file_id} ({self.meta['chunk_count']} chunks) "
+              f"from peers holding it among {', '.join(self.peers)}")
+        self.receiver.expect_file(self.file_id)
+        self.receiver.join_swarm(self.file_id, self.piece_count)
+        try:
+            last_progress = time.monotonic()
+            last_bitfield = 0
+            # A resumed download may already have some pieces
+            completed = self.receiver.completed_chunks(self.file_id)
+            if completed:
+                self.pool = [p for p in self.pool if self.missing(completed, p)]
+            while True:
+                completed = self.receiver.completed_chunks(self.file_id)
+                if completed is None:
+                    print(f"[Swarm] Download of {self.file_id} complete.")
+                    return
+                now = time.monotonic()
+
+                if now - last_bitfield > self.bitfield_interval:
+                    last_bitfield = now
+                    for addr in self.peers.values():
+                        send_control(self.receiver.soc, addr, f"BITFIELD_REQ:{self.file_id}")
+                sources = self.source_pieces()
+                self.announce(completed, sources)
+
+                for name, batch in list(self.assigned.items()):
+                    left = sum(len(self.missing(completed, piece)) for piece in batch['pieces'])
+                    if left == 0:
+                        elapsed = max(now - batch['started'], 1e-3)
+                        self.rates[name] = batch['chunks'] / elapsed
+                        del self.assigned[name]
+                    elif left < batch['left']:
+                        batch['left'] = left
+                        batch['progress'] = now
+                        last_progress = now
+                    elif now - batch['progress'] > self.stall_timeout:
+                        print(f"[Swarm] {name} stalled, moving its work to other peers.")
+                        del self.assigned[name]
+                        busy = {p for other in self.assigned.values() for p in other['pieces']}
+                        self.pool = [p for p in batch['pieces']
+                                     if p not in busy and self.missing(completed, p)] + self.pool
+                        self.rates[name] = None
+                        self.benched[name] = now + 2 * self.stall_timeout
+
+                availability = [0] * self.piece_count
+                for holds in sources.values():
+                    for piece in range(self.piece_count):
+                        if (piece >> 3) < len(holds) and holds[piece >> 3] & (0x80 >> (piece & 7)):
+                            availability[piece] += 1
+                for name, holds in sources.items():
+                    if name not in self.assigned and self.benched.get(name, 0) <= now:
+                        self.assign(name, holds, availability, completed, now)
+
+                if now - last_progress > self.give_up_timeout:
+                    print(f"[Swarm] No progress on {self.file_id} for {self.give_up_timeout}s, giving up.")
+                    return
+                await asyncio.sleep(0.1)
+        finally:
+            self.receiver.leave_swarm(self.file_id)
+
+
+async def swarm_download(peers, file_id, receiver, address, directory):
+    """
+    Finds every peer holding the same content for file_id, whole or in
+    part, and downloads disjoint pieces of it from all of them at once.
+    Sources are looked up with the tracker or in the DHT, every known peer
+    is asked only if the tracker cannot be reached or the DHT knows of none.
+    """
+    loop = asyncio.get_running_loop()
+    partial = receiver.partial_file(file_id)
+    located = await find_sources(directory, file_id, partial[1]['digest'] if partial else None)
+    if located is not None:
+        peers = located
+    found = await loop.run_in_executor(None, request_metadata, peers, file_id)
+    if not found:
+        print(f"[Swarm] No peer has file ID {file_id}.")
+        return
+
+    # Peers may share different files under the same ID, go with the most common
+    # content, or the content a resumed download already has part of
+    by_digest = {}
+    for name, meta in found.items():
+        by_digest.setdefault(meta['digest'], []).append(name)
+    names = max(by_digest.values(), key=len)
+    if partial:
+        names = by_digest.get(partial[1]['digest'])
+        if not names:
+            print(f"[Swarm] No peer has the content of the unfinished download of {file_id}.")
+            return
+    await SwarmDownload(receiver, file_id, peers, found[names[0]], address).run()
 
         
-def process_exchange_requests(exch_req_queue, address, soc):
+def only_completed(ranges, completed):
     """
-    Continuously monitors 'exch_req_queue' for (file_id, peer_address) tuples
-    and starts a Sender to serve that file to 'peer_address'.
+    Narrows requested ranges down to the chunks a partial download has on disk.
+
+    :param ranges: ChunkRanges requested
+    :param completed: chunk completion bitmap of the partial download
+    :return: ChunkRanges of the requested chunks that are complete
     """
-    while True:
-        if not exch_req_queue.empty():
-            print("[System] Fulfilling Exchange Request")
-            file_id, raw_peer_addr = exch_req_queue.get()
+    have = []
+    for pos in range(len(ranges)):
+        idx = ranges.chunk(pos)
+        if (idx >> 3) < len(completed) and completed[idx >> 3] & (0x80 >> (idx & 7)):
+            have.append(idx)
+    return ChunkRanges.from_indexes(have, max_ranges=None)
 
-            try:
-                peer_ip, peer_port_str = raw_peer_addr.split(":")
-                exch_path = get_index_path(file_id)
-                send_soc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-                sender = Sender(send_soc, peer_ip, int(peer_port_str), file_id)
-                sender_thread = Thread(target=sender.setup_exchange, args=[exch_path])
-                sender_thread.start()
-            except ValueError:
-                print(f"[Error] Invalid peer address format: {raw_peer_addr}")
-        time.sleep(1)
+
+async def serve_exchange(file_id, raw_peer_addr, ranges, codecs, fec, receiver, scheduler, uploads):
+    """
+    Serves one EXCH_REQ: hands a Sender for the upload to 'peer_address' to
+    the upload scheduler, which runs it once a slot is free.
+    Files we are still downloading are served from the finished chunks of
+    the partial file held by 'receiver'. Chunks are compressed with the
+    first of the requester's 'codecs' we have, if any, and 'fec' parity is
+    sent if asked for.
+    """
+    codec = next((name for name in codecs if wire.find_codec(name)), None)
+    try:
+        peer_ip, peer_port_str = raw_peer_addr.split(":")
+        exch_path = get_index_path(file_id)
+        meta = peer_files.describe(file_id)
+        partial = receiver.partial_file(file_id) if file_id not in peer_files else None
+        if partial:
+            exch_path, meta, completed = partial
+        if meta is not None:
+            chunk_count = meta['chunk_count']
+        else:
+            # Changed since it was indexed, the Sender hashes it again when it starts
+            chunk_count = -(-os.path.getsize(exch_path) // DEFAULT_CHUNK_SIZE)
+        if ranges and ranges.ranges[-1][1] >= chunk_count:
+            print(f"[Error] EXCH_REQ from {raw_peer_addr} asks for chunks {ranges} of {file_id}, "
+                  f"which has {chunk_count}")
+            return
+        if partial:
+            ranges = only_completed(ranges or ChunkRanges.whole(meta['chunk_count']), completed)
+        sender = Sender(None, peer_ip, int(peer_port_str), file_id, scheduler=scheduler, ranges=ranges,
+                        codec=codec, fec=fec)
+    except ValueError:
+        print(f"[Error] Invalid peer address format: {raw_peer_addr}")
+        return
+    except OSError as e:
+        print(f"[Error] Cannot serve {file_id} to {raw_peer_addr}: {e}")
+        return
+
+    try:
+        await uploads.submit(sender, exch_path, meta)
+    except Exception as e:
+        print(f"[Sender] Upload of {file_id} to {raw_peer_addr} failed: {e}")
 
 
-def p2p_command_line(name, port):
+async def run_peer(name, port, fsync_policy='complete', upload_slots=8, max_up=None, max_down=None,
+                   peer_max_up=None, peer_max_down=None, compress=False, fec=None, shares=None,
+                   index_path=DEFAULT_INDEX_PATH, dht=False, bootstrap=None, trackers=None):
     """
-    Main interface for the P2P system.
-    Handles user input and executes commands.
+    Runs the peer on one asyncio event loop: the receiver endpoint, every
+    upload and swarm download are driven by the loop, while blocking work
+    such as reading commands and talking to the tracker runs off it.
+
+    :param fsync_policy: when downloads are synced to disk, see receiver_rdt.ChunkSink
+    :param upload_slots: most uploads served at once, see sender_rdt.UploadScheduler
+    :param max_up: total upload bytes per second, None for no limit
+    :param max_down: total download bytes per second, None for no limit
+    :param peer_max_up: upload bytes per second to each remote host, None for no limit
+    :param peer_max_down: download bytes per second from each remote host, None for no limit
+    :param compress: ask uploaders to compress chunks, see wire.CODECS
+    :param fec: optional (n, k) FEC parity to ask uploaders for, see wire.PARITY
+    :param shares: directories whose files are shared, None for ./shared
+    :param index_path: file the index of the shared files is kept in, see share_index.ShareIndex
+    :param dht: find peers and files over a DHT instead of the tracker, see dht.DHTNode
+    :param bootstrap: (ip, port) of peers already in the DHT to join it through
+    :param trackers: (host, port) of every tracker, None for one on this host, see tracker.TrackerCluster
     """
     ip = socket.gethostbyname(socket.gethostname())
     address = f"{ip}:{port}"
-          
+
     soc = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    # Every transfer shares this socket, give bursts from hundreds of them room to queue
+    soc.setsockopt(socket.SOL_SOCKET, socket.SO_RCVBUF, RECV_BUFFER)
     soc.bind((ip, port))
-    
-    exch_req_queue = queue.SimpleQueue()
-    receiver = Receiver(soc, peer_files)
 
-    listener = Thread(target=receiver.listen_for_requests, args=[exch_req_queue])
-    listener.start()
-    print("[System] Receiver thread launched.")
-    
-    exchange_processor = Thread(target=process_exchange_requests, args=[exch_req_queue, address, soc])
-    exchange_processor.start()
-    print("[System] Exchange processor thread launched.")
+    loop = asyncio.get_running_loop()
+    scheduler = LoopScheduler(loop)
+    down = RateLimiter(max_down, peer_max_down) if max_down or peer_max_down else None
+    up = RateLimiter(max_up, peer_max_up) if max_up or peer_max_up else None
+    if shares is not None:
+        peer_files.directories = list(shares)
+    peer_files.index_path = index_path
+    # Serve what was indexed last run at once, and catch up on changes once registered
+    peer_files.load()
+    receiver = Receiver(None, peer_files, scheduler, fsync_policy, down,
+                        wire.codec_names() if compress else None, fec)
+    uploads = UploadScheduler(loop, upload_slots, up)
+    # The loop only keeps weak references to tasks
+    tasks = set()
+
+    def start(coro):
+        task = loop.create_task(coro)
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    peers = PeerTable(ip, port, name)
+
+    def exchange_requested(file_id, peer_addr, ranges, codecs, fec):
+        # A peer asking us for a file is alive
+        peer_ip, _, peer_port = peer_addr.partition(":")
+        if peer_port.isdigit():
+            peers.touch(peer_ip, int(peer_port))
+        start(serve_exchange(file_id, peer_addr, ranges, codecs, fec, receiver, scheduler, uploads))
+
+    receiver.on_exchange_request = exchange_requested
+    receiver.on_peer_exchange = peers.handle
+    await wire.open_endpoint(loop, lambda: receiver, sock=soc)
+    print("[System] Receiver endpoint launched.")
 
 
     print('--- P2P File Sharing System ---')
     print(f'Hello, {name} (listening on port {port})')
 
-    peers = peer_discovery(port, name)
+    if dht:
+        directory = DHTNode(lambda text, addr: receiver.soc.sendto(wire.encode_control(text), addr),
+                            (ip, port), name)
+        receiver.on_dht = directory.handle
+        # DHT nodes carry no names, the peers we join through tell us theirs and their peers'
+        for addr in bootstrap or []:
+            send_control(receiver.soc, addr, peers.gossip(True))
+        await directory.bootstrap(bootstrap or [])
+        start(directory.maintain())
+        start(keep_published(directory, receiver))
+    else:
+        directory = TrackerCluster(trackers or [('127.0.0.1', TRACKER_PORT)])
+        await loop.run_in_executor(None, peer_discovery, directory, peers)
+        start(keep_registered(directory, receiver))
+    start(keep_gossiping(receiver, peers, directory))
+    start(refresh_shares(directory, receiver))
+    for file_id in receiver.resume_downloads():
+        start(swarm_download(peers, file_id, receiver, address, directory))
 
     while True:
         print('\nCurrent Peers:')
-        for peer in peers.keys():
+        for peer in sorted(peers):
             print(f" - {peer}")
         print_menu()
 
-        # User input
-        ans = input('\nChoose: ').strip().split(' ')
+        # User input, read off the loop so transfers keep running meanwhile
+        ans = (await loop.run_in_executor(None, input, '\nChoose: ')).strip().split(' ')
         if not ans:
             continue
 
@@ -268,22 +949,107 @@ def p2p_command_line(name, port):
         if command == 'i' and len(ans) == 2:
             peer = ans[1]
             if peer in peers:
-                print_index(peers[peer], soc)
+                await loop.run_in_executor(None, print_index, peers[peer])
             else:
                 print("[Error] Unknown peer.")
         elif command == 'c' and len(ans) == 3:
             peer, file_id = ans[1], ans[2]
             exchange_data(peers, peer, file_id, receiver, address)
+        elif command == 'c' and len(ans) == 2:
+            file_id = ans[1]
+            start(swarm_download(peers, file_id, receiver, address, directory))
         elif command == 'r':
-            peers = peer_discovery(port, name)
+            # The peer list refreshes itself by gossip
+            start(refresh_shares(directory, receiver))
         elif command == 'q':
             print('Leaving system. Goodbye!')
-            receiver.set_timeout()
+            receiver.save_progress()
+            if not dht:
+                try:
+                    await loop.run_in_executor(None, directory.leave)
+                except OSError:
+                    pass
             _exit(1)
         else:
             print('[Error] Invalid command. Please try again.')
 
 
+def p2p_command_line(name, port, fsync_policy='complete', upload_slots=8, max_up=None, max_down=None,
+                     peer_max_up=None, peer_max_down=None, compress=False, fec=None, shares=None,
+                     index_path=DEFAULT_INDEX_PATH, dht=False, bootstrap=None, trackers=None):
+    """
+    Main interface for the P2P system.
+    Handles user input and executes commands.
+
+    :param fsync_policy: when downloads are synced to disk, see receiver_rdt.ChunkSink
+    :param upload_slots: most uploads served at once, see sender_rdt.UploadScheduler
+    :param max_up: total upload bytes per second, None for no limit
+    :param max_down: total download bytes per second, None for no limit
+    :param peer_max_up: upload bytes per second to each remote host, None for no limit
+    :param peer_max_down: download bytes per second from each remote host, None for no limit
+    :param compress: ask uploaders to compress chunks, see wire.CODECS
+    :param fec: optional (n, k) FEC parity to ask uploaders for, see wire.PARITY
+    :param shares: directories whose files are shared, None for ./shared
+    :param index_path: file the index of the shared files is kept in, see share_index.ShareIndex
+    :param dht: find peers and files over a DHT instead of the tracker, see dht.DHTNode
+    :param bootstrap: (ip, port) of peers already in the DHT to join it through
+    :param trackers: (host, port) of every tracker, None for one on this host, see tracker.TrackerCluster
+    """
+    asyncio.run(run_peer(name, port, fsync_policy, upload_slots, max_up, max_down, peer_max_up, peer_max_down,
+                         compress, fec, shares, index_path, dht, bootstrap, trackers))
+
+
+def parse_rate(text):
+    """
+    Parses a rate limit given on the command line
+
+    :param text: bytes per second, optionally suffixed with K, M or G, e.g. "500K"
+    :return: bytes per second
+    :rtype: int
+    """
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+    scale = units.get(text[-1:].upper(), 1)
+    try:
+        rate = int(float(text[:-1] if scale > 1 else text) * scale)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid rate: {text}")
+    if rate <= 0:
+        raise argparse.ArgumentTypeError(f"rate must be positive: {text}")
+    return rate
+
+
+
+def parse_fec(text):
+    """
+    Parses a FEC setting given on the command line
+
+    :param text: "N:K", K parity packets for every N data packets, e.g. "8:1"
+    :return: (n, k)
+    :rtype: tuple
+    """
+    try:
+        n, k = (int(x) for x in text.split(":"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"invalid FEC setting: {text}")
+    if not 1 <= k <= n <= 255:
+        raise argparse.ArgumentTypeError(f"FEC needs 1 <= K <= N <= 255: {text}")
+    return n, k
+
+
+def parse_address(text):
+    """
+    Parses a peer address given on the command line
+
+    :param text: "HOST:PORT", e.g. "192.168.1.20:10001"
+    :return: (ip, port)
+    :rtype: tuple
+    """
+    host, _, port = text.rpartition(":")
+    try:
+        return socket.gethostbyname(host), int(port)
+    except (OSError, ValueError):
+        raise argparse.ArgumentTypeError(f"invalid address: {text}")
+
 
 # -----------------------------
 # Entry point
@@ -297,13 +1063,44 @@ if __name__ == "__main__":
     """
     parser = argparse.ArgumentParser(description="P2P File Sharing App")
     parser.add_argument('--tracker', action='store_true', help='Run as tracker server')
-    parser.add_argument('--port', type=int, help='Port number to use (default: 10000)')
+    parser.add_argument('--port', type=int, help=f'Port number to use (default: 10000, {TRACKER_PORT} for a tracker)')
+    parser.add_argument('--state-file',
+                        help='Where a tracker saves its state for restarts (default: tracker_<port>.json)')
+    parser.add_argument('--tracker-addr', action='append', type=parse_address, metavar='HOST:PORT',
+                        help=f'Tracker to use, may be repeated to split the work between several '
+                             f'(default: 127.0.0.1:{TRACKER_PORT})')
     parser.add_argument('--name', type=str, help='Peer name (default: Tempest)')
+    parser.add_argument('--fsync', choices=['never', 'complete', 'always'], default='complete',
+                        help='When downloads are synced to disk (default: complete)')
+    parser.add_argument('--upload-slots', type=int, default=8,
+                        help='Most uploads served at once, the rest wait in line (default: 8)')
+    parser.add_argument('--max-up', type=parse_rate,
+                        help='Total upload rate in bytes per second, e.g. 2M (default: unlimited)')
+    parser.add_argument('--max-down', type=parse_rate,
+                        help='Total download rate in bytes per second, e.g. 2M (default: unlimited)')
+    parser.add_argument('--peer-max-up', type=parse_rate,
+                        help='Upload rate to each remote host (default: unlimited)')
+    parser.add_argument('--peer-max-down', type=parse_rate,
+                        help='Download rate from each remote host (default: unlimited)')
+    parser.add_argument('--compress', action='store_true',
+                        help='Ask uploaders to compress chunks that shrink, e.g. text and logs')
+    parser.add_argument('--fec', type=parse_fec, metavar='N:K',
+                        help='Ask uploaders for K parity packets every N packets to repair losses')
+    parser.add_argument('--share', action='append', metavar='DIR',
+                        help='Directory whose files are shared, may be repeated (default: shared)')
+    parser.add_argument('--index-file', default=DEFAULT_INDEX_PATH,
+                        help=f'Where the index of shared files is kept (default: {DEFAULT_INDEX_PATH})')
+    parser.add_argument('--dht', action='store_true',
+                        help='Find peers and files over a DHT of the peers instead of the tracker')
+    parser.add_argument('--bootstrap', action='append', type=parse_address, metavar='HOST:PORT',
+                        help='Peer already in the DHT to join it through, may be repeated')
     args = parser.parse_args()
 
     if args.tracker:
-        start_tracker()
+        start_tracker(port=args.port if args.port else TRACKER_PORT, state_path=args.state_file)
     else:
         port = args.port if args.port else int(input("Enter port number (e.g., 10001): "))
         name = args.name if args.name else input("Enter peer name: ")
-        p2p_command_line(name, port)
+        p2p_command_line(name, port, args.fsync, args.upload_slots, args.max_up, args.max_down,
+                         args.peer_max_up, args.peer_max_down, args.compress, args.fec, args.share,
+                         args.index_file, args.dht, args.bootstrap, args.tracker_addr)
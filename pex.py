@@ -0,0 +1,233 @@
+import collections.abc
+import random
+import threading
+import time
+
+# Seconds between gossip rounds
+GOSSIP_INTERVAL = 10.0
+# Peers gossiped with each round
+GOSSIP_FANOUT = 3
+# Most peers listed in one PEX message, keeps it well within one packet
+PEX_ENTRIES = 24
+# A peer nobody has heard from for this long is dropped
+PEER_TTL = 180
+# Most peers kept, the least recently heard from are dropped first
+MAX_PEERS = 512
+# With fewer peers than this the tracker is asked for more
+MIN_PEERS = 4
+# Seconds between asking the tracker for more peers
+TRACKER_RETRY = 120.0
+
+
+def encode_pex(entries, want_reply):
+    """
+    Forms a PEX message, the peers a peer knows of and how long ago each was
+    last heard from
+
+    :param entries: list of (ip, port, age in seconds, name)
+    :type entries: list
+    :param want_reply: ask the receiver to answer with its own peers
+    :type want_reply: bool
+    :return: the message, e.g. "PEX:q|127.0.0.1:10001:0:Alice|127.0.0.1:10002:35:Bob"
+    :rtype: String
+    """
+    listed = "|".join(f"{ip}:{port}:{int(age)}:{name}" for ip, port, age, name in entries)
+    return f"PEX:{'q' if want_reply else 'r'}|{listed}"
+
+def decode_pex(text):
+    """
+    Reads a PEX message formed by encode_pex, skipping malformed entries
+
+    :param text: the message
+    :type text: String
+    :return: (want_reply, list of (ip, port, age, name))
+    :rtype: tuple
+    """
+    kind, _, listed = text[len("PEX:"):].partition("|")
+    entries = []
+    for entry in listed.split("|") if listed else []:
+        try:
+            ip, port, age, name = entry.split(":", 3)
+            entries.append((ip, int(port), max(0, int(age)), name))
+        except ValueError:
+            continue
+    return kind == 'q', entries
+
+
+class PeerTable(collections.abc.Mapping):
+    """
+    PeerTable, the peers we know of, kept fresh by gossip with them rather
+    than by asking the tracker
+
+    Peers swap small random samples of their tables (PEX messages) over the
+    UDP socket every GOSSIP_INTERVAL, so new peers spread through the
+    network in a few rounds. Each entry carries how long ago its peer was
+    last heard from and a peer always lists itself as just heard, so the
+    freshest sighting spreads too, and a peer that has left ages out of
+    every table after PEER_TTL. Works as a read only mapping of
+    peer_name -> (ip, port) and is safe to read from other threads.
+
+    Attributes:
+        me: our own (ip, port, name)
+        entries: (ip, port) -> [name, time.monotonic() it was last heard from]
+        names: peer_name -> (ip, port)
+        last_tracker: time.monotonic() the tracker was last asked for peers
+        lock: guards entries and names
+    """
+
+    def __init__(self, ip, port, name):
+        """
+        Constructor for PeerTable
+
+        :param ip: our IPv4 address, as other peers reach us
+        :type ip: String
+        :param port: our UDP port
+        :type port: int
+        :param name: our peer name
+        :type name: String
+        """
+        self.me = (ip, port, name)
+        self.entries = {}
+        self.names = {}
+        self.last_tracker = 0.0
+        self.lock = threading.Lock()
+
+    def __getitem__(self, name):
+        return self.names[name]
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.names))
+
+    def __len__(self):
+        return len(self.names)
+
+    def items(self):
+        """
+        :return: snapshot of the table, list of (peer_name, (ip, port))
+        :rtype: list
+        """
+        with self.lock:
+            return list(self.names.items())
+
+    def learn(self, ip, port, name, age=0, now=None):
+        """
+        Records a sighting of a peer, keeping whichever of ours and this one
+        is more recent
+
+        :param ip: the peer's IPv4 address
+        :type ip: String
+        :param port: the peer's UDP port
+        :type port: int
+        :param name: the peer's name
+        :type name: String
+        :param age: seconds since the peer was heard from
+        :type age: int
+        :param now: current time.monotonic(), None to read the clock
+        :type now: float
+        """
+        if now is None:
+            now = time.monotonic()
+        key = (ip, port)
+        if key == self.me[:2] or age >= PEER_TTL:
+            return
+        heard = now - age
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                if len(self.entries) >= MAX_PEERS:
+                    stalest = min(self.entries, key=lambda k: self.entries[k][1])
+                    if self.entries[stalest][1] >= heard:
+                        return
+                    self.forget(stalest)
+                self.entries[key] = [name, heard]
+            else:
+                if entry[1] >= heard:
+                    return
+                if entry[0] != name:
+                    if self.names.get(entry[0]) == key:
+                        del self.names[entry[0]]
+                    entry[0] = name
+                entry[1] = heard
+            self.names[name] = key
+
+    def touch(self, ip, port):
+        """
+        Notes that a peer we may already know of was just heard from directly
+
+        :param ip: the peer's IPv4 address
+        :type ip: String
+        :param port: the peer's UDP port
+        :type port: int
+        """
+        with self.lock:
+            entry = self.entries.get((ip, port))
+            if entry is not None:
+                entry[1] = time.monotonic()
+
+    def forget(self, key):
+        """
+        Drops a peer. Must be called with lock held.
+
+        :param key: (ip, port) of the peer
+        :type key: tuple
+        """
+        name = self.entries.pop(key)[0]
+        if self.names.get(name) == key:
+            del self.names[name]
+
+    def expire(self, now=None):
+        """
+        Drops every peer not heard from for PEER_TTL
+
+        :param now: current time.monotonic(), None to read the clock
+        :type now: float
+        """
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            for key in [key for key, entry in self.entries.items() if now - entry[1] >= PEER_TTL]:
+                self.forget(key)
+
+    def gossip(self, want_reply, now=None):
+        """
+        Forms a PEX message of ourselves and a random sample of our peers
+
+        :param want_reply: ask the receiver to answer with its own peers
+        :type want_reply: bool
+        :param now: current time.monotonic(), None to read the clock
+        :type now: float
+        :return: the message
+        :rtype: String
+        """
+        if now is None:
+            now = time.monotonic()
+        with self.lock:
+            keys = random.sample(list(self.entries), min(PEX_ENTRIES - 1, len(self.entries)))
+            entries = [key + (now - self.entries[key][1], self.entries[key][0]) for key in keys]
+        return encode_pex([(self.me[0], self.me[1], 0, self.me[2])] + entries, want_reply)
+
+    def targets(self, count=GOSSIP_FANOUT):
+        """
+        :param count: most peers to pick
+        :type count: int
+        :return: up to 'count' random peer addresses to gossip with
+        :rtype: list
+        """
+        with self.lock:
+            return random.sample(list(self.entries), min(count, len(self.entries)))
+
+    def handle(self, text):
+        """
+        Merges a PEX message into the table
+
+        :param text: the message
+        :type text: String
+        :return: the PEX message to answer with, None if none was asked for
+        :rtype: String
+        """
+        want_reply, entries = decode_pex(text)
+        now = time.monotonic()
+        for ip, port, age, name in entries:
+            self.learn(ip, port, name, age, now)
+        return self.gossip(False, now) if want_reply else None
@@ -1,312 +1,1235 @@
-import threading
-import time
-import zlib
-from sender_rdt import make_packet as make_data_packet, convert_ack_payload
+import asyncio
+import os
 
+import wire
+from sender_rdt import (LoopScheduler, convert_meta_payload, make_meta_payload, describe_file,
+                        file_digest, ChunkRanges, MAX_WINDOW, PIECE_CHUNKS)
+from share_index import ShareIndex, index_line, make_index_pages
 
-def make_checksum(data):
-    """
-    Forms checksum from data using crc32 function from zlib library
+# Most out of order chunks a single ACK reports in its SACK bitmap
+MAX_SACK_BITS = 1024
 
-    :param data: sequence of Bytes to calculate checksum
-    :type data: Bytes
-    :return: checksum of data
-    :rtype: Bytes
-    """
-    return zlib.crc32(data).to_bytes(8,'big',signed=True)
 
-def make_receiver_payload(seq_num, msg):
+def piece_bitmap(completed, chunk_count):
     """
-    Forms packet payload by encoding sequence number and message of packet
-
-    :param seq_num: int to convert to bytes
-    :type seq_num: int
-    :param msg: characters to encode
-    :type msg: String
-    :return: payload, sequence of bytes containing seq_num and msg
-    :rtype: Bytes
+    Turns a chunk completion bitmap into a piece availability bitmap
+
+    :param completed: bitmap with bit i (most significant bit first) set for every chunk on disk
+    :type completed: Bytes
+    :param chunk_count: number of chunks in the file
+    :type chunk_count: int
+    :return: bitmap with bit p set for every piece whose PIECE_CHUNKS chunks are all on disk
+    :rtype: bytearray
     """
-    seq_bytes = seq_num.to_bytes(4, byteorder='big', signed=True)
-    msg_bytes = msg.encode()
-    payload = seq_bytes + msg_bytes
-    return payload
+    piece_count = (chunk_count + PIECE_CHUNKS - 1) // PIECE_CHUNKS
+    pieces = bytearray((piece_count + 7) // 8)
+    for p in range(piece_count):
+        # PIECE_CHUNKS is a multiple of 8, so whole pieces start on a byte boundary
+        first = p * PIECE_CHUNKS // 8
+        last = min(p * PIECE_CHUNKS + PIECE_CHUNKS, chunk_count)
+        full, rest = divmod(last - p * PIECE_CHUNKS, 8)
+        have = completed[first:first + full].count(0xFF) == full
+        if have and rest:
+            have = len(completed) > first + full and \
+                   completed[first + full] & (0xFF << (8 - rest)) & 0xFF == (0xFF << (8 - rest)) & 0xFF
+        if have:
+            pieces[p >> 3] |= 0x80 >> (p & 7)
+    return pieces
 
-def convert_sender_payload(data):
+def make_ack_packet(handle, cum_ack, sack, rwnd=MAX_WINDOW):
     """
-    Decodes packet payload to retrieve sequence number and message of packet
-
-    :param data: sequence of Bytes to decode
-    :type data: Bytes
-    :return: send_seq, sequence number of packet
-    :rtype: Bytes
-    :return: msg, data from packet
-    :rtype: String
+    Forms an acknowledgement packet carrying a cumulative ACK point, the
+    receive window granted beyond it and a selective ACK bitmap of chunks
+    received beyond it
+
+    :param handle: handle of the stream acknowledged, 0 if it has none
+    :type handle: int
+    :param cum_ack: every sequence number up to and including this one was received
+    :type cum_ack: int
+    :param sack: bitmap where bit i (most significant bit first) covers cum_ack + 2 + i
+    :type sack: Bytes
+    :param rwnd: the sender may send sequence numbers up to cum_ack + rwnd
+    :type rwnd: int
+    :return: checksummed ACK packet
+    :rtype: bytearray
     """
-    id_length = int.from_bytes(data[:4], byteorder='big')
-    file_id = data[4:4+id_length].decode()
-    send_seq = int.from_bytes(data[4+id_length:8+id_length], byteorder='big', signed=True)
-    msg = data[8+id_length:].decode()
-    return file_id, send_seq, msg
+    return wire.encode_ack(handle, cum_ack, sack, rwnd)
 
-def verify_integrity(sent_chksum, data):
+class ChunkSink:
     """
-    Verifies checksum from received packet
-
-    :param sent_chksum: received checksum with length of 8 bytes
-    :type sent_chksum: Bytes
-    :param data: sequence of bytes to calculate checksum with
-    :type data: Bytes
-    :return: if sent_chksum is the exact same as calculated checksum
-    :rtype: Boolean
+    ChunkSink, writes each verified chunk straight to its offset in a
+    temporary file and renames it into place once the transfer completes
+
+    The temporary file is sparse: unwritten ranges take no disk space, and
+    when the final size is known up front it is preallocated with ftruncate.
+
+    Given the transfer metadata, the sink also keeps a progress journal next
+    to the temporary file so a download can be resumed after the peer quits
+    or crashes. The journal is the metadata line followed by the raw
+    completion bitmap. Every journal_every chunks the data written so far is
+    synced according to the fsync policy and only the bitmap bytes that
+    changed are written back, so the journal never claims a chunk that is
+    not in the temporary file. A crash loses at most journal_every chunks.
+
+    Attributes:
+        path: final name of the file
+        tmp_path: name of the file while chunks are still arriving
+        journal_path: name of the progress journal, None when not journaling
+        chunk_size: number of bytes in every chunk except possibly the last
+        completed: bitmap with bit i (most significant bit first) set once chunk i is on disk
+        count: number of chunks written so far
+        end: byte offset just past the furthest chunk written
+        fsync_policy: 'never', 'complete' to fsync before the rename,
+                      or 'always' to fsync after every chunk
     """
-    chksum = make_checksum(data)
-    return sent_chksum == chksum
+    # Chunks written between journal updates
+    journal_every = PIECE_CHUNKS
+
+    def __init__(self, path, chunk_size, fsync_policy='complete', size=None, header=None, resume=False):
+        """
+        :param path: final name of the file
+        :param chunk_size: number of bytes in every chunk except possibly the last
+        :param fsync_policy: 'never', 'complete' or 'always'
+        :param size: final size of the file if known, used to preallocate it
+        :param header: metadata line to journal progress under, None for no journal
+        :param resume: reopen an existing temporary file and journal instead of starting over
+        """
+        self.path = path
+        self.tmp_path = path + '.part'
+        self.journal_path = path + '.journal' if header is not None else None
+        self.chunk_size = chunk_size
+        self.fsync_policy = fsync_policy
+        self.fd = os.open(self.tmp_path, os.O_RDWR | os.O_CREAT | (0 if resume else os.O_TRUNC), 0o644)
+        self.completed = bytearray()
+        self.count = 0
+        self.end = 0
+        self.journal_fd = None
+        self.journal_offset = 0
+        self.unsaved = 0
+        self.dirty = None
+        if size:
+            os.ftruncate(self.fd, size)
+            self.completed = bytearray((size + chunk_size - 1) // chunk_size // 8 + 1)
+        if self.journal_path is None:
+            return
+
+        head = header.encode() + b'\n'
+        self.journal_offset = len(head)
+        if resume:
+            self.journal_fd = os.open(self.journal_path, os.O_RDWR)
+            saved = os.pread(self.journal_fd, len(self.completed), self.journal_offset)
+            self.completed[:len(saved)] = saved
+            self.count = bin(int.from_bytes(self.completed, 'big')).count('1')
+            self.end = size or 0
+        else:
+            self.journal_fd = os.open(self.journal_path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+            os.write(self.journal_fd, head + bytes(self.completed))
+
+    @classmethod
+    def resume(cls, journal_path, fsync_policy='complete'):
+        """
+        Reopens a download left behind by a previous run from its journal
+
+        :param journal_path: name of the journal, <final name>.journal
+        :type journal_path: String
+        :param fsync_policy: 'never', 'complete' or 'always'
+        :type fsync_policy: String
+        :return: (sink, metadata), or None if the journal or its temporary file is unusable
+        :rtype: tuple
+        """
+        path = journal_path[:-len('.journal')]
+        try:
+            with open(journal_path, 'rb') as journal:
+                header = journal.readline().rstrip(b'\n').decode()
+            meta = convert_meta_payload(header)
+            meta.pop('ranges')
+            if os.path.getsize(path + '.part') != meta['size']:
+                raise ValueError("temporary file has the wrong size")
+        except (OSError, ValueError) as e:
+            print(f"[Receiver] Cannot resume {path}: {e}")
+            return None
+        sink = cls(path, meta['chunk_size'], fsync_policy, meta['size'], header, resume=True)
+        return sink, meta
+
+    def has(self, index):
+        """
+        :param index: zero based index of the chunk
+        :type index: int
+        :return: True once the chunk is written
+        :rtype: Boolean
+        """
+        byte = index >> 3
+        return byte < len(self.completed) and bool(self.completed[byte] & (0x80 >> (index & 7)))
+
+    def write(self, index, data):
+        """
+        Writes a chunk at its offset and marks it complete
+
+        :param index: zero based index of the chunk
+        :type index: int
+        :param data: the chunk contents
+        :type data: Bytes
+        """
+        offset = index * self.chunk_size
+        os.pwrite(self.fd, data, offset)
+        if self.fsync_policy == 'always':
+            os.fsync(self.fd)
+        byte = index >> 3
+        if byte >= len(self.completed):
+            self.completed.extend(bytes(byte + 1 - len(self.completed)))
+        if not self.completed[byte] & (0x80 >> (index & 7)):
+            self.completed[byte] |= 0x80 >> (index & 7)
+            self.count += 1
+            if self.journal_fd is not None:
+                lo, hi = self.dirty if self.dirty else (byte, byte)
+                self.dirty = (min(lo, byte), max(hi, byte))
+                self.unsaved += 1
+                if self.unsaved >= self.journal_every:
+                    self.save()
+        self.end = max(self.end, offset + len(data))
+
+    def save(self):
+        """
+        Records the chunks written since the last save in the journal, after
+        syncing them to disk unless the fsync policy is 'never'
+        """
+        if self.journal_fd is None or self.dirty is None:
+            return
+        if self.fsync_policy != 'never':
+            os.fsync(self.fd)
+        lo, hi = self.dirty
+        os.pwrite(self.journal_fd, bytes(self.completed[lo:hi + 1]), self.journal_offset + lo)
+        self.dirty = None
+        self.unsaved = 0
+
+    def close_journal(self):
+        """
+        Closes and deletes the journal, the download no longer needs resuming
+        """
+        if self.journal_fd is not None:
+            os.close(self.journal_fd)
+            os.remove(self.journal_path)
+            self.journal_fd = None
+
+    def commit(self):
+        """
+        Trims the file to the data written, syncs it according to the fsync
+        policy and atomically renames it to its final name
+        """
+        os.ftruncate(self.fd, self.end)
+        if self.fsync_policy != 'never':
+            os.fsync(self.fd)
+        os.close(self.fd)
+        os.replace(self.tmp_path, self.path)
+        self.close_journal()
+
+    def abort(self):
+        """
+        Closes and deletes the temporary file and journal
+        """
+        os.close(self.fd)
+        os.remove(self.tmp_path)
+        self.close_journal()
 
-def make_packet(seq_num, msg):
+class ReorderBuffer:
     """
-    Forms packet by combining calculated checksum and formed payload
-
-    :param seq_num: int to convert to bytes
-    :type seq_num: int
-    :param msg: characters to encode
-    :type msg: String
-    :return: payload, sequence of bytes containing seq_num and msg
-    :return type: Bytes
+    ReorderBuffer, a fixed size ring of slots anchored at the cumulative ACK point
+
+    Sequence number seq lives in slot seq % capacity while
+    cum_ack < seq <= cum_ack + capacity, so marking a chunk is constant time
+    whatever order chunks arrive in. Chunk data itself goes straight to disk,
+    the ring only remembers which chunks beyond cum_ack have arrived. As soon
+    as the chunk after cum_ack is present, advance moves past the run.
+
+    Attributes:
+        capacity: number of slots, the most chunks buffered out of order
+        received: bytearray holding 1 for every occupied slot
+        cum_ack: every sequence number up to and including this one was received
+        max_seq: highest sequence number placed so far
     """
-    payload = make_receiver_payload(seq_num, msg)
-    chksum = make_checksum(payload)
-    return chksum + payload
+    def __init__(self, capacity=MAX_WINDOW, cum_ack=0):
+        self.capacity = capacity
+        self.received = bytearray(capacity)
+        self.cum_ack = cum_ack
+        self.max_seq = cum_ack
 
-class Receiver:
+    def accepts(self, seq_num):
+        """
+        Checks that seq_num is new and falls inside the window
+
+        :param seq_num: sequence number of the chunk
+        :type seq_num: int
+        :rtype: Boolean
+        """
+        if seq_num <= self.cum_ack or seq_num > self.cum_ack + self.capacity:
+            return False
+        return not self.received[seq_num % self.capacity]
+
+    def place(self, seq_num):
+        """
+        Marks a chunk as received
+
+        :param seq_num: sequence number of the chunk
+        :type seq_num: int
+        :return: True if the chunk was new and fits inside the window
+        :rtype: Boolean
+        """
+        if not self.accepts(seq_num):
+            return False
+        self.received[seq_num % self.capacity] = 1
+        self.max_seq = max(self.max_seq, seq_num)
+        return True
+
+    def advance(self):
+        """
+        Advances cum_ack over the run of chunks directly after it, freeing their slots
+
+        :return: the new cum_ack
+        :rtype: int
+        """
+        while True:
+            slot = (self.cum_ack + 1) % self.capacity
+            if not self.received[slot]:
+                return self.cum_ack
+            self.received[slot] = 0
+            self.cum_ack += 1
+
+    def sack(self, max_bits):
+        """
+        Builds the SACK bitmap of chunks buffered beyond cum_ack + 1
+
+        :param max_bits: most chunks to report
+        :type max_bits: int
+        :return: bitmap where bit i (most significant bit first) covers cum_ack + 2 + i
+        :rtype: bytearray
+        """
+        span = max(0, min(self.max_seq - self.cum_ack - 1, max_bits))
+        bitmap = bytearray((span + 7) // 8)
+        base = self.cum_ack + 2
+        for i in range(span):
+            if self.received[(base + i) % self.capacity]:
+                bitmap[i >> 3] |= 0x80 >> (i & 7)
+        return bitmap
+
+class Receiver(asyncio.DatagramProtocol):
     """
-    Receiver class that can handle multiple files simultaneously.
+    Receiver class that can handle multiple files simultaneously, each from
+    one or several senders at once.
 
-    For each inbound file, we store its 'base_seq', 'max_seq', and 'packets'
-    inside self.active_files[file_id], for example:
+    Every sender opens its stream with a META packet naming the file and
+    carrying its size, chunk size, chunk count, sha256 digest and the
+    ranges of chunks that stream will send. The ACK to it hands the sender a
+    numeric handle, an index into self.handles, and the stream's data
+    packets carry only that handle instead of the file id. The first stream of a file
+    creates a preallocated ChunkSink that all its streams share, and every
+    stream keeps its own ReorderBuffer for acknowledgements, inside
+    self.active_files[file_id], for example:
 
         self.active_files[file_id] = {
-            'base_seq': -1,
-            'max_seq':  -1,
-            'packets':  []
+            'sink':    ChunkSink('001_torrent.txt', 1400, size=5000),
+            'meta':    {'size': 5000, 'chunk_size': 1400, 'chunk_count': 4, 'digest': '...'},
+            'streams': {
+                ('127.0.0.1', 10001): {
+                    'buffer':       ReorderBuffer(),
+                    'ranges':       ChunkRanges([(0, 3)]),
+                    'pending':      0,
+                    'ack_timer':    None,
+                    'edge':         4,
+                    'window_timer': None,
+                    'file_id':      file_id,
+                    'address':      ('127.0.0.1', 10001),
+                    'handle':       1,
+                    'decompress':   None,
+                    'recovered':    0
+                }
+            }
         }
 
-    When a new chunk arrives for 'file_id', we place it at index [seq - base_seq].
-    Once we see seq == -1, we know the sender is done sending that file, and we
-    call finalize_file(file_id) to write out the chunks and remove the entry.
+    Packet seq of a stream carries chunk ranges.chunk(seq - 1). When it
+    arrives it is written to its offset in the sink's temporary file right
+    away, unless another stream already delivered it, and marked in the
+    stream's ring. Chunks beyond the ring's window are dropped
+    unacknowledged and resent by the sender later. As soon as the last
+    missing chunk of the file lands we call finalize_file(file_id), which
+    checks the digest in one pass off the event loop, renames the file into
+    place and removes the entry. A stream's FIN (seq == -1) just closes that stream.
 
-    Attributes:
-        packets: Array of received decoded data
+    Every sink journals its progress, so after a restart resume_downloads
+    puts unfinished files back in self.active_files and only their missing
+    chunks have to be requested again.
+
+    The Receiver is the protocol of the peer's main asyncio datagram
+    endpoint: every datagram is dispatched as it arrives, file data and
+    control messages are handled on the spot, and EXCH_REQ requests are
+    passed to on_exchange_request to start an upload.
+
+    ACKs are coalesced: in order chunks are acknowledged once every ack_every
+    packets or ack_delay seconds, whichever comes first, while out of order or
+    duplicate chunks are acknowledged straight away so the sender learns
+    about gaps quickly. Each ACK carries the stream's cumulative ACK point
+    plus a SACK bitmap of the chunks buffered beyond it.
 
-        soc: socket that receiver uses to bind and receive data over
-        ip: ip address to receive data from
-        port: port number to receive data from
-        base_seq: the lowest sequence number to index by
-        max_seq: the highest sequence number known to the receiver
+    Each ACK also grants the sender a window: it may send sequence numbers
+    up to the stream's edge. Without a download limiter the edge is as far
+    as the ring reaches. With one, the edge only moves as far as the
+    global and the sender host's token buckets allow, and when they run dry
+    a window update is scheduled for when tokens are back, so downloads
+    hold their rate however many streams are running.
+
+    Attributes:
+        soc: datagram transport that receiver receives data and sends ACKs over
+        on_exchange_request: called with (file_id, "ip:port", ranges, codecs, fec) for every EXCH_REQ
+        on_peer_exchange: called with every PEX message, returns the PEX message to answer with or None
+        on_dht: called with (text, address) for every DHT message, returns the DHT message to answer with or None
+        codecs: names of the wire codecs asked for in our EXCH_REQs, most preferred first
+        fec: optional (n, k) FEC parity asked for in our EXCH_REQs, see wire.PARITY
+        recovered: number of chunks rebuilt from parity instead of retransmitted
+        peer_files: local files served to other peers (file_id -> path), a ShareIndex or dictionary
+        active_files: inbound file_id -> transfer state shown above
+        handles: stream handle -> stream, the entry of the stream in
+                 active_files, or of a closed stream until its handle is reused
+        finished: file_id -> {sender address: stream length} of recently
+                  completed transfers, so late retransmissions can still be acknowledged
+        piece_maps: file_id -> {peer address: {'digest', 'pieces'}}, the piece
+                    bitmaps other peers advertised with BITFIELD and HAVE
+        swarms: file_id -> piece count of every file a swarm download is
+                running for, advertisements of other files are ignored
+        window: most slots in each stream's ReorderBuffer
+        fsync_policy: when ChunkSink syncs downloads to disk
+        limiter: optional RateLimiter for download bandwidth
     """
-    packets = []
-    base_seq = -1
-    max_seq = -1
+    # Coalescing policy for in order data
+    ack_every = 8
+    ack_delay = 0.01
+    window = MAX_WINDOW
+    # How many completed transfers to remember in finished
+    finished_limit = 256
+    # How many shared files hashed off the loop to remember in described
+    described_limit = 256
 
 
     timeout = None
 
-    def __init__(self, soc, peer_files=None):
+    def __init__(self, soc, peer_files=None, scheduler=None, fsync_policy='complete', limiter=None,
+                 codecs=None, fec=None):
         """
-        :param soc: the UDP socket that this receiver will use for inbound data
-        :param peer_files: an optional dictionary of local files (file_id -> path)
+        :param soc: transport for inbound data, None until the endpoint calls connection_made
+        :param peer_files: an optional ShareIndex or dictionary of local files (file_id -> path)
+        :param scheduler: LoopScheduler used to flush delayed ACKs, None for one on the running loop
+        :param fsync_policy: 'never', 'complete' or 'always', see ChunkSink
+        :param limiter: RateLimiter that chunk data must fit in, None for no limit
+        :param codecs: names of the wire codecs senders may compress chunks with
+        :param fec: optional (n, k), ask senders for k parity packets every n data packets
         """
         self.soc = soc
-        self.peer_files = peer_files if peer_files else {}
+        self.peer_files = peer_files if peer_files is not None else {}
+        self.fsync_policy = fsync_policy
+        self.limiter = limiter
+        self.codecs = codecs if codecs else []
+        self.fec = fec
 
-        # Multi-file storage: file_id -> { base_seq, max_seq, packets[] }
+        # Multi-file storage: file_id -> { sink, meta, streams }
         self.active_files = {}
+        self.finished = {}
+        self.piece_maps = {}
+        self.swarms = {}
+        # Stream handle -> stream, slot 0 stays empty
+        self.handles = [None] * (wire.MAX_HANDLE + 1)
+        self.next_handle = 1
+        self.recovered = 0
+        # Downloads being hashed before they are committed
+        self.verifications = set()
+        # Metadata of shared files hashed off the loop: (path, size, mtime_ns) -> meta
+        self.described = {}
+        self.describing = set()
+        self.scheduler = scheduler if scheduler else LoopScheduler(asyncio.get_running_loop())
 
         self.timeout = None
+        self.on_exchange_request = None
+        self.on_peer_exchange = None
+        self.on_dht = None
+
+    def connection_made(self, transport):
+        """
+        Called by asyncio once the peer's datagram endpoint is ready
+        """
+        self.soc = transport
+
+    def datagram_received(self, data, address):
+        """
+        Called by asyncio for every datagram, starts an upload for EXCH_REQ
+        """
+        request = self.handle_packet(data, address)
+        if request and self.on_exchange_request:
+            self.on_exchange_request(*request)
+
+    def error_received(self, exc):
+        """
+        Called by asyncio when a send fails, e.g. an ACK to a sender that already left
+        """
+        print("[Receiver] Socket error:", exc)
 
-    # Rebase and add packet functions will change base_seq and max_seq
-    def add_packet(self, file_id, seq_num, data_str, expand_pkts):
+    def send_ack(self, file_id, address):
         """
-        Given file_id, seq_num, data_str, place the data into the correct spot
-        in 'info["packets"]'. If expand_pkts is True, we enlarge 'info["packets"]'
-        up to seq_num.
+        Sends the cumulative ACK point and SACK bitmap of one stream to its
+        sender and clears any pending delayed ACK
 
         :param file_id: the identifier of the inbound file
         :type file_id: String
-        :param seq_num: sequence number of this chunk
-        :type seq_num: int
-        :param data_str: the chunk contents
-        :type data_str: String
-        :param expand_pkts: True if seq_num >= info['max_seq'], meaning we may need
-                            to extend the packets array
-        :type expand_pkts: bool
+        :param address: (ip, port) of the stream's sender
+        :type address: tuple
+        """
+        info = self.active_files.get(file_id)
+        stream = info['streams'].get(address) if info else None
+        if stream is None:
+            return
+        if stream['ack_timer'] is not None:
+            self.scheduler.cancel(stream['ack_timer'])
+            stream['ack_timer'] = None
+        stream['pending'] = 0
+
+        buffer = stream['buffer']
+        self.grant_window(info, stream, file_id, address)
+        sack = buffer.sack(MAX_SACK_BITS)
+        self.soc.sendto(make_ack_packet(stream['handle'], buffer.cum_ack, sack,
+                                        stream['edge'] - buffer.cum_ack), address)
+
+    def grant_window(self, info, stream, file_id, address):
+        """
+        Moves a stream's window edge as far as the ring and the download
+        limits allow. If the limits hold it back, arms a window update for
+        when the tokens for a few more chunks are back.
+
+        :param info: the file's entry in self.active_files
+        :type info: dict
+        :param stream: the stream's entry in info['streams']
+        :type stream: dict
+        :param file_id: the identifier of the inbound file
+        :type file_id: String
+        :param address: (ip, port) of the stream's sender
+        :type address: tuple
         """
+        buffer = stream['buffer']
+        limit = min(buffer.cum_ack + buffer.capacity, len(stream['ranges']))
+        if self.limiter is None:
+            stream['edge'] = max(stream['edge'], limit)
+            return
+        if stream['edge'] >= limit:
+            return
+        chunk = info['meta']['chunk_size']
+        credit = min(limit - stream['edge'], int(self.limiter.allowance(address[0]) // chunk))
+        if credit > 0:
+            self.limiter.spend(address[0], credit * chunk)
+            stream['edge'] += credit
+        if stream['edge'] < limit and stream['window_timer'] is None:
+            wait = self.limiter.delay(address[0], min(limit - stream['edge'], self.ack_every) * chunk)
+            stream['window_timer'] = self.scheduler.schedule(wait, self.window_update, file_id, address)
+
+    def window_update(self, file_id, address):
+        """
+        Window update deadline, sends an ACK granting the window tokens now allow
+
+        :param file_id: the identifier of the inbound file
+        :type file_id: String
+        :param address: (ip, port) of the stream's sender
+        :type address: tuple
+        """
+        info = self.active_files.get(file_id)
+        stream = info['streams'].get(address) if info else None
+        if stream is not None:
+            stream['window_timer'] = None
+            self.send_ack(file_id, address)
+
+    def flush_ack(self, file_id, address):
+        """
+        Delayed ACK deadline, sends the ACK if packets are still waiting for one
+
+        :param file_id: the identifier of the inbound file
+        :type file_id: String
+        :param address: (ip, port) of the stream's sender
+        :type address: tuple
+        """
+        info = self.active_files.get(file_id)
+        stream = info['streams'].get(address) if info else None
+        if stream is not None:
+            stream['ack_timer'] = None
+            if stream['pending']:
+                self.send_ack(file_id, address)
+
+    def open_stream(self, file_id, msg, address, codec_id=0):
+        """
+        Starts a stream from its transfer metadata and acknowledges it. The
+        first stream of a file also preallocates the file. A stream whose
+        digest differs from the file already being received, or compressed
+        with a codec we don't have, is refused.
+
+        :param file_id: the identifier of the inbound file
+        :type file_id: String
+        :param msg: metadata body from the sender
+        :type msg: Bytes
+        :param address: (ip, port) of the sender
+        :type address: tuple
+        :param codec_id: wire codec the sender may compress chunks with, 0 for none
+        :type codec_id: int
+        """
+        if codec_id and codec_id not in wire.CODECS:
+            print(f"[Receiver] Refusing stream from {address[0]}:{address[1]}, unknown codec {codec_id}.")
+            return
+        meta = convert_meta_payload(msg)
+        ranges = meta.pop('ranges')
+        if file_id in self.finished:
+            # Already complete, let the sender finish straight away
+            self.finished[file_id][address] = len(ranges)
+            self.soc.sendto(make_ack_packet(0, len(ranges), b''), address)
+            return
+
+        if file_id not in self.active_files:
+            self.active_files[file_id] = {
+                'sink': ChunkSink(f"{file_id}_torrent.txt", meta['chunk_size'], self.fsync_policy,
+                                  meta['size'], make_meta_payload(**meta)),
+                'meta': meta,
+                'streams': {}
+            }
+            print(f"[Receiver] Receiving {file_id}: {meta['size']} bytes in {meta['chunk_count']} chunks.")
         info = self.active_files[file_id]
+        if meta != info['meta']:
+            print(f"[Receiver] Refusing stream from {address[0]}:{address[1]}, its {file_id} is different content.")
+            return
+
+        # A resent META for a stream we already have only repeats the ACK
+        if address not in info['streams']:
+            stream = info['streams'][address] = {
+                'buffer': ReorderBuffer(max(1, min(self.window, len(ranges)))),
+                'ranges': ranges,
+                'pending': 0,
+                'ack_timer': None,
+                'edge': 0,
+                'window_timer': None,
+                'file_id': file_id,
+                'address': address,
+                'handle': 0,
+                'decompress': wire.CODECS[codec_id][2] if codec_id else None,
+                'recovered': 0
+            }
+            self.assign_handle(stream)
+        self.send_ack(file_id, address)
+        if info['sink'].count == meta['chunk_count']:
+            self.finalize_file(file_id)
 
-        if expand_pkts:
-            needed = seq_num - info['max_seq']
-            # If needed == 0, it means seq_num is exactly info['max_seq'],
-            # we still need to create one new slot for that chunk. So you may do:
-            # needed = (seq_num - info['max_seq']) + 1
-            # if you want the new chunk to expand properly. 
-            # But let's keep it as is if you have consistent indexing.
-            for _ in range(needed):
-                info['packets'].append(None)
-            info['max_seq'] = seq_num
+    def assign_handle(self, stream):
+        """
+        Gives a new stream the next free handle. Handles are handed out in
+        turn, so a closed stream keeps answering late packets until its
+        handle comes round again.
 
-        idx = seq_num - info['base_seq']
-        info['packets'][idx] = data_str
+        :param stream: the stream's entry in info['streams']
+        :type stream: dict
+        """
+        for _ in range(wire.MAX_HANDLE):
+            handle = self.next_handle
+            self.next_handle = handle % wire.MAX_HANDLE + 1
+            old = self.handles[handle]
+            if old is None or not self.stream_open(old):
+                self.handles[handle] = stream
+                stream['handle'] = handle
+                return
+        print("[Receiver] Out of stream handles.")
 
-    def rebase_packets(self, file_id, seq_num, data_str):
+    def stream_open(self, stream):
         """
-        Given file_id and a chunk's sequence number is smaller than base_seq,
-        rebase so that 'seq_num' becomes the new base_seq and put 'data_str'
-        at index 0.
+        :param stream: a stream from self.handles
+        :type stream: dict
+        :return: whether the stream is still receiving
+        :rtype: Boolean
+        """
+        info = self.active_files.get(stream['file_id'])
+        return info is not None and info['streams'].get(stream['address']) is stream
+
+    def close_stream(self, file_id, address):
+        """
+        Forgets a stream after its FIN, the file stays open for other streams
 
         :param file_id: the identifier of the inbound file
         :type file_id: String
-        :param seq_num: the inbound packet's sequence number
-        :type seq_num: int
-        :param data_str: the actual file data chunk
-        :type data_str: String
+        :param address: (ip, port) of the stream's sender
+        :type address: tuple
         """
         info = self.active_files[file_id]
-        old_base = info['base_seq']
-        shift_count = old_base - seq_num
+        stream = info['streams'].pop(address, None)
+        if stream:
+            self.cancel_stream_timers(stream)
+        info['sink'].save()
+
+    def resume_downloads(self, directory='.'):
+        """
+        Picks up the downloads a previous run left unfinished, from the
+        journals their ChunkSinks kept. Resumed files get no streams until
+        they are requested again, only their missing chunks need to be.
+
+        :param directory: where downloads are saved
+        :type directory: String
+        :return: file_ids of the resumed downloads
+        :rtype: list
+        """
+        suffix = '_torrent.txt.journal'
+        resumed = []
+        for name in sorted(os.listdir(directory)):
+            file_id = name[:-len(suffix)]
+            if not name.endswith(suffix) or file_id in self.active_files:
+                continue
+            opened = ChunkSink.resume(os.path.normpath(os.path.join(directory, name)), self.fsync_policy)
+            if opened is None:
+                continue
+            sink, meta = opened
+            self.active_files[file_id] = {'sink': sink, 'meta': meta, 'streams': {}}
+            if sink.count == meta['chunk_count']:
+                # Stopped between the last chunk and the rename
+                self.finalize_file(file_id)
+                continue
+            print(f"[Receiver] Resuming {file_id}: {sink.count} of {meta['chunk_count']} chunks already on disk.")
+            resumed.append(file_id)
+        return resumed
+
+    def save_progress(self):
+        """
+        Brings the journal of every download in progress up to date, called
+        before quitting so nothing received has to be fetched again
+        """
+        for info in self.active_files.values():
+            info['sink'].save()
+
+    def cancel_stream_timers(self, stream):
+        """
+        Cancels a stream's delayed ACK and window update deadlines
+
+        :param stream: the stream's entry in self.active_files[file_id]['streams']
+        :type stream: dict
+        """
+        for key in ('ack_timer', 'window_timer'):
+            if stream[key] is not None:
+                self.scheduler.cancel(stream[key])
+                stream[key] = None
+
+    def expect_file(self, file_id):
+        """
+        Called before requesting a file, so that a previous download with the
+        same file_id is not mistaken for this one
+
+        :param file_id: the identifier of the file about to be requested
+        :type file_id: String
+        """
+        self.finished.pop(file_id, None)
+
+    def completed_chunks(self, file_id):
+        """
+        Reports download progress of a file
+
+        :param file_id: the identifier of the inbound file
+        :type file_id: String
+        :return: None once the file is saved, otherwise a copy of the
+                 completion bitmap (empty before the first stream opens)
+        :rtype: bytearray
+        """
+        if file_id in self.finished:
+            return None
+        info = self.active_files.get(file_id)
+        return bytearray(info['sink'].completed) if info else bytearray()
+
+    def local_pieces(self, file_id):
+        """
+        Describes what this peer can serve of a file, whether shared or still
+        being downloaded
+
+        :param file_id: the identifier of the file
+        :type file_id: String
+        :return: (metadata, piece bitmap), or None if we have none of it or
+            a shared file is still being hashed
+        :rtype: tuple
+        """
+        path = self.peer_files.get(file_id)
+        if path and os.path.isfile(path):
+            meta = None
+            if isinstance(self.peer_files, ShareIndex):
+                meta = self.peer_files.describe(file_id)
+            if meta is None:
+                meta = self.describe_shared(path)
+                if meta is None:
+                    return None
+            piece_count = (meta['chunk_count'] + PIECE_CHUNKS - 1) // PIECE_CHUNKS
+            pieces = bytearray(b'\xff' * ((piece_count + 7) // 8))
+            if piece_count % 8:
+                pieces[-1] &= (0xFF << (8 - piece_count % 8)) & 0xFF
+            return meta, pieces
+        info = self.active_files.get(file_id)
+        if info is None:
+            return None
+        return dict(info['meta']), piece_bitmap(info['sink'].completed, info['meta']['chunk_count'])
+
+    def describe_shared(self, path):
+        """
+        Gives the metadata of a shared file the share index has no current
+        entry for. On the event loop the file is hashed in the default
+        executor instead, so a large file does not stall every transfer, and
+        None is given until it is done.
+
+        :param path: path of the file
+        :type path: String
+        :return: dictionary with size, chunk_size, chunk_count and digest, or None
+        :rtype: dict
+        """
+        st = os.stat(path)
+        key = (path, st.st_size, st.st_mtime_ns)
+        meta = self.described.get(key)
+        if meta is not None:
+            return dict(meta)
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return describe_file(path)
+        if key not in self.describing:
+            self.describing.add(key)
+
+            def described(future):
+                self.describing.discard(key)
+                if future.exception() is None:
+                    self.described[key] = future.result()
+                    if len(self.described) > self.described_limit:
+                        del self.described[next(iter(self.described))]
+
+            loop.run_in_executor(None, describe_file, path).add_done_callback(described)
+        return None
+
+    def index_pages(self, since):
+        """
+        Gives the INDEX pages of the files we share, see share_index.make_index_pages
+
+        :param since: etag of the listing the peer already holds, "-" for none
+        :type since: String
+        :return: the packets
+        :rtype: list
+        """
+        if isinstance(self.peer_files, ShareIndex):
+            return self.peer_files.index_pages(since)
+        lines = [index_line(file_id, os.path.getsize(path) if os.path.isfile(path) else 0, os.path.basename(path))
+                 for file_id, path in self.peer_files.items()]
+        return make_index_pages('-', '-', lines)
 
-        # Insert shift_count new 'None' at the front
-        for _ in range(shift_count):
-            info['packets'].insert(0, None)
+    def download_digests(self):
+        """
+        Gives the content digest of every file being downloaded, since its
+        finished pieces are served to other peers
+
+        :return: file_id -> hex sha256 of the complete file
+        :rtype: dict
+        """
+        return {file_id: info['meta']['digest'] for file_id, info in self.active_files.items()}
+
+    def partial_file(self, file_id):
+        """
+        Gives what is needed to serve the finished pieces of a file that is
+        still being downloaded
+
+        :param file_id: the identifier of the file
+        :type file_id: String
+        :return: (path of the partial file, metadata, copy of the chunk
+                 completion bitmap), or None if no download is in progress
+        :rtype: tuple
+        """
+        info = self.active_files.get(file_id)
+        if info is None:
+            return None
+        return info['sink'].tmp_path, dict(info['meta']), bytearray(info['sink'].completed)
+
+    def join_swarm(self, file_id, piece_count):
+        """
+        Starts collecting the piece bitmaps peers advertise for a file
+        being swarm downloaded
+
+        :param file_id: the identifier of the file
+        :type file_id: String
+        :param piece_count: number of pieces in the file
+        :type piece_count: int
+        """
+        self.swarms[file_id] = piece_count
+
+    def leave_swarm(self, file_id):
+        """
+        Stops collecting piece bitmaps for a file and forgets those collected
+
+        :param file_id: the identifier of the file
+        :type file_id: String
+        """
+        self.swarms.pop(file_id, None)
+        self.piece_maps.pop(file_id, None)
+
+    def update_pieces(self, file_id, address, digest, pieces=None, have=None):
+        """
+        Records piece availability a peer advertised. Only files being swarm
+        downloaded are tracked, and pieces past the end of the file are dropped.
+
+        :param file_id: the identifier of the file
+        :type file_id: String
+        :param address: (ip, port) the advertisement came from
+        :type address: tuple
+        :param digest: hex sha256 of the peer's content for file_id
+        :type digest: String
+        :param pieces: full piece bitmap from a BITFIELD message
+        :type pieces: bytearray
+        :param have: single piece number from a HAVE message
+        :type have: int
+        """
+        piece_count = self.swarms.get(file_id)
+        if piece_count is None or (have is not None and not 0 <= have < piece_count):
+            return
+        size = (piece_count + 7) >> 3
+        peers = self.piece_maps.setdefault(file_id, {})
+        entry = peers.get(address)
+        if entry is None or entry['digest'] != digest:
+            entry = peers[address] = {'digest': digest, 'pieces': bytearray(size)}
+        if pieces is not None:
+            entry['pieces'] = pieces[:size].ljust(size, b'\0')
+        if have is not None:
+            entry['pieces'][have >> 3] |= 0x80 >> (have & 7)
 
-        info['base_seq'] = seq_num
-        # Now index 0 matches this chunk
-        info['packets'][0] = data_str
-        
     def finalize_file(self, file_id):
         """
-        Writes out the collected packets for 'file_id' to <file_id>_torrent.txt,
-        then clears them from self.active_files.
+        Verifies the digest of the chunks written for 'file_id' and commits them
+        to <file_id>_torrent.txt, then clears them from self.active_files.
+        A file that fails verification is discarded. On the event loop the
+        file is hashed in the default executor, so a large file does not stall
+        every other transfer, and stays in self.active_files until it is done.
 
         :param file_id: the unique identifier for the file being transferred
         :type file_id: String
         """
-        if file_id not in self.active_files:
+        info = self.active_files.get(file_id)
+        if info is None:
             print(f"[Receiver] finalize_file called, but no record found for {file_id}.")
             return
+        if info.get('verifying'):
+            return
+        info['verifying'] = True
+        for stream in info['streams'].values():
+            self.cancel_stream_timers(stream)
 
-        info = self.active_files[file_id]
-        packets = info['packets']
-        outname = f"{file_id}_torrent.txt"
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            self.commit_file(file_id, info, file_digest(info['sink'].tmp_path))
+            return
+        task = loop.create_task(self.verify_file(file_id, info))
+        # The loop only keeps weak references to tasks
+        self.verifications.add(task)
+        task.add_done_callback(self.verifications.discard)
 
-        with open(outname, "w") as f:
-            for chunk in packets:
-                if chunk:
-                    f.write(chunk)
+    async def verify_file(self, file_id, info):
+        """
+        Hashes a finished download off the event loop, then commits or discards it
 
-        print(f"[Receiver] Saved file {outname} successfully.")
-        # Remove from active_files
-        del self.active_files[file_id]
+        :param file_id: the unique identifier for the file being transferred
+        :type file_id: String
+        :param info: the file's entry in self.active_files
+        :type info: dict
+        """
+        digest = await asyncio.get_running_loop().run_in_executor(None, file_digest, info['sink'].tmp_path)
+        self.commit_file(file_id, info, digest)
 
-    def set_timeout(self):
+    def commit_file(self, file_id, info, digest):
         """
-        Optional method to signal that this receiver should time out.
+        Renames a verified download into place, or discards it if its digest
+        does not match, and clears it from self.active_files.
+
+        :param file_id: the unique identifier for the file being transferred
+        :type file_id: String
+        :param info: the file's entry in self.active_files
+        :type info: dict
+        :param digest: hex sha256 of the chunks written
+        :type digest: String
+        """
+        if self.active_files.get(file_id) is info:
+            del self.active_files[file_id]
+        for stream in info['streams'].values():
+            self.cancel_stream_timers(stream)
+        sink = info['sink']
+
+        if digest != info['meta']['digest']:
+            print(f"[Receiver] {file_id} failed digest verification, discarding.")
+            sink.abort()
+            return
+
+        sink.commit()
+        recovered = sum(stream['recovered'] for stream in info['streams'].values())
+        print(f"[Receiver] Saved file {sink.path} successfully"
+              + (f", {recovered} chunks rebuilt from parity." if recovered else "."))
+        self.finished[file_id] = {address: len(stream['ranges']) for address, stream in info['streams'].items()}
+        if len(self.finished) > self.finished_limit:
+            del self.finished[next(iter(self.finished))]
+
+    def handle_data(self, handle, send_seq, msg, address, flags=0):
+        """
+        Stores one chunk of file data from a sender and acknowledges it
+        according to the coalescing policy
+
+        :param handle: stream handle the packet carries
+        :type handle: int
+        :param send_seq: sequence number of the chunk, -1 for FIN
+        :type send_seq: int
+        :param msg: the chunk contents, only valid during this call
+        :type msg: memoryview
+        :param address: (ip, port) of the sender
+        :type address: tuple
+        :param flags: flags of the packet, FLAG_COMPRESSED if msg needs decompressing
+        :type flags: int
+        """
+        stream = self.handles[handle]
+        if stream is None or stream['address'] != address:
+            if send_seq == -1:
+                self.soc.sendto(make_ack_packet(handle, -1, b''), address)
+            else:
+                print(f"[Receiver] Discarding data for unknown stream {handle}.")
+            return
+        file_id = stream['file_id']
+        info = self.active_files.get(file_id)
+        if info is None or info['streams'].get(address) is not stream:
+            # Late retransmissions or a repeated FIN for a stream already
+            # closed only need their ACK again
+            if send_seq == -1:
+                self.soc.sendto(make_ack_packet(handle, -1, b''), address)
+            elif address in self.finished.get(file_id, {}):
+                self.soc.sendto(make_ack_packet(handle, self.finished[file_id][address], b''), address)
+            return
+
+        # The sender only sends FIN once all of its chunks were acknowledged
+        if send_seq == -1:
+            self.soc.sendto(make_ack_packet(handle, -1, b''), address)
+            self.close_stream(file_id, address)
+            print(f"[Receiver] Stream from {address[0]}:{address[1]} finished for {file_id}, "
+                  f"{info['meta']['chunk_count'] - info['sink'].count} chunks still missing, "
+                  f"{stream['recovered']} rebuilt from parity.")
+            return
+
+        if flags & wire.FLAG_COMPRESSED:
+            try:
+                msg = stream['decompress'](msg, info['meta']['chunk_size'])
+            except ValueError as e:
+                print(f"[Receiver] Could not decompress chunk {send_seq} of {file_id}: {e}")
+                return
+            if len(msg) > info['meta']['chunk_size']:
+                return
+
+        self.accept_chunk(file_id, info, stream, send_seq, msg, address)
+
+    def accept_chunk(self, file_id, info, stream, send_seq, msg, address):
         """
-        self.soc.settimeout(1)
-        
+        Places a chunk of an open stream, writes it to the sink and
+        acknowledges it according to the coalescing policy.
+
+        :param file_id: the identifier of the inbound file
+        :type file_id: String
+        :param info: the file's entry in self.active_files
+        :type info: dict
+        :param stream: the stream's entry in info['streams']
+        :type stream: dict
+        :param send_seq: sequence number of the chunk
+        :type send_seq: int
+        :param msg: the uncompressed chunk contents
+        :type msg: Bytes
+        :param address: (ip, port) of the sender
+        :type address: tuple
+        :return: False if the chunk was a duplicate or beyond the window
+        :rtype: Boolean
+        """
+        buffer = stream['buffer']
+        old_cum = buffer.cum_ack
+        if not buffer.place(send_seq):
+            # Duplicate or beyond the window, tell the sender where we are now
+            self.send_ack(file_id, address)
+            return False
+        sink = info['sink']
+        index = stream['ranges'].chunk(send_seq - 1)
+        if not sink.has(index):
+            sink.write(index, msg)
+        buffer.advance()
+
+        if sink.count == info['meta']['chunk_count']:
+            # Last chunk landed, no need to wait for the FIN
+            for other in list(info['streams']):
+                self.send_ack(file_id, other)
+            self.finalize_file(file_id)
+            return True
+
+        stream['pending'] += 1
+        in_order = send_seq == old_cum + 1 == buffer.cum_ack
+        if not in_order or stream['pending'] >= self.ack_every:
+            self.send_ack(file_id, address)
+        elif stream['ack_timer'] is None:
+            stream['ack_timer'] = self.scheduler.schedule(self.ack_delay, self.flush_ack, file_id, address)
+        return True
+
+    def handle_parity(self, handle, first_seq, n, k, j, parity, address):
+        """
+        Rebuilds the one missing chunk a parity packet covers, if exactly one
+        is missing, from the parity and the covered chunks already on disk
+
+        :param handle: stream handle the packet carries
+        :type handle: int
+        :param first_seq: sequence number of the first packet of the FEC group
+        :type first_seq: int
+        :param n: number of packets in the group
+        :type n: int
+        :param k: number of parity packets for the group
+        :type k: int
+        :param j: the parity covers the group's positions j, j + k, ...
+        :type j: int
+        :param parity: XOR of the covered chunks, each padded to the chunk size
+        :type parity: memoryview
+        :param address: (ip, port) of the sender
+        :type address: tuple
+        """
+        stream = self.handles[handle]
+        if stream is None or stream['address'] != address or not self.stream_open(stream):
+            return
+        file_id = stream['file_id']
+        info = self.active_files[file_id]
+        if self.limiter is not None:
+            # Parity is not covered by the window, charge it as it arrives
+            self.limiter.spend(address[0], len(parity))
+        sink = info['sink']
+        meta = info['meta']
+        chunk_size = meta['chunk_size']
+        if len(parity) != chunk_size or k == 0:
+            return
+        value = int.from_bytes(parity, 'big')
+        missing = None
+        for seq in range(first_seq + j, min(first_seq + n, len(stream['ranges']) + 1), k):
+            index = stream['ranges'].chunk(seq - 1)
+            if sink.has(index):
+                chunk = os.pread(sink.fd, chunk_size, index * chunk_size)
+                value ^= int.from_bytes(chunk, 'big') << (8 * (chunk_size - len(chunk)))
+            elif missing is None:
+                missing = seq, index
+            else:
+                return  # Two lost, only a retransmission helps
+        if missing is None:
+            return
+        seq, index = missing
+        chunk = value.to_bytes(chunk_size, 'big')[:min(chunk_size, meta['size'] - index * chunk_size)]
+        if self.accept_chunk(file_id, info, stream, seq, chunk, address):
+            stream['recovered'] += 1
+            self.recovered += 1
+
     #
     # ------------------ MAIN LISTENER ------------------
     #
 
-    def listen_for_requests(self,exch_req_queue):
+    def handle_packet(self, data, address):
         """
-        Waits for request from other peers from self.soc, verifies data and verifies requests
-        Runs as long as the p2p_command is running
+        Verifies one datagram from another peer and handles it: file data and
+        control messages are dealt with here, exchange requests are returned
+
+        :param data: the datagram, only valid during this call
+        :type data: memoryview
+        :param address: (ip, port) it came from
+        :type address: tuple
+        :return: (file_id, "ip:port", ranges, codecs, fec) for an EXCH_REQ, otherwise None
+        :rtype: tuple
         """
-        while True:
-            try:
-                data, address = self.soc.recvfrom(4096)
-
-                # Separate checksum from payload
-                chksum = data[:8]
-                payload = data[8:]
-
-                if not verify_integrity(chksum, payload):
-                    print("Corrupted packet, discarding")
-                    continue
-
-                # See what kind of message this is
-                text_msg = payload.decode(errors='ignore')
-
-                if text_msg.startswith("EXCH_REQ"):
-                    # Example: "EXCH_REQ:001,127.0.0.1:9999"
-                    # We'll push it to the queue to let the 'sender logic' handle it
-                    # (i.e. we are the "server" side for that file).
-                    string = text_msg.split(":")[1]
-                    try:
-                        file_id, raw_ip = string.split(",", 1)
-                        ip, port = address  # actual sender's address from recvfrom()
-                        peer_addr = f"{ip}:{port}"
-                        print("[Receiver] Inserting EXCH_REQ with file id:", file_id, "and peer_addr:", peer_addr)
-                        exch_req_queue.put((file_id, peer_addr))
-                    except ValueError:
-                        print(f"[Error] Invalid EXCH_REQ format: {string}")
-
-                elif text_msg.startswith("INDEX_REQ"):
-                    # Peer is asking for our local file index
-                    print("[Receiver] Received INDEX_REQ")
-                    file_index = "|".join(f"{fid}:{fname}" for fid, fname in self.peer_files.items())
-                    resp_pkt = make_data_packet(0, file_index, "index")  # from sender_rdt
-                    self.soc.sendto(resp_pkt, address)
-                    print("[Receiver] Sent index response")
-
-                else:
-                    #
-                    # Otherwise, assume it's a chunk of file data from a sender.
-                    #
-                    file_id, send_seq, msg = convert_sender_payload(payload)
-                    # Send ACK immediately
-                    #print('sequence number ' + str(send_seq) + " : " + str(msg))
-                    ack_pkt = make_packet(send_seq, "ACK")
-                    self.soc.sendto(ack_pkt, address)
-
-                    # If we haven't started tracking this file yet, init an entry
-                    if file_id not in self.active_files:
-                        self.active_files[file_id] = {
-                            'base_seq': -1,
-                            'max_seq': -1,
-                            'packets': []
-                        }
-
-                    # Shortcut reference
-                    info = self.active_files[file_id]
-
-                    # If this is the "FIN" marker
-                    if send_seq == -1:
-                        print(f"[Receiver] Received final chunk (-1) for file {file_id} -- writing to disk.")
-                        self.finalize_file(file_id)
-                        continue
-
-                    #
-                    # If first chunk for this file, set up base_seq / max_seq
-                    #
-                    if info['base_seq'] == -1:
-                        info['base_seq'] = send_seq
-                        info['max_seq'] = send_seq
-                        info['packets'] = [None]  # index 0
-
-                    if send_seq < info['base_seq']:
-                        # We rebase
-                        self.rebase_packets(file_id, send_seq, msg)
-                    elif send_seq >= info['max_seq']:
-                        # Expand
-                        self.add_packet(file_id, send_seq, msg, True)
-                    else:
-                        # It's in the existing range, fill if not present
-                        idx = send_seq - info['base_seq']
-                        if info['packets'][idx] is None:
-                            self.add_packet(file_id, send_seq, msg, False)
-
-            except Exception as e:
-                print("[Receiver] Unexpected error:", e)
-                #continue
-                break
+        try:
+            header = wire.parse_packet(data)
+            if header is None:
+                print("Corrupted packet, discarding")
+                return None
+
+            if header[0] == wire.PACKET_DATA:
+                # A chunk of file data or FIN from a sender
+                handle, send_seq, msg = wire.decode_data(data)
+                self.handle_data(handle, send_seq, msg, address, header[1])
+                return None
+            if header[0] == wire.PACKET_PARITY:
+                self.handle_parity(*wire.decode_parity(data), address)
+                return None
+            if header[0] == wire.PACKET_META:
+                # A sender opening a stream
+                file_id, msg = wire.decode_meta(data)
+                self.open_stream(file_id, msg, address, header[1])
+                return None
+            if header[0] != wire.PACKET_CONTROL:
+                return None
+
+            # See what kind of message this is
+            text_msg = wire.decode_control(data)
+
+            if text_msg.startswith("EXCH_REQ"):
+                # Example: "EXCH_REQ:001,127.0.0.1:9999" for the whole file, or
+                # "EXCH_REQ:001,127.0.0.1:9999,0-255;512-767" for some chunk ranges, and
+                # "EXCH_REQ:001,127.0.0.1:9999,,zlib" to accept zlib compressed chunks, and
+                # "EXCH_REQ:001,127.0.0.1:9999,,,8:2" for 2 FEC parity packets every 8 packets
+                # The caller starts the 'sender logic' for it
+                # (i.e. we are the "server" side for that file).
+                string = text_msg.split(":", 1)[1]
+                try:
+                    parts = string.split(",")
+                    file_id = parts[0]
+                    ranges = ChunkRanges.parse(parts[2]) if len(parts) > 2 and parts[2] else None
+                    codecs = parts[3].split(";") if len(parts) > 3 and parts[3] else []
+                    fec = tuple(int(x) for x in parts[4].split(":")) if len(parts) > 4 and parts[4] else None
+                    ip, port = address  # actual sender's address from recvfrom()
+                    peer_addr = f"{ip}:{port}"
+                    print("[Receiver] Received EXCH_REQ with file id:", file_id, "and peer_addr:", peer_addr)
+                    return file_id, peer_addr, ranges, codecs, fec
+                except ValueError:
+                    print(f"[Error] Invalid EXCH_REQ format: {string}")
+
+            elif text_msg.startswith("META_REQ"):
+                # Peer wants to know what our copy of a file looks like
+                # Example: "META_REQ:001"
+                file_id = text_msg.split(":", 1)[1]
+                local = self.local_pieces(file_id)
+                if local:
+                    meta = local[0]
+                    body = make_meta_payload(meta['size'], meta['chunk_size'],
+                                             meta['chunk_count'], meta['digest'])
+                    self.soc.sendto(wire.encode_meta(file_id, body), address)
+
+            elif text_msg.startswith("PEX:"):
+                # Peer gossiping the peers it knows of, answered in kind if it asks
+                reply = self.on_peer_exchange(text_msg) if self.on_peer_exchange else None
+                if reply:
+                    self.soc.sendto(wire.encode_control(reply), address)
+
+            elif text_msg.startswith("DHT:"):
+                # Kademlia query or reply, see dht.DHTNode
+                reply = self.on_dht(text_msg, address) if self.on_dht else None
+                if reply:
+                    self.soc.sendto(wire.encode_control(reply), address)
+
+            elif text_msg.startswith("BITFIELD_REQ"):
+                # Peer wants to know which pieces of a file we can serve
+                # Example: "BITFIELD_REQ:001", answered with "BITFIELD:001,<digest>,<hex bitmap>"
+                file_id = text_msg.split(":", 1)[1]
+                local = self.local_pieces(file_id)
+                if local:
+                    reply = f"BITFIELD:{file_id},{local[0]['digest']},{local[1].hex()}"
+                    self.soc.sendto(wire.encode_control(reply), address)
+
+            elif text_msg.startswith("BITFIELD:"):
+                file_id, digest, pieces = text_msg.split(":", 1)[1].split(",")
+                self.update_pieces(file_id, address, digest, pieces=bytearray.fromhex(pieces))
+
+            elif text_msg.startswith("HAVE:"):
+                # Peer finished downloading a piece, example: "HAVE:001,<digest>,12"
+                file_id, digest, piece = text_msg.split(":", 1)[1].split(",")
+                self.update_pieces(file_id, address, digest, have=int(piece))
+
+            elif text_msg.startswith("INDEX_REQ"):
+                # Peer is asking for a page of our local file index, listing only
+                # the changes since the etag it holds, example: "INDEX_REQ:<etag>,0"
+                since, _, page = text_msg[len("INDEX_REQ:"):].partition(",")
+                pages = self.index_pages(since or '-')
+                page = int(page or 0)
+                if page < len(pages):
+                    self.soc.sendto(pages[page], address)
 
+        except Exception as e:
+            print("[Receiver] Unexpected error:", e)
+        return None
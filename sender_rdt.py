@@ -1,157 +1,1079 @@
+import asyncio
+import bisect
+import collections
+import functools
+import hashlib
+import mmap
 import os
-import socket
 import threading
 import time
-import zlib
 
+import wire
 
-def make_checksum(data):
+# Bytes of file data carried by each packet. Sized so a data packet plus its
+# headers still fits in a single 1500 byte Ethernet frame without fragmenting.
+DEFAULT_CHUNK_SIZE = 1400
+# Largest span of sequence numbers a sender may have outstanding, and so the
+# number of chunks a receiver must be able to buffer out of order
+MAX_WINDOW = 1024
+# Sequence number of the transfer metadata packet sent before any data
+META_SEQ = 0
+# Number of chunks per piece, the unit peers advertise availability in
+PIECE_CHUNKS = 256
+
+
+def sack_seqs(cum_ack, sack):
     """
-    Forms checksum from data using crc32 function from zlib library
+    Lists the sequence numbers marked as received in a SACK bitmap
 
-    :param data: sequence of Bytes to calculate checksum
-    :type data: Bytes
-    :return: checksum of data
-    :rtype: Bytes
+    :param cum_ack: cumulative ACK point the bitmap is relative to
+    :type cum_ack: int
+    :param sack: bitmap from wire.decode_ack
+    :type sack: Bytes
+    :return: generator of acknowledged sequence numbers
     """
-    return zlib.crc32(data).to_bytes(8,'big',signed=True)
+    for byte_idx, byte in enumerate(sack):
+        if not byte:
+            continue
+        for bit in range(8):
+            if byte & (0x80 >> bit):
+                yield cum_ack + 2 + byte_idx * 8 + bit
 
-def make_sender_payload(seq_num, msg, file_id):
+def make_meta_payload(size, chunk_size, chunk_count, digest, ranges=None):
     """
-    Forms packet payload by encoding sequence number and message of packet
+    Forms the body of the transfer metadata packet
 
-    :param seq_num: int to convert to bytes
-    :type seq_num: int
-    :param msg: characters to encode
-    :type msg: String
-    :return: payload, sequence of bytes containing seq_num and msg
-    :rtype: Bytes
+    :param size: total size of the file in bytes
+    :type size: int
+    :param chunk_size: number of bytes in every chunk except possibly the last
+    :type chunk_size: int
+    :param chunk_count: number of chunks the file is split into
+    :type chunk_count: int
+    :param digest: hex sha256 digest of the whole file
+    :type digest: String
+    :param ranges: the chunks this transfer will send, the whole file if None
+    :type ranges: ChunkRanges
+    :return: metadata as "size,chunk_size,chunk_count,digest,ranges"
+    :rtype: String
     """
+    if ranges is None:
+        ranges = ChunkRanges.whole(chunk_count)
+    return f"{size},{chunk_size},{chunk_count},{digest},{ranges}"
 
-    id_bytes = file_id.encode()
-    id_length = len(id_bytes).to_bytes(4, byteorder='big')
-    seq_bytes = seq_num.to_bytes(4, byteorder='big', signed=True)
-    msg_bytes = msg.encode()
-    payload = id_length + id_bytes + seq_bytes + msg_bytes
-    return payload
+def convert_meta_payload(msg):
+    """
+    Parses the body of a transfer metadata packet
 
-def convert_receiver_payload(data):
+    :param msg: body formed by make_meta_payload
+    :type msg: Bytes or String
+    :return: dictionary with size, chunk_size, chunk_count, digest and ranges
+    :rtype: dict
     """
-    Decodes packet payload to retrieve sequence number and message of packet
+    if not isinstance(msg, str):
+        msg = bytes(msg).decode()
+    size, chunk_size, chunk_count, digest, ranges = msg.split(",")
+    return {
+        'size': int(size),
+        'chunk_size': int(chunk_size),
+        'chunk_count': int(chunk_count),
+        'digest': digest,
+        'ranges': ChunkRanges.parse(ranges)
+    }
 
-    :param data: sequence of Bytes to decode
-    :type data: Bytes
-    :return: send_seq, sequence number of packet
-    :rtype: Bytes
-    :return: msg, data from packet
+def file_digest(path):
+    """
+    Computes the sha256 digest of a file in one buffered pass
+
+    :param path: path of the file to hash
+    :type path: String
+    :return: hex digest
     :rtype: String
     """
-    id_length = int.from_bytes(data[:4], byteorder='big', signed=True)
-    file_id = data[4:4+id_length].decode()
-    send_seq = int.from_bytes(data[4+id_length:8+id_length], byteorder='big', signed=True)
-    msg = data[8+id_length:].decode()
-    return send_seq, msg
+    digest = hashlib.sha256()
+    buf = bytearray(1 << 20)
+    view = memoryview(buf)
+    with open(path, 'rb', buffering=0) as f:
+        while True:
+            n = f.readinto(buf)
+            if not n:
+                break
+            digest.update(view[:n])
+    return digest.hexdigest()
+
+@functools.lru_cache(maxsize=256)
+def _describe(path, size, mtime_ns, chunk_size):
+    return {
+        'size': size,
+        'chunk_size': chunk_size,
+        'chunk_count': (size + chunk_size - 1) // chunk_size,
+        'digest': file_digest(path)
+    }
+
+def describe_file(path, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Gives the transfer metadata of a file. Results are cached on the file's
+    size and modification time, so an unchanged file is only hashed once.
+
+    :param path: path of the file
+    :type path: String
+    :param chunk_size: number of bytes per chunk
+    :type chunk_size: int
+    :return: dictionary with size, chunk_size, chunk_count and digest
+    :rtype: dict
+    """
+    st = os.stat(path)
+    return dict(_describe(os.path.abspath(path), st.st_size, st.st_mtime_ns, chunk_size))
+
+class LoopScheduler:
+    """
+    LoopScheduler, fires deadlines as callbacks on an asyncio event loop, for
+    Senders and Receivers driven by that loop
+
+    Deadlines are the loop's timer heap, so callbacks run on the loop between
+    datagrams and never race the rest of a transfer's state.
+
+    Attributes:
+        loop: the event loop callbacks run on
+    """
+    def __init__(self, loop):
+        self.loop = loop
+
+    def schedule(self, delay, callback, *args):
+        """
+        Arranges for callback(*args) to run on the loop after delay
+
+        :param delay: seconds from now until the deadline
+        :type delay: float
+        :param callback: function to call once the deadline passes
+        :type callback: callable
+        :return: handle that can be passed to cancel
+        :rtype: asyncio.TimerHandle
+        """
+        return self.loop.call_later(delay, callback, *args)
+
+    def cancel(self, entry):
+        """
+        Stops a scheduled callback from running, safe to call more than once
+
+        :param entry: handle returned by schedule
+        :type entry: asyncio.TimerHandle
+        """
+        entry.cancel()
+
+class TokenBucket:
+    """
+    TokenBucket, allows rate bytes per second on average and bursts of up to
+    burst bytes. Spending may run the balance negative, later sends then
+    wait until it is paid back.
+
+    Attributes:
+        rate: bytes added per second
+        burst: most bytes the bucket holds
+        tokens: bytes that may be sent right now
+        stamp: time.monotonic() tokens was last brought up to date
+    """
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst if burst else max(rate * 0.05, 2 * (DEFAULT_CHUNK_SIZE + 64))
+        self.tokens = self.burst
+        self.stamp = time.monotonic()
+
+    def available(self):
+        """
+        :return: bytes that may be sent right now
+        :rtype: float
+        """
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+        return self.tokens
+
+    def spend(self, nbytes):
+        """
+        :param nbytes: bytes sent or promised
+        :type nbytes: int
+        """
+        self.available()
+        self.tokens -= nbytes
 
-def convert_ack_payload(data):
+    def delay(self, nbytes):
+        """
+        :param nbytes: bytes about to be sent
+        :type nbytes: int
+        :return: seconds until the bucket holds nbytes
+        :rtype: float
+        """
+        return max(0.0, (min(nbytes, self.burst) - self.available()) / self.rate)
+
+class RateLimiter:
     """
-    Parses a receiver ACK payload (just a sequence number + "ACK")
+    RateLimiter, a global TokenBucket shared by every transfer in one
+    direction plus one TokenBucket per remote host (IP address)
 
-    :param data: sequence of bytes
-    :return: seq_num, message
+    Attributes:
+        rate: global bytes per second, None for no global limit
+        per_host: bytes per second for each remote host, None for no per host limit
+        total: the global TokenBucket
+        hosts: ip -> TokenBucket of that host
     """
-    seq_num = int.from_bytes(data[:4], byteorder='big', signed=True)
-    try:
-        msg = data[4:].decode()
-    except UnicodeDecodeError:
-        print(f"[Error] Failed to decode ACK payload: {data[4:]}")
-        msg = "<INVALID>"
-    return seq_num, msg
+    # Forget idle hosts once this many are tracked
+    max_hosts = 4096
+
+    def __init__(self, rate=None, per_host=None):
+        self.rate = rate
+        self.per_host = per_host
+        self.total = TokenBucket(rate) if rate else None
+        self.hosts = {}
+
+    def buckets(self, host):
+        """
+        :param host: ip of the remote peer
+        :type host: String
+        :return: the buckets a transfer with host draws from
+        :rtype: list
+        """
+        buckets = [self.total] if self.total else []
+        if self.per_host:
+            bucket = self.hosts.get(host)
+            if bucket is None:
+                if len(self.hosts) >= self.max_hosts:
+                    self.hosts = {ip: b for ip, b in self.hosts.items() if b.available() < b.burst}
+                bucket = self.hosts[host] = TokenBucket(self.per_host)
+            buckets.append(bucket)
+        return buckets
+
+    def allowance(self, host):
+        """
+        :param host: ip of the remote peer
+        :type host: String
+        :return: bytes that may be exchanged with host right now
+        :rtype: float
+        """
+        return min((b.available() for b in self.buckets(host)), default=float('inf'))
+
+    def spend(self, host, nbytes):
+        """
+        :param host: ip of the remote peer
+        :type host: String
+        :param nbytes: bytes sent or promised
+        :type nbytes: int
+        """
+        for bucket in self.buckets(host):
+            bucket.spend(nbytes)
+
+    def delay(self, host, nbytes):
+        """
+        :param host: ip of the remote peer
+        :type host: String
+        :param nbytes: bytes about to be exchanged
+        :type nbytes: int
+        :return: seconds until nbytes may be exchanged with host
+        :rtype: float
+        """
+        return max((b.delay(nbytes) for b in self.buckets(host)), default=0.0)
 
-def verify_integrity(sent_chksum, data):
+class ChunkRanges:
     """
-    Verifies checksum from received packet
+    ChunkRanges, the chunks of a file one transfer covers, as sorted inclusive
+    (first, last) ranges of zero based chunk indexes
 
-    :param sent_chksum: received checksum with length of 8 bytes
-    :type sent_chksum: Bytes
-    :param data: sequence of bytes to calculate checksum with
-    :type data: Bytes
-    :return: if sent_chksum is the exact same as calculated checksum
-    :rtype: Boolean
+    Packets of a transfer are numbered by their position in this list
+    rather than by chunk index, so a transfer covering scattered ranges still
+    has gap free sequence numbers. Written on the wire as "0-63;128-191".
+
+    Attributes:
+        ranges: list of (first, last) chunk index pairs
+        starts: position of the first chunk of every range
     """
-    chksum = make_checksum(data)
-    return sent_chksum == chksum
+    def __init__(self, ranges):
+        self.ranges = list(ranges)
+        self.starts = []
+        total = 0
+        for first, last in self.ranges:
+            self.starts.append(total)
+            total += last - first + 1
+        self.total = total
+
+    @classmethod
+    def whole(cls, chunk_count):
+        """
+        :param chunk_count: number of chunks in the file
+        :type chunk_count: int
+        :return: ranges covering every chunk
+        :rtype: ChunkRanges
+        """
+        return cls([(0, chunk_count - 1)] if chunk_count else [])
+
+    @classmethod
+    def parse(cls, text):
+        """
+        :param text: ranges as written by str()
+        :type text: String
+        :return: the parsed ranges
+        :rtype: ChunkRanges
+        :raises ValueError: if a range is reversed, or overlaps or comes before the one ahead of it
+        """
+        ranges = []
+        for part in text.split(";"):
+            if part:
+                first, last = part.split("-")
+                first, last = int(first), int(last)
+                if first > last or first <= (ranges[-1][1] if ranges else -1):
+                    raise ValueError(f"bad chunk range {part}")
+                ranges.append((first, last))
+        return cls(ranges)
+
+    @classmethod
+    def from_indexes(cls, indexes, max_ranges=64):
+        """
+        Groups sorted chunk indexes into ranges. When there would be more than
+        max_ranges, the smallest gaps are filled in so the result still fits
+        in one datagram.
+
+        :param indexes: sorted zero based chunk indexes
+        :type indexes: iterable of int
+        :param max_ranges: most ranges to produce, None to keep every gap
+        :type max_ranges: int
+        :rtype: ChunkRanges
+        """
+        ranges = []
+        for idx in indexes:
+            if ranges and ranges[-1][1] == idx - 1:
+                ranges[-1][1] = idx
+            else:
+                ranges.append([idx, idx])
+        while max_ranges is not None and len(ranges) > max_ranges:
+            gap = min(range(len(ranges) - 1), key=lambda i: ranges[i + 1][0] - ranges[i][1])
+            ranges[gap][1] = ranges.pop(gap + 1)[1]
+        return cls((first, last) for first, last in ranges)
+
+    def __len__(self):
+        return self.total
+
+    def __str__(self):
+        return ";".join(f"{first}-{last}" for first, last in self.ranges)
+
+    def chunk(self, pos):
+        """
+        :param pos: zero based position within the transfer
+        :type pos: int
+        :return: index of the chunk at that position
+        :rtype: int
+        """
+        i = bisect.bisect_right(self.starts, pos) - 1
+        return self.ranges[i][0] + pos - self.starts[i]
+
+class RttEstimator:
+    """
+    RttEstimator, smoothed round trip time and retransmission timeout computed
+    from ACK samples the way TCP does (RFC 6298)
+
+    Attributes:
+        srtt: smoothed round trip time in seconds, None before the first sample
+        rttvar: round trip time variation in seconds
+        rto: current retransmission timeout in seconds
+    """
+    def __init__(self, initial_rto=1.0, min_rto=0.1, max_rto=30.0):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = initial_rto
+        self.min_rto = min_rto
+        self.max_rto = max_rto
+
+    def sample(self, rtt):
+        """
+        Folds a measured round trip time into the estimate and recomputes rto
+
+        :param rtt: seconds between sending a packet and receiving its ACK
+        :type rtt: float
+        """
+        if self.srtt is None:
+            self.srtt = rtt
+            self.rttvar = rtt / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - rtt)
+            self.srtt = 0.875 * self.srtt + 0.125 * rtt
+        self.rto = min(self.max_rto, max(self.min_rto, self.srtt + 4 * self.rttvar))
+
+    def backoff(self):
+        """
+        Doubles rto after a retransmission timeout
+        """
+        self.rto = min(self.max_rto, self.rto * 2)
+
+class CongestionWindow:
+    """
+    CongestionWindow, additive increase multiplicative decrease control over
+    how many packets a Sender may have in flight
+
+    The window grows by one packet per ACK in slow start and by one packet
+    per round trip above ssthresh. A timeout halves ssthresh and restarts
+    from a single packet.
+
+    Attributes:
+        cwnd: congestion window in packets, fractional during congestion avoidance
+        ssthresh: slow start threshold in packets
+        max_window: hard cap on cwnd
+    """
+    def __init__(self, initial=4, ssthresh=64, max_window=MAX_WINDOW):
+        self.cwnd = float(initial)
+        self.ssthresh = ssthresh
+        self.max_window = max_window
+
+    @property
+    def window(self):
+        """
+        Whole number of packets currently allowed in flight, at least 1
+        """
+        return max(1, int(self.cwnd))
+
+    def on_ack(self):
+        """
+        Grows the window for one newly acknowledged packet
+        """
+        if self.cwnd < self.ssthresh:
+            self.cwnd += 1
+        else:
+            self.cwnd += 1 / self.cwnd
+        self.cwnd = min(self.cwnd, self.max_window)
+
+    def on_loss(self):
+        """
+        Halves the window after a loss signalled by duplicate ACKs
+        """
+        self.ssthresh = max(2, self.window // 2)
+        self.cwnd = float(self.ssthresh)
+
+    def on_timeout(self):
+        """
+        Backs off after a packet was lost
+        """
+        self.ssthresh = max(2, self.window // 2)
+        self.cwnd = 1.0
+
+class FileChunker:
+    """
+    FileChunker, lazily splits a file into fixed-size byte chunks
+
+    The file is memory mapped rather than read, so only the chunks currently
+    being sent are paged in and memory stays flat whatever the file size.
+
+    Attributes:
+        path: path of the file being chunked
+        chunk_size: number of bytes in every chunk except possibly the last
+        size: total size of the file in bytes
+        identity: (absolute path, size, mtime in ns, chunk_size), changes whenever the chunks may
+    """
+    def __init__(self, path, chunk_size=DEFAULT_CHUNK_SIZE):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.file = open(path, 'rb')
+        st = os.fstat(self.file.fileno())
+        self.size = st.st_size
+        self.identity = (os.path.abspath(path), st.st_size, st.st_mtime_ns, chunk_size)
+        # mmap refuses empty files, an empty file simply has no chunks
+        self.map = None
+        if self.size:
+            self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __len__(self):
+        return (self.size + self.chunk_size - 1) // self.chunk_size
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.chunk(i)
+
+    def chunk(self, index):
+        """
+        Reads a single chunk from the file
+
+        :param index: zero based index of the chunk
+        :type index: int
+        :return: bytes of the chunk
+        :rtype: Bytes
+        """
+        start = index * self.chunk_size
+        return self.map[start:start + self.chunk_size]
+
+    def view(self, index):
+        """
+        Gives a single chunk without copying it out of the mapping. The view
+        must be released before the chunker is closed, use it in a with block.
+
+        :param index: zero based index of the chunk
+        :type index: int
+        :return: view of the chunk
+        :rtype: memoryview
+        """
+        start = index * self.chunk_size
+        return memoryview(self.map)[start:start + self.chunk_size]
+
+    def close(self):
+        """
+        Unmaps and closes the underlying file
+        """
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+        self.file.close()
+
+class ChunkCache:
+    """
+    ChunkCache, shares what Senders prepare from a file between every
+    concurrent upload of it, so demand for popular content costs no more
+    file opening or compression than a single upload
+
+    Senders of the same file identity share one FileChunker, and chunk
+    bodies prepared for the wire (compressed, or found not worth
+    compressing) are kept in a least recently used cache bounded in bytes.
+    Both are keyed by FileChunker.identity, so a modified file never serves
+    stale chunks.
+
+    Attributes:
+        capacity: most bytes of prepared chunks kept
+        entries: OrderedDict of key -> prepared chunk, least recently used first
+        used: bytes currently held in entries
+        open_files: identity -> [FileChunker, number of Senders using it]
+        hits: lookups answered from the cache
+        misses: lookups that had to prepare the chunk
+    """
+    # Bookkeeping charged per entry on top of its bytes
+    entry_overhead = 100
+
+    def __init__(self, capacity=64 << 20):
+        self.capacity = capacity
+        self.entries = collections.OrderedDict()
+        self.used = 0
+        self.open_files = {}
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def open(self, path, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Gives a chunk source for a file, shared with other Senders of the
+        same unchanged file. Every open must be matched by a release.
+
+        :param path: path of the file
+        :type path: String
+        :param chunk_size: number of bytes per chunk
+        :type chunk_size: int
+        :return: chunk source for the file
+        :rtype: FileChunker
+        """
+        st = os.stat(path)
+        identity = (os.path.abspath(path), st.st_size, st.st_mtime_ns, chunk_size)
+        shared = self.open_files.get(identity)
+        if shared is not None:
+            shared[1] += 1
+            return shared[0]
+        chunks = FileChunker(path, chunk_size)
+        shared = self.open_files.get(chunks.identity)
+        if shared is not None:
+            # Another Sender opened it meanwhile
+            shared[1] += 1
+            chunks.close()
+            return shared[0]
+        self.open_files[chunks.identity] = [chunks, 1]
+        return chunks
+
+    def release(self, chunks):
+        """
+        Gives back a chunk source from open, closing it once no Sender uses it
+
+        :param chunks: the chunk source
+        :type chunks: FileChunker
+        """
+        shared = self.open_files.get(chunks.identity)
+        if shared is None or shared[0] is not chunks:
+            chunks.close()
+            return
+        shared[1] -= 1
+        if shared[1]:
+            return
+        del self.open_files[chunks.identity]
+        chunks.close()
+
+    def get(self, key):
+        """
+        :param key: (FileChunker.identity, codec id, chunk index)
+        :type key: tuple
+        :return: the prepared chunk, None if it is not cached
+        :rtype: Bytes
+        """
+        value = self.entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        """
+        Caches a prepared chunk, evicting the least recently used ones beyond capacity
 
-def make_packet(seq_num, msg, file_id):
+        :param key: (FileChunker.identity, codec id, chunk index)
+        :type key: tuple
+        :param value: the prepared chunk
+        :type value: Bytes
+        """
+        size = len(value) + self.entry_overhead
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.used -= len(old) + self.entry_overhead
+        self.entries[key] = value
+        self.used += size
+        while self.used > self.capacity and self.entries:
+            _, evicted = self.entries.popitem(last=False)
+            self.used -= len(evicted) + self.entry_overhead
+
+    def stats(self):
+        """
+        :return: hits, misses, entries, bytes used and files open
+        :rtype: dict
+        """
+        return {'hits': self.hits, 'misses': self.misses, 'entries': len(self.entries),
+                'bytes': self.used, 'open_files': len(self.open_files)}
+
+_chunk_cache = None
+_chunk_cache_lock = threading.Lock()
+
+def get_chunk_cache():
     """
-    Forms packet by combining calculated checksum and formed payload
+    Returns the process wide ChunkCache, creating it on first use
 
-    :param seq_num: int to convert to bytes
-    :type seq_num: int
-    :param msg: characters to encode
-    :type msg: String
-    :return: payload, sequence of bytes containing seq_num and msg
-    :rtype: Bytes
+    :return: the shared cache
+    :rtype: ChunkCache
     """
-    payload = make_sender_payload(seq_num, msg, file_id)
-    chksum = make_checksum(payload)
-    return chksum+payload
+    global _chunk_cache
+    with _chunk_cache_lock:
+        if _chunk_cache is None:
+            _chunk_cache = ChunkCache()
+        return _chunk_cache
 
-class Sender:
+class Sender(asyncio.DatagramProtocol):
     """
     Sender, a class with defined behavior to send data to a receiver
 
+    Packets are built from the chunk source when they are (re)transmitted
+    instead of being held in memory for the whole transfer. A Sender may be
+    asked for only some ranges of the file, packet i then carries the i-th
+    chunk of those ranges. How many packets
+    are in flight is bounded by a congestion window, and retransmission
+    deadlines follow the measured round trip time.
+
+    A Sender is the protocol of its own asyncio datagram endpoint and is
+    driven entirely by events: every ACK that arrives advances the transfer
+    and refills the window, and every retransmission, metadata or FIN retry
+    is a deadline on its LoopScheduler, by default one on the running loop.
+    setup_exchange is the coroutine that runs one transfer.
+
     Attributes:
-        packets: Array of 3 object arrays containing:
-        [formed byte packet, boolean ack, Timeout retransmission thread]
+        chunks: chunk source for the file, indexed from 0
+        ranges: ChunkRanges of the chunks to send, the whole file if None
+        acked: bytearray holding 1 for every acknowledged packet
+        timers: in flight packet index -> retransmission deadline handle
+        sent_at: in flight packet index -> time it was first sent, for RTT samples
+        retransmitted: packet indexes sent more than once, never sampled for RTT
+        last_cum_ack: highest cumulative ACK point seen so far
+        dupacks: number of ACKs in a row that did not move last_cum_ack
+        scheduler: LoopScheduler that fires the retransmissions
+        rtt: RttEstimator giving the retransmission timeout
+        cwnd: CongestionWindow limiting packets in flight
+        pacing_rate: optional cap in bytes per second on how fast packets leave
 
-        soc: socket that sender uses to send data over
+        soc: datagram transport that sender uses to send data over
+        send_buf: preallocated buffer data packets are packed into
+        handle: stream handle the receiver assigned in its ACK of the metadata
+        codec_id: wire codec chunks are compressed with, 0 for none
+        compress_after: no compression is tried before this packet index, see compressed_chunk
+        cache: ChunkCache sharing the file and its compressed chunks with other Senders
+        fec: optional (n, k), k parity packets follow every n data packets, see wire.PARITY
+        retransmissions: number of data packets sent more than once
+        state: 'meta', 'data' or 'fin', the stage of the transfer waiting on an ACK
+        done: future resolved with True once the FIN is acknowledged, False on failure
+        window_edge: highest packet index the receiver granted, see wire.encode_ack
+        uplink: optional UploadScheduler that decides when new packets may leave
+        wants_budget: set when fill_window stopped only because its budget ran out
         ip: ip address to send data to
         port: port number to send data to
         base_seq: the lowest sequence number to index by
+        chunk_size: number of file bytes to put in each packet
     """
-    packets = None
-    def __init__(self, soc, ip, port, file_id):
+    chunks = None
+    # Largest span of sequence numbers a receiver is expected to buffer
+    max_window = MAX_WINDOW
+    # Give up when nothing at all is heard back for this many seconds
+    idle_limit = 30.0
+    # Packets due this close together leave in one burst, finer than the loop's timers
+    pacing_slack = 0.005
+    # Most packets skipped between compression attempts once chunks stop shrinking
+    max_compress_backoff = 64
+
+    def __init__(self, soc, ip, port, file_id, chunk_size=DEFAULT_CHUNK_SIZE, scheduler=None,
+                 pacing_rate=None, ranges=None, codec=None, fec=None, cache=None):
         self.soc = soc
         self.ip = ip
         self.port = port
         self.base_seq = 1
         self.file_id = file_id
-        self.packets = []  # Each entry: [packet_bytes, acked (bool), timer]
+        self.handle = 0
+        self.chunk_size = chunk_size
+        # Every data packet is packed into this one buffer just before it is sent
+        self.send_buf = bytearray(wire.DATA.size + chunk_size)
+        self.send_view = memoryview(self.send_buf)
+        self.codec_id = (wire.find_codec(codec) if codec else None) or 0
+        self.compress = wire.CODECS[self.codec_id][1] if self.codec_id else None
+        self.compress_after = 0
+        self.compress_backoff = 0
+        self.fec = fec if fec and 1 <= fec[1] <= fec[0] <= 255 else None
+        self.parity_sent = 0
+        self.retransmissions = 0
+        self.chunks = []
+        self.ranges = ranges
+        self.acked = bytearray()
+        self.timers = {}
+        self.sent_at = {}
+        self.retransmitted = set()
+        self.recv_base = 0
+        self.next_idx = 0
+        self.recovery_point = 0
+        self.last_cum_ack = 0
+        self.dupacks = 0
+        self.scheduler = scheduler if scheduler else LoopScheduler(asyncio.get_running_loop())
+        self.cache = cache if cache else get_chunk_cache()
+        self.rtt = RttEstimator()
+        self.cwnd = CongestionWindow(max_window=self.max_window)
+        self.pacing_rate = pacing_rate
+        self.next_send_time = 0.0
+        self.pace_timer = None
+        self.state = None
+        self.done = None
+        self.control_pkt = None
+        self.control_timer = None
+        self.control_sent_at = 0.0
+        self.attempts = 0
+        self.last_heard = 0.0
+        self.window_edge = -1
+        self.probe_timer = None
+        self.uplink = None
+        self.wants_budget = False
+
+    def connection_made(self, transport):
+        """
+        Called by asyncio once the datagram endpoint of this Sender is ready
+        """
+        self.soc = transport
+
+    def datagram_received(self, data, address):
+        """
+        Handles one ACK from the receiver according to the stage of the transfer
+
+        :param data: the datagram, only valid during this call
+        :type data: memoryview
+        :param address: (ip, port) it came from
+        :type address: tuple
+        """
+        header = wire.parse_packet(data)
+        if header is None:
+            return
+        if header[0] != wire.PACKET_ACK:
+            print(f"[Sender] Ignored non-ACK packet of type {header[0]}")
+            return
+        handle, cum_ack, rwnd, sack = wire.decode_ack(data)
+        if self.state != 'meta' and handle != self.handle:
+            return  # Left over from an earlier stream to the same address
+        self.last_heard = time.monotonic()
+
+        if self.state == 'meta' and cum_ack >= META_SEQ:
+            self.scheduler.cancel(self.control_timer)
+            # The receiver names the stream in its answer to the metadata
+            self.handle = handle
+            # Only an unambiguous round trip seeds the RTT estimate
+            if self.attempts == 0:
+                self.rtt.sample(self.last_heard - self.control_sent_at)
+            self.state = 'data'
+            self.handle_ack(cum_ack, sack, rwnd)
+            self.pump()
+        elif self.state == 'data':
+            self.handle_ack(cum_ack, sack, rwnd)
+            self.pump()
+        elif self.state == 'fin' and cum_ack == -1:
+            # Late ACKs for data packets are skipped over
+            print(f"[Sender] Received final ACK. Transfer complete, {self.retransmissions} retransmissions"
+                  + (f", {self.parity_sent} parity packets." if self.fec else "."))
+            self.finish(True)
+
+    def error_received(self, exc):
+        """
+        Called by asyncio when a send fails, e.g. the receiver's port is closed
+        """
+        print(f"[Sender] Socket error towards {self.ip}:{self.port}: {exc}")
+
+    def build_pkt(self, idx):
+        """
+        Forms packet idx of the transfer from the chunk source, straight into
+        the Sender's send buffer. With a codec the chunk is compressed if
+        that makes it smaller.
+
+        :param idx: zero based position of the packet within the transfer
+        :type idx: int
+        :return: packet for that chunk, only valid until the next build_pkt
+        :rtype: memoryview
+        """
+        chunk = self.ranges.chunk(idx)
+        with self.chunks.view(chunk) as body:
+            if self.compress is not None:
+                packed = self.compressed_chunk(idx, chunk, body)
+                if packed:
+                    length = wire.encode_data_into(self.send_buf, self.base_seq + idx, self.handle,
+                                                   packed, wire.FLAG_COMPRESSED)
+                    return self.send_view[:length]
+            length = wire.encode_data_into(self.send_buf, self.base_seq + idx, self.handle, body)
+        return self.send_view[:length]
+
+    def compressed_chunk(self, idx, chunk, body):
+        """
+        Compresses a chunk, or finds it already compressed by an earlier
+        upload in the chunk cache
+
+        :param idx: zero based position of the packet within the transfer
+        :type idx: int
+        :param chunk: index of the chunk in the file
+        :type chunk: int
+        :param body: the chunk
+        :type body: memoryview
+        :return: the compressed chunk, empty if it is sent uncompressed
+        :rtype: Bytes
+        """
+        key = (self.chunks.identity, self.codec_id, chunk)
+        packed = self.cache.get(key)
+        if packed is not None:
+            return packed
+        if idx < self.compress_after:
+            return b''
+        packed = self.compress(body)
+        if len(packed) < len(body):
+            self.compress_backoff = 0
+        else:
+            # Incompressible data, wait longer before trying again each time
+            self.compress_backoff = min(max(1, self.compress_backoff * 2), self.max_compress_backoff)
+            self.compress_after = idx + self.compress_backoff
+            packed = b''
+        self.cache.put(key, packed)
+        return packed
+
+    def transmit(self, idx, pkt=None):
+        """
+        Sends the chunk at idx for the first time and arms its retransmission deadline
+
+        :param idx: zero based index of the chunk
+        :type idx: int
+        :param pkt: the packet if already built
+        :type pkt: Bytes
+        """
+        if pkt is None:
+            pkt = self.build_pkt(idx)
+        now = time.monotonic()
+        if self.pacing_rate:
+            self.next_send_time = max(self.next_send_time, now) + len(pkt) / self.pacing_rate
+        self.sent_at[idx] = now
+        self.timers[idx] = self.scheduler.schedule(self.rtt.rto, self.send_pkt, self.base_seq + idx)
+        self.soc.sendto(pkt, (self.ip, self.port))
 
     def send_pkt(self, seq_num):
         """
-        Retransmits packet after timeout by thread.Timer and resets timeout
+        Retransmits packet after its deadline fires on the scheduler and resets timeout
+
+        The first loss seen in a window shrinks the congestion window and
+        backs off the timeout. Further losses from the same window don't
+        shrink it again.
 
         :param seq_num: sequence number to retransmit
         :type seq_num: int
         """
         idx = seq_num - self.base_seq
-        if idx < 0 or idx >= len(self.packets):
+        if idx < 0 or idx >= len(self.acked) or self.acked[idx]:
             return
+        if idx >= self.recovery_point:
+            self.cwnd.on_timeout()
+            self.rtt.backoff()
+            self.recovery_point = self.next_idx
+        self.retransmitted.add(idx)
+        # Restart retransmission timer
+        self.timers[idx] = self.scheduler.schedule(self.rtt.rto, self.send_pkt, seq_num)
 
         print(f"[Sender] Retransmitting {seq_num} to {self.ip}:{self.port}")
-        pkt, acked, _ = self.packets[idx]
+        self.resend(idx)
+
+    def resend(self, idx):
+        """
+        Sends packet idx again. Retransmissions are never held back, but they
+        still count against the uplink's rate limits.
+
+        :param idx: zero based index of the chunk
+        :type idx: int
+        """
+        pkt = self.build_pkt(idx)
+        self.retransmissions += 1
+        if self.uplink is not None:
+            self.uplink.spend(self, len(pkt))
         self.soc.sendto(pkt, (self.ip, self.port))
 
-        # Restart retransmission timer
-        timer = threading.Timer(5.0, self.send_pkt, [seq_num])
-        self.packets[idx][2] = timer
-        timer.start()
+    def send_parity(self, idx):
+        """
+        Sends the parity packets of a FEC group once packet idx, the group's
+        last, has been sent for the first time. Parity is never retransmitted.
+
+        :param idx: zero based index of the packet just sent
+        :type idx: int
+        :return: number of bytes sent
+        :rtype: int
+        """
+        n, k = self.fec
+        if (idx + 1) % n and idx + 1 != len(self.acked):
+            return 0
+        first = idx - idx % n
+        members = range(first, idx + 1)
+        sent = 0
+        for j in range(min(k, len(members))):
+            parity = 0
+            for m in members[j::k]:
+                with self.chunks.view(self.ranges.chunk(m)) as body:
+                    # Short chunks are padded with zeros at the end
+                    parity ^= int.from_bytes(body, 'big') << (8 * (self.chunk_size - len(body)))
+            pkt = wire.encode_parity(self.handle, self.base_seq + first, len(members), k, j,
+                                     parity.to_bytes(self.chunk_size, 'big'))
+            if self.pacing_rate:
+                self.next_send_time += len(pkt) / self.pacing_rate
+            self.soc.sendto(pkt, (self.ip, self.port))
+            self.parity_sent += 1
+            sent += len(pkt)
+        return sent
+
+    def ack_one(self, idx):
+        """
+        Marks a single packet acknowledged and cancels its timer.
+
+        :param idx: zero based index of the chunk
+        :type idx: int
+        :return: RTT sample for the packet, 0 if newly acked but not sampleable,
+                 None if it was already acknowledged
+        :rtype: float
+        """
+        if self.acked[idx]:
+            return None
+        self.acked[idx] = 1  # Mark packet as acked
+        # Cancel the timer if it's still running
+        timer = self.timers.pop(idx, None)
+        if timer:
+            self.scheduler.cancel(timer)
+        sent_at = self.sent_at.pop(idx, None)
+        self.cwnd.on_ack()
+        # Karn's rule, a retransmitted packet's ACK is ambiguous
+        if idx in self.retransmitted:
+            self.retransmitted.discard(idx)
+            return 0
+        return time.monotonic() - sent_at if sent_at is not None else 0
+
+    def handle_ack(self, cum_ack, sack=b'', rwnd=None):
+        """
+        Applies a cumulative + selective acknowledgement: marks the packets it
+        covers as acked, feeds the RTT estimate and congestion window, moves
+        the receive window edge, and fast retransmits the first missing packet
+        after 3 duplicate ACKs. An ACK that only opens the window is not a duplicate.
+        With FEC the fast retransmission waits until parity could not have repaired it.
+
+        :param cum_ack: sequence number every earlier packet was received up to
+        :type cum_ack: int
+        :param sack: bitmap of packets received beyond cum_ack + 1
+        :type sack: Bytes
+        :param rwnd: packets the receiver will take beyond cum_ack, None to leave the edge alone
+        :type rwnd: int
+        """
+        resend = None
+        window_moved = False
+        if rwnd is not None and cum_ack + rwnd - self.base_seq > self.window_edge:
+            # ACKs may arrive out of order, the edge never moves back
+            self.window_edge = cum_ack + rwnd - self.base_seq
+            window_moved = True
+
+        samples = []
+        last = min(cum_ack - self.base_seq, len(self.acked) - 1)
+        for idx in range(self.recv_base, last + 1):
+            samples.append(self.ack_one(idx))
+        newest = cum_ack
+        for seq in sack_seqs(cum_ack, sack):
+            newest = seq
+            idx = seq - self.base_seq
+            if 0 <= idx < len(self.acked):
+                samples.append(self.ack_one(idx))
+        # The newest packet acked carries the least ACK delay
+        samples = [rtt for rtt in samples if rtt]
+        if samples:
+            self.rtt.sample(min(samples))
+
+        if cum_ack > self.last_cum_ack:
+            self.last_cum_ack = cum_ack
+            self.dupacks = 0
+        elif sack and not window_moved:
+            self.dupacks += 1
+            idx = cum_ack + 1 - self.base_seq
+            if (self.dupacks >= 3 and 0 <= idx < len(self.acked) and not self.acked[idx]
+                    and idx not in self.retransmitted and not self.repairable(idx, newest - self.base_seq)):
+                if idx >= self.recovery_point:
+                    self.cwnd.on_loss()
+                    self.recovery_point = self.next_idx
+                self.retransmitted.add(idx)
+                timer = self.timers.pop(idx, None)
+                if timer:
+                    self.scheduler.cancel(timer)
+                self.timers[idx] = self.scheduler.schedule(self.rtt.rto, self.send_pkt, cum_ack + 1)
+                resend = idx
+
+        if resend is not None:
+            print(f"[Sender] Fast retransmitting {cum_ack + 1} to {self.ip}:{self.port}")
+            self.resend(resend)
+
+    def repairable(self, idx, newest):
+        """
+        Tells whether parity may still rebuild a missing packet. The parity of
+        a FEC group is sent before the next group, so once the receiver
+        reports a packet past the group the missing one is really lost.
+
+        :param idx: zero based index of the missing packet
+        :type idx: int
+        :param newest: zero based index of the newest packet the receiver reported
+        :type newest: int
+        :return: whether fast retransmission should wait for the parity
+        :rtype: Boolean
+        """
+        if not self.fec:
+            return False
+        return newest < idx - idx % self.fec[0] + self.fec[0]
 
     def arrange_pkts(self, data):
         """
-        Given chunks of data, populate each entry of Sender packets with
-        packet, False (for acknowledgement), thread.Timer for timeout and retransmit
+        Given a chunk source, reset the acknowledgement state so that every
+        chunk in ranges is unacknowledged and has no timer yet
 
-        :param data: array of chunks of data
-        :type data: Array of Strings
+        :param data: chunk source supporting len() and chunk(index)
+        :type data: FileChunker
         """
-        self.packets = []
-        seq_num = self.base_seq
-        for pkt in data:
-            packet = make_packet(seq_num, pkt, self.file_id)
-            self.packets.append([packet, False, None])  # No timer yet
-            seq_num += 1
+        self.chunks = data
+        if self.ranges is None:
+            self.ranges = ChunkRanges.whole(len(data))
+        self.acked = bytearray(len(self.ranges))
+        self.timers = {}
+        self.sent_at = {}
+        self.retransmitted = set()
+        self.recv_base = 0
+        self.next_idx = 0
+        self.recovery_point = 0
+        self.last_cum_ack = 0
+        self.dupacks = 0
+        self.window_edge = -1
 
 
     def find_recv_base_window(self, window_size):
@@ -162,110 +1084,454 @@ class Sender:
         :param window_size: size of window
         :type window_size: int
         """
-        for i in range(len(self.packets)):
-            if not self.packets[i][1]:  # Not ACKed
-                end = min(i + window_size - 1, len(self.packets) - 1)
-                return i, end
-        return None, None
+        while self.recv_base < len(self.acked) and self.acked[self.recv_base]:
+            self.recv_base += 1
+        if self.recv_base == len(self.acked):
+            return None, None
+        end = min(self.recv_base + window_size - 1, len(self.acked) - 1)
+        return self.recv_base, end
 
     def make_packets(self, exch_path, chunk_size):
         """
-        Forms packets from file by splitting file into chunks
+        Opens the file as a lazy source of fixed size byte chunks, shared
+        with the other Senders of the same file through the chunk cache
 
-        :param file_name: String containing name of file to send
-        :type file_name: String
-        :param chunk_size: number of characters to fit in a chunk from file
+        :param exch_path: String containing path of file to send
+        :type exch_path: String
+        :param chunk_size: number of bytes to fit in a chunk from file
         :type chunk_size: int
-        :return: pkts, array of character chunks from file
-        :rtype: Array
+        :return: chunk source for the file
+        :rtype: FileChunker
+        """
+        return self.cache.open(exch_path, chunk_size)
+
+    async def setup_exchange(self, exch_path, meta=None):
         """
-        file = open(exch_path, 'r')
-        content = file.read()
-        file.close()
-        pkts = [content[i:i + chunk_size] for i in range(0, len(content), chunk_size)]
-        #print(pkts)
-        return pkts
+        Opens the file, announces the transfer and waits until it is sent,
+        failed, or nothing was heard back for idle_limit seconds
 
-    def setup_exchange(self, exch_path):
+        :param exch_path: String containing path of file to send
+        :type exch_path: String
+        :param meta: metadata of the complete file, only needed when exch_path
+                     is a partial download, otherwise read from the file
+        :type meta: dict
+        :return: True once the receiver acknowledged the whole transfer
+        :rtype: Boolean
+        """
         print(f"[Sender] Starting file exchange for {exch_path}")
-        self.arrange_pkts(self.make_packets(exch_path, 24))
-        # Add process to run sender to distinguish request number
-        self.run_sender()
+        loop = asyncio.get_running_loop()
+        self.done = loop.create_future()
+        chunks = self.make_packets(exch_path, self.chunk_size)
+        self.arrange_pkts(chunks)
+        try:
+            if meta is None:
+                # Hashing a large file the first time would stall every other transfer on the loop
+                meta = await loop.run_in_executor(None, describe_file, exch_path, self.chunk_size)
+            meta = make_meta_payload(meta['size'], self.chunk_size, meta['chunk_count'],
+                                     meta['digest'], self.ranges)
+            self.last_heard = time.monotonic()
+            self.open_transfer(meta)
+            while True:
+                try:
+                    return await asyncio.wait_for(asyncio.shield(self.done), self.idle_limit)
+                except asyncio.TimeoutError:
+                    if time.monotonic() - self.last_heard > self.idle_limit:
+                        print(f"[Sender] No ACKs from {self.ip}:{self.port} for {self.idle_limit}s, aborting.")
+                        return False
+        finally:
+            self.finish(False)
+            self.cache.release(chunks)
 
+    def cancel_timers(self):
+        """
+        Cancels every retransmission deadline still pending for this Sender
+        """
+        for timer in self.timers.values():
+            self.scheduler.cancel(timer)
+        self.timers.clear()
+        for timer in (self.pace_timer, self.control_timer, self.probe_timer):
+            if timer is not None:
+                self.scheduler.cancel(timer)
+        self.pace_timer = self.control_timer = self.probe_timer = None
 
-    def run_sender(self):
+    def finish(self, ok):
         """
-        Sends packets using Selective Repeat. Only creates timers once per packet.
+        Ends the transfer, stopping every timer, and resolves done
+
+        :param ok: whether the receiver acknowledged the whole transfer
+        :type ok: Boolean
         """
-        win_size = max(1, len(self.packets) // 4)
-        sent = set()
+        self.state = None
+        self.cancel_timers()
+        if self.done is not None and not self.done.done():
+            self.done.set_result(ok)
 
-        while True:
-            #print("Still alive")
-            recv_base, win_end = self.find_recv_base_window(win_size)
-            if recv_base is None:
-                break  # All packets acknowledged
-
-            for i in range(recv_base, win_end + 1):
-                if not self.packets[i][1] and i not in sent:
-                    pkt = self.packets[i][0]
-                    self.soc.sendto(pkt, (self.ip, self.port))
-
-                    # Set and start retransmission timer
-                    timer = threading.Timer(5.0, self.send_pkt, [self.base_seq + i])
-                    self.packets[i][2] = timer
-                    timer.start()
-                    sent.add(i)
-                    time.sleep(0.2)
-
-            # Listen for ACKs
-            self.soc.settimeout(4)
-            try:
-                while True:
-                    data, _ = self.soc.recvfrom(4096)
-                    chksum, payload = data[:8], data[8:]
-                    
-                    if verify_integrity(chksum, payload):
-                        recv_seq, ack = convert_ack_payload(payload)
-                        if ack.strip() != "ACK":
-                            print(f"[Sender] Ignored non-ACK message: {ack}")
-                            continue
-
-                        print(f"[Sender] Received ACK for packet {recv_seq}")
-                        idx = recv_seq - self.base_seq
-                        if 0 <= idx < len(self.packets):
-                            self.packets[idx][1] = True  # Mark packet as acked
-                            # Cancel the timer if it's still running
-                            timer = self.packets[idx][2]
-                            if timer and timer.is_alive():
-                                timer.cancel()
-            except socket.timeout:
-                # Instead of continue, we break out of the "while True" loop
-                pass
-            finally:
-                self.soc.settimeout(None)
-
-        # Send FIN and wait for ACK
-        max_retries = 5
-        retries = 0
-        while retries < max_retries:
-            fin_pkt = make_packet(-1, 'FIN', self.file_id)
-            self.soc.sendto(fin_pkt, (self.ip, self.port))
+    def send_control(self, pkt, state):
+        """
+        Sends the metadata or FIN packet and arms its retry deadline
+
+        :param pkt: the packet
+        :type pkt: Bytes
+        :param state: the stage waiting for this packet's ACK, 'meta' or 'fin'
+        :type state: String
+        """
+        self.state = state
+        self.control_pkt = pkt
+        self.attempts = 0
+        self.control_sent_at = time.monotonic()
+        self.soc.sendto(pkt, (self.ip, self.port))
+        self.control_timer = self.scheduler.schedule(self.rtt.rto, self.resend_control, state)
+
+    def resend_control(self, state, max_retries=5):
+        """
+        Retry deadline of the metadata or FIN packet, resends it with a backed
+        off timeout until max_retries attempts went unacknowledged
+
+        :param state: the stage the deadline was armed for
+        :type state: String
+        """
+        if self.state != state:
+            return
+        self.attempts += 1
+        self.rtt.backoff()
+        if self.attempts >= max_retries:
+            if state == 'meta':
+                print(f"[Sender] {self.ip}:{self.port} never acknowledged transfer setup, aborting.")
+                self.finish(False)
+            else:
+                # Every chunk was acknowledged, only the FIN's ACK went missing
+                print("[Sender] Exiting FIN handshake sequence.")
+                self.finish(True)
+            return
+        if state == 'fin':
+            print(f"[Sender] FIN retry timed out ({self.attempts}/{max_retries})")
+        self.soc.sendto(self.control_pkt, (self.ip, self.port))
+        self.control_timer = self.scheduler.schedule(self.rtt.rto, self.resend_control, state)
+
+    def open_transfer(self, meta):
+        """
+        Sends the transfer metadata. No data is sent until the receiver
+        acknowledges it, and that round trip also seeds the RTT estimate.
+
+        :param meta: metadata body formed by make_meta_payload
+        :type meta: String
+        """
+        self.send_control(wire.encode_meta(self.file_id, meta, self.codec_id), 'meta')
+
+    def fill_window(self, budget=None):
+        """
+        Sends new packets while the congestion window has room and they fit
+        inside the window the receiver granted. With a pacing rate, stops at
+        the next packet that would leave too early and arms a deadline to
+        carry on. With a budget, stops before the packet that would exceed it
+        and sets wants_budget. When the receiver's window is shut with nothing
+        in flight, a probe deadline makes sure we hear when it opens.
+
+        :param budget: most bytes to send, None for no limit
+        :type budget: int
+        :return: number of bytes sent
+        :rtype: int
+        """
+        self.wants_budget = False
+        sent = 0
+        recv_base, win_end = self.find_recv_base_window(self.max_window)
+        if recv_base is None:
+            return sent  # All packets acknowledged
+        win_end = min(win_end, self.window_edge)
+        if self.next_idx > win_end and not self.timers and self.probe_timer is None:
+            self.probe_timer = self.scheduler.schedule(self.rtt.rto, self.probe)
+        while self.next_idx <= win_end and len(self.timers) < self.cwnd.window:
+            if not self.acked[self.next_idx]:
+                wait = self.next_send_time - time.monotonic()
+                if wait > self.pacing_slack:
+                    if self.pace_timer is None:
+                        self.pace_timer = self.scheduler.schedule(wait, self.paced)
+                    break
+                pkt = self.build_pkt(self.next_idx)
+                if budget is not None and sent + len(pkt) > budget:
+                    self.wants_budget = True
+                    break
+                self.transmit(self.next_idx, pkt)
+                sent += len(pkt)
+                if self.fec:
+                    sent += self.send_parity(self.next_idx)
+            self.next_idx += 1
+        return sent
+
+    def probe(self):
+        """
+        Probe deadline, resends the metadata packet while the receiver's
+        window stays shut. The receiver answers it with a fresh ACK, so a
+        lost window update can't stall the transfer.
+        """
+        self.probe_timer = None
+        if self.state == 'data' and self.next_idx > self.window_edge and not self.timers:
+            self.soc.sendto(self.control_pkt, (self.ip, self.port))
+            self.probe_timer = self.scheduler.schedule(self.rtt.rto, self.probe)
+
+    def paced(self):
+        """
+        Pacing deadline, sends whatever the window allows now
+        """
+        self.pace_timer = None
+        if self.state == 'data':
+            self.pump()
+
+    def pump(self):
+        """
+        Refills the window after an ACK, or waits for a turn from the uplink
+        when it has one, and once every packet has been acknowledged sends the FIN
+        """
+        if self.find_recv_base_window(self.max_window)[0] is not None:
+            if self.uplink is not None:
+                self.uplink.backlog(self)
+            else:
+                self.fill_window()
+        else:
+            self.cancel_timers()
             print("[Sender] Sent FIN, waiting for final ACK...")
+            self.send_control(wire.encode_data(-1, self.handle, 'FIN'), 'fin')
+
+class UploadEndpoint(asyncio.DatagramProtocol):
+    """
+    UploadEndpoint, a pooled datagram endpoint that Senders to different
+    receivers share, routing each ACK to the Sender talking to the address
+    it came from
+
+    Attributes:
+        soc: datagram transport of the endpoint
+        senders: (ip, port) -> Sender currently uploading to that address
+        released: (ip, port) -> time.monotonic() the last upload to that address ended
+        idle_since: time.monotonic() the last upload from this endpoint ended
+    """
+    def __init__(self):
+        self.soc = None
+        self.senders = {}
+        self.released = {}
+        self.idle_since = time.monotonic()
+
+    def connection_made(self, transport):
+        """
+        Called by asyncio once the endpoint is ready
+        """
+        self.soc = transport
+
+    def datagram_received(self, data, address):
+        """
+        Hands the datagram to the Sender uploading to address, if any
+        """
+        sender = self.senders.get(address)
+        if sender is not None:
+            sender.datagram_received(data, address)
+
+    def error_received(self, exc):
+        """
+        Called by asyncio when a send fails, e.g. the receiver's port is closed
+        """
+        print("[Uploads] Socket error:", exc)
+
+class UploadScheduler:
+    """
+    UploadScheduler, runs uploads in a bounded number of slots and shares the
+    uplink between the running ones with deficit round robin
+
+    Uploads beyond the number of slots wait in order of arrival. Every round,
+    each running Sender with room in its window gets quantum bytes of credit
+    and sends new packets while its credit lasts, so a transfer with a huge
+    window can't starve the others. A Sender with nothing to send leaves the
+    round and keeps no credit. Retransmissions are not held back. Rounds are
+    separate loop callbacks, so ACKs are handled in between.
+
+    With a RateLimiter, a Sender only gets its turn while the global bucket
+    and the bucket of its receiver's host hold tokens, and whatever it sends,
+    retransmissions included, is spent from them. When every backlogged
+    Sender is out of tokens the next round waits until some are back.
+
+    Uploads send from a pool of UploadEndpoints. ACKs carry no transfer id,
+    so an endpoint only serves one upload per receiver address at a time, and
+    only picks that address up again after reuse_delay, once stray packets of
+    the previous upload are gone. The pool is capped at max_endpoints, so
+    quick repeat uploads to one receiver may wait briefly for an endpoint.
+
+    Attributes:
+        loop: the event loop uploads run on
+        slots: most uploads running at once
+        running: number of uploads holding a slot
+        waiting: futures of uploads waiting for a slot, oldest first
+        backlogged: Senders waiting for their turn this round
+        deficits: Sender -> bytes of credit left over from earlier rounds
+        endpoints: the pooled UploadEndpoints
+        max_endpoints: most endpoints in the pool
+        limiter: optional RateLimiter for upload bandwidth
+    """
+    # Credit per round, a few packets so rounds stay cheap
+    quantum = 4 * (DEFAULT_CHUNK_SIZE + 64)
+    # Seconds before an endpoint uploads to the same receiver again, well
+    # beyond how long the network might hold back a reordered packet
+    reuse_delay = 0.5
+    # Seconds an endpoint beyond the number of slots may stay idle before it is closed
+    idle_close = 30.0
+
+    def __init__(self, loop, slots=8, limiter=None):
+        self.loop = loop
+        self.limiter = limiter
+        self.slots = slots
+        self.running = 0
+        self.waiting = collections.deque()
+        self.backlogged = collections.deque()
+        self.deficits = {}
+        self.round = None
+        self.endpoints = []
+        self.max_endpoints = 4 * slots
+        self.opening = 0
+
+    async def submit(self, sender, exch_path, meta=None):
+        """
+        Runs one upload once a slot is free
+
+        :param sender: Sender for the upload, its soc is set from the pool
+        :type sender: Sender
+        :param exch_path: String containing path of file to send
+        :type exch_path: String
+        :param meta: metadata of the complete file, see Sender.setup_exchange
+        :type meta: dict
+        :return: True once the receiver acknowledged the whole transfer
+        :rtype: Boolean
+        """
+        if self.running < self.slots and not self.waiting:
+            self.running += 1
+        else:
+            turn = self.loop.create_future()
+            self.waiting.append(turn)
+            print(f"[Uploads] All {self.slots} slots busy, {sender.file_id} to {sender.ip}:{sender.port} "
+                  f"is number {len(self.waiting)} in line.")
+            # The finishing upload hands its slot straight to us
+            await turn
+
+        address = (sender.ip, sender.port)
+        try:
+            endpoint = await self.endpoint_for(address)
+            endpoint.senders[address] = sender
+            sender.soc = endpoint.soc
+            sender.uplink = self
             try:
-                self.soc.settimeout(10)
-                data, _ = self.soc.recvfrom(4096)
-                chksum, payload = data[:8], data[8:]
-                
-                if verify_integrity(chksum, payload):
-                    recv_seq, ack = convert_ack_payload(payload)
-                    if ack.strip() == "ACK" and recv_seq == -1:
-                        print("[Sender] Received final ACK. Transfer complete.")
-                        break
-            except socket.timeout:
-                print(f"[Sender] FIN retry timed out ({retries+1}/{max_retries})")
-                retries += 1
+                return await sender.setup_exchange(exch_path, meta)
             finally:
-                self.soc.settimeout(None)
+                del endpoint.senders[address]
+                now = time.monotonic()
+                endpoint.released = {addr: at for addr, at in endpoint.released.items()
+                                     if now - at < self.reuse_delay}
+                endpoint.released[address] = now
+                endpoint.idle_since = now
+                self.deficits.pop(sender, None)
+        finally:
+            if self.waiting:
+                self.waiting.popleft().set_result(None)
+            else:
+                self.running -= 1
 
-        print("[Sender] Exiting FIN handshake sequence.")
+    async def endpoint_for(self, address):
+        """
+        Finds a pooled endpoint free to upload to address, opening one while
+        the pool is below max_endpoints, otherwise waiting for one to come free
+
+        :param address: (ip, port) of the receiver
+        :type address: tuple
+        :rtype: UploadEndpoint
+        """
+        while True:
+            now = time.monotonic()
+            soonest = None
+            for endpoint in self.endpoints:
+                if address in endpoint.senders:
+                    continue
+                wait = endpoint.released.get(address, float('-inf')) + self.reuse_delay - now
+                if wait <= 0:
+                    return endpoint
+                soonest = wait if soonest is None else min(soonest, wait)
+
+            # Close surplus endpoints nothing was sent from lately
+            for endpoint in list(self.endpoints):
+                if len(self.endpoints) <= self.slots:
+                    break
+                if not endpoint.senders and now - endpoint.idle_since > self.idle_close:
+                    endpoint.soc.close()
+                    self.endpoints.remove(endpoint)
+
+            if len(self.endpoints) + self.opening < self.max_endpoints:
+                self.opening += 1
+                try:
+                    _, endpoint = await wire.open_endpoint(self.loop, UploadEndpoint, ('0.0.0.0', 0))
+                finally:
+                    self.opening -= 1
+                self.endpoints.append(endpoint)
+                return endpoint
+            await asyncio.sleep(soonest)
+
+    def backlog(self, sender):
+        """
+        Queues a Sender that has room in its window for its next turn
+
+        :param sender: the Sender
+        :type sender: Sender
+        """
+        if sender not in self.deficits:
+            self.deficits[sender] = 0
+            self.backlogged.append(sender)
+        if self.round is None:
+            self.round = self.loop.call_soon(self.run_round)
+
+    def spend(self, sender, nbytes):
+        """
+        Charges bytes a Sender sent outside its turn to the rate limits
+
+        :param sender: the Sender
+        :type sender: Sender
+        :param nbytes: bytes sent
+        :type nbytes: int
+        """
+        if self.limiter is not None:
+            self.limiter.spend(sender.ip, nbytes)
+
+    def run_round(self):
+        """
+        Gives every backlogged Sender with tokens left one turn of quantum
+        bytes of credit
+        """
+        self.round = None
+        progress = False
+        waits = []
+        for _ in range(len(self.backlogged)):
+            sender = self.backlogged.popleft()
+            if sender.state != 'data':
+                self.deficits.pop(sender, None)
+                continue
+            budget = self.deficits[sender] + self.quantum
+            if self.limiter is not None:
+                allowance = self.limiter.allowance(sender.ip)
+                packet = sender.chunk_size + 64
+                if allowance < packet:
+                    waits.append(self.limiter.delay(sender.ip, packet))
+                    if self.limiter.total is not None and self.limiter.total.available() < packet:
+                        # The shared bucket ran dry, this Sender goes first once it refills
+                        self.backlogged.appendleft(sender)
+                        break
+                    # Its host is out of tokens, sits this round out without earning credit
+                    self.backlogged.append(sender)
+                    continue
+                budget = min(budget, allowance)
+            sent = sender.fill_window(budget)
+            # Credit a rate limit kept from being used is not saved up for a burst later
+            self.deficits[sender] = min(self.deficits[sender] + self.quantum - sent, self.quantum)
+            self.spend(sender, sent)
+            progress = progress or sent > 0
+            if sender.wants_budget:
+                self.backlogged.append(sender)
+            else:
+                # Waiting on ACKs now, no credit is saved up meanwhile
+                del self.deficits[sender]
+        if self.backlogged:
+            if progress or not waits:
+                self.round = self.loop.call_soon(self.run_round)
+            else:
+                self.round = self.loop.call_later(min(waits), self.run_round)
@@ -0,0 +1,411 @@
+import collections
+import collections.abc
+import json
+import os
+import threading
+import time
+
+from sender_rdt import DEFAULT_CHUNK_SIZE, file_digest
+import wire
+
+# Format of the on-disk index, an index of another format is rebuilt
+INDEX_FORMAT = 2
+# Where the index of the shared files is kept between runs
+DEFAULT_INDEX_PATH = "share_index.json"
+# Most bytes of listing per INDEX page before compression, keeps a compressed
+# page of typical names to about one Ethernet frame
+INDEX_PAGE_BYTES = 3072
+# Most bytes an INDEX page may decompress to, its listing, header and one long line to spare
+MAX_PAGE_TEXT = 1 << 16
+# Codec INDEX pages are compressed with, zlib ships with every Python
+INDEX_CODEC = wire.find_codec('zlib')
+# Removed files remembered so index deltas can report them, older removals
+# are forgotten and clients that far behind get the full listing
+MAX_TOMBSTONES = 4096
+# Listings kept ready to send, one per version a client asked for changes since
+PAGE_CACHE_SIZE = 16
+
+
+def index_line(file_id, size, name):
+    """
+    Forms the line an INDEX page lists a file with
+
+    :param file_id: the file id
+    :type file_id: String
+    :param size: size of the file in bytes
+    :type size: int
+    :param name: name of the file relative to its shared directory
+    :type name: String
+    :return: "id<TAB>size<TAB>name"
+    :rtype: String
+    """
+    return f"{file_id}\t{size}\t{name}"
+
+def make_index_pages(etag, base, lines):
+    """
+    Splits a listing into INDEX pages. Each page is a compressed META packet
+    named "index" whose text starts with "<etag>,<base>,<page>,<pages>"
+    followed by a line per file. A line "-<id>" reports a removed file.
+
+    :param etag: version of the index the listing was taken at, "-" if it has none
+    :type etag: String
+    :param base: etag the listing holds the changes since, "-" for a full listing
+    :type base: String
+    :param lines: the listing, see index_line
+    :type lines: list
+    :return: the packets, at least one even for an empty listing
+    :rtype: list
+    """
+    pages = [[]]
+    size = 0
+    for line in lines:
+        length = len(line.encode()) + 1
+        if pages[-1] and size + length > INDEX_PAGE_BYTES:
+            pages.append([])
+            size = 0
+        pages[-1].append(line)
+        size += length
+    compress = wire.CODECS[INDEX_CODEC][1]
+    return [wire.encode_meta("index", compress("\n".join([f"{etag},{base},{number},{len(pages)}"] + page).encode()),
+                             INDEX_CODEC)
+            for number, page in enumerate(pages)]
+
+def read_index_page(data):
+    """
+    Reads an INDEX page made by make_index_pages
+
+    :param data: the datagram
+    :type data: bytes-like
+    :return: (etag, base, page number, page count, lines), or None if data
+        is not an intact INDEX page
+    :rtype: tuple
+    """
+    header = wire.parse_packet(data)
+    if header is None or header[0] != wire.PACKET_META:
+        return None
+    file_id, body = wire.decode_meta_raw(data)
+    codec = wire.CODECS.get(header[1])
+    if file_id != "index" or codec is None:
+        return None
+    try:
+        head, *lines = codec[2](body, MAX_PAGE_TEXT).decode().split("\n")
+        etag, base, number, count = head.split(",")
+        return etag, base, int(number), int(count), lines
+    except ValueError:
+        return None
+
+
+class ShareIndex(collections.abc.Mapping):
+    """
+    ShareIndex, the files this peer shares, found by scanning the configured
+    directories and kept in an index on disk between runs
+
+    Each file keeps the id it was first given for as long as it stays at the
+    same path. The index records the size, modification time and digest of
+    each file, so a rescan only stats the shares and re-hashes the files that changed,
+    and transfer setup reads the metadata from the index instead of the file.
+    Works as a read only mapping of file_id -> path.
+
+    Every change bumps the index version. Together with an epoch drawn when
+    the index is first created it forms the etag peers cache the listing
+    under, so an INDEX_REQ can ask for only what changed since.
+
+    Attributes:
+        directories: directories whose files are shared
+        index_path: file the index is saved to
+        chunk_size: number of bytes per chunk the metadata is given for
+        files: file_id -> entry dict with path, name, size, mtime_ns, digest
+            and the version it last changed at
+        ids: path -> file_id
+        next_id: number of the next id handed out
+        epoch: random tag of this index, changes if the index is rebuilt
+        version: number of changes made to the index
+        removed: file_id -> version it was removed at
+        floor: oldest version changes can still be listed since
+        page_cache: OrderedDict of base etag -> (version, INDEX pages)
+        lock: guards the index, scans run off the event loop
+    """
+
+    def __init__(self, directories=(), index_path=DEFAULT_INDEX_PATH, chunk_size=DEFAULT_CHUNK_SIZE):
+        """
+        Constructor for ShareIndex, nothing is read until load() or scan()
+
+        :param directories: directories whose files are shared
+        :type directories: list
+        :param index_path: file the index is saved to
+        :type index_path: String
+        :param chunk_size: number of bytes per chunk
+        :type chunk_size: int
+        """
+        self.directories = list(directories)
+        self.index_path = index_path
+        self.chunk_size = chunk_size
+        self.files = {}
+        self.ids = {}
+        self.next_id = 1
+        self.epoch = os.urandom(4).hex()
+        self.version = 0
+        self.removed = {}
+        self.floor = 0
+        self.page_cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+    def __getitem__(self, file_id):
+        return self.files[file_id]['path']
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.files))
+
+    def __len__(self):
+        return len(self.files)
+
+    def items(self):
+        """
+        Gives a snapshot of the shared files, safe to use while a scan runs
+
+        :return: list of (file_id, path)
+        :rtype: list
+        """
+        with self.lock:
+            return [(file_id, entry['path']) for file_id, entry in self.files.items()]
+
+    def load(self):
+        """
+        Reads the index saved by an earlier run. Entries are trusted until the
+        next scan, so the files can be served right away.
+
+        :return: number of files loaded
+        :rtype: int
+        """
+        try:
+            with open(self.index_path, 'r') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            print(f"[Shares] Ignoring unreadable index {self.index_path}: {e}")
+            return 0
+        if saved.get('format') != INDEX_FORMAT:
+            return 0
+        with self.lock:
+            self.next_id = saved.get('next_id', 1)
+            self.epoch = saved['epoch']
+            self.version = saved['version']
+            self.floor = saved['floor']
+            self.removed = saved['removed']
+            for file_id, entry in saved.get('files', {}).items():
+                # Indexes of earlier versions also kept piece hashes
+                entry.pop('pieces', None)
+                self.files[file_id] = entry
+                self.ids[entry['path']] = file_id
+            return len(self.files)
+
+    def save(self):
+        """
+        Writes the index to disk, replacing the old one only once the new one
+        is complete
+        """
+        with self.lock:
+            saved = {
+                'format': INDEX_FORMAT,
+                'next_id': self.next_id,
+                'epoch': self.epoch,
+                'version': self.version,
+                'floor': self.floor,
+                'removed': dict(self.removed),
+                'files': dict(self.files)
+            }
+            text = json.dumps(saved, separators=(',', ':'))
+        tmp = self.index_path + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, self.index_path)
+
+    def assign_id(self, path):
+        """
+        Gives the id of a path, handing out the next free one for a new path.
+        Must be called with lock held.
+
+        :param path: absolute path of the file
+        :type path: String
+        :return: the file id
+        :rtype: String
+        """
+        file_id = self.ids.get(path)
+        if file_id is None:
+            file_id = f"{self.next_id:03d}"
+            self.next_id += 1
+            self.ids[path] = file_id
+        return file_id
+
+    def index_file(self, path, name, st, file_id=None):
+        """
+        Hashes a file and records it in the index
+
+        :param path: absolute path of the file
+        :type path: String
+        :param name: name peers are shown the file by
+        :type name: String
+        :param st: os.stat result of the file taken before hashing
+        :type st: os.stat_result
+        :param file_id: id to share the file under, None to assign one
+        :type file_id: String
+        :return: the file id
+        :rtype: String
+        """
+        entry = {
+            'path': path,
+            'name': name,
+            'size': st.st_size,
+            'mtime_ns': st.st_mtime_ns,
+            'digest': file_digest(path)
+        }
+        with self.lock:
+            if file_id is None:
+                file_id = self.assign_id(path)
+            else:
+                self.ids[path] = file_id
+            self.version += 1
+            entry['version'] = self.version
+            self.removed.pop(file_id, None)
+            self.files[file_id] = entry
+        return file_id
+
+    def scan(self):
+        """
+        Brings the index up to date with the directories: new and modified
+        files are hashed, files whose size and modification time are
+        unchanged are kept as they are, and removed files are dropped. Blocks
+        while hashing, so run it off the event loop.
+
+        :return: (number of files shared, number of files hashed)
+        :rtype: tuple
+        """
+        started = time.time()
+        seen = set()
+        hashed = 0
+        for directory in self.directories:
+            directory = os.path.abspath(directory)
+            for root, dirs, names in os.walk(directory):
+                dirs[:] = sorted(d for d in dirs if not d.startswith('.'))
+                for name in sorted(names):
+                    if name.startswith('.'):
+                        continue
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except OSError:
+                        continue
+                    seen.add(path)
+                    with self.lock:
+                        file_id = self.ids.get(path)
+                        entry = self.files.get(file_id)
+                        if entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns:
+                            continue
+                    try:
+                        self.index_file(path, os.path.relpath(path, directory), st, file_id)
+                    except OSError as e:
+                        print(f"[Shares] Could not hash {path}: {e}")
+                        continue
+                    hashed += 1
+
+        with self.lock:
+            gone = [file_id for file_id, entry in self.files.items()
+                    if entry['path'] not in seen and not os.path.isfile(entry['path'])]
+            for file_id in gone:
+                del self.ids[self.files.pop(file_id)['path']]
+                self.version += 1
+                self.removed[file_id] = self.version
+            if len(self.removed) > MAX_TOMBSTONES:
+                # Forget the oldest half, clients older than that get a full listing
+                kept = sorted(self.removed.items(), key=lambda item: item[1])[MAX_TOMBSTONES // 2:]
+                self.floor = kept[0][1] - 1
+                self.removed = dict(kept)
+            count = len(self.files)
+        if hashed or gone:
+            self.save()
+        print(f"[Shares] {count} files shared, {hashed} hashed, {len(gone)} removed "
+              f"in {time.time() - started:.2f}s")
+        return count, hashed
+
+    def describe(self, file_id):
+        """
+        Gives the transfer metadata of a shared file from the index. Only the
+        file's size and modification time are checked, its content is not read.
+
+        :param file_id: the identifier of the file
+        :type file_id: String
+        :return: dictionary with size, chunk_size, chunk_count and digest,
+            or None if the file is not shared or changed since it was hashed
+        :rtype: dict
+        """
+        entry = self.files.get(file_id)
+        if entry is None:
+            return None
+        try:
+            st = os.stat(entry['path'])
+        except OSError:
+            return None
+        if entry['size'] != st.st_size or entry['mtime_ns'] != st.st_mtime_ns:
+            return None
+        return {
+            'size': entry['size'],
+            'chunk_size': self.chunk_size,
+            'chunk_count': (entry['size'] + self.chunk_size - 1) // self.chunk_size,
+            'digest': entry['digest']
+        }
+
+    def digests(self):
+        """
+        Gives the content digest of every shared file, as announced to the tracker
+
+        :return: file_id -> hex sha256 of the file
+        :rtype: dict
+        """
+        with self.lock:
+            return {file_id: entry['digest'] for file_id, entry in self.files.items()}
+
+    def etag(self):
+        """
+        :return: tag of the current version of the index, "<epoch>.<version>"
+        :rtype: String
+        """
+        return f"{self.epoch}.{self.version}"
+
+    def index_pages(self, since='-'):
+        """
+        Gives the INDEX pages answering a peer that has the listing as of
+        etag 'since'. Only files added, changed or removed after that version
+        are listed, or every file if 'since' is not a version this index can
+        list changes from. Pages are built once per version and base, so each
+        page request costs a lookup.
+
+        :param since: etag the peer holds, "-" for none
+        :type since: String
+        :return: the packets, see make_index_pages
+        :rtype: list
+        """
+        with self.lock:
+            cached = self.page_cache.get(since)
+            if cached and cached[0] == self.version:
+                self.page_cache.move_to_end(since)
+                return cached[1]
+            version = self.version
+            etag = self.etag()
+            epoch, _, seen = since.partition('.')
+            if epoch == self.epoch and seen.isdigit() and self.floor <= int(seen) <= version:
+                seen = int(seen)
+                base = since
+                lines = [index_line(file_id, entry['size'], entry['name'])
+                         for file_id, entry in self.files.items() if entry['version'] > seen]
+                lines += [f"-{file_id}" for file_id, removed in self.removed.items() if removed > seen]
+            else:
+                base = '-'
+                lines = [index_line(file_id, entry['size'], entry['name']) for file_id, entry in self.files.items()]
+        pages = make_index_pages(etag, base, sorted(lines))
+        with self.lock:
+            self.page_cache[since] = (version, pages)
+            while len(self.page_cache) > PAGE_CACHE_SIZE:
+                self.page_cache.popitem(last=False)
+        return pages
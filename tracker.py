@@ -0,0 +1,1241 @@
+import bisect
+import collections
+import hashlib
+import json
+import os
+import random
+import selectors
+import socket
+import struct
+import threading
+import time
+
+# Port the tracker listens on
+TRACKER_PORT = 9000
+# Seconds a registration lasts without a heartbeat
+DEFAULT_TTL = 60
+# Most peers listed in one PEERS or LOCATED reply
+MAX_PAGE = 512
+# Most content changes a peer sends in one ANNOUNCE
+ANNOUNCE_BATCH = 4096
+# Longest message either side accepts, anything longer is a broken stream
+MAX_FRAME = 1 << 20
+# Bytes read from a connection at a time
+RECV_SIZE = 1 << 16
+# Seconds between snapshots of a tracker's state, taken only if it changed
+SNAPSHOT_INTERVAL = 10
+# Version of the snapshot format, snapshots of other versions are ignored
+STATE_FORMAT = 1
+# Points each tracker gets on the hash ring, evens out how many keys each owns
+RING_POINTS = 64
+# Seconds a tracker that did not answer is passed over before it is tried again
+RETRY_DOWN = 30
+
+# Every message is framed by its length (of the type byte and body) and type
+FRAME = struct.Struct('!IB')
+# REGISTER and HEARTBEAT: ip, port, then for REGISTER the name
+ADDRESS = struct.Struct('!4sH')
+# GET_PEERS: mode, first peer, most peers
+GET_PEERS = struct.Struct('!BII')
+# PEERS: peers registered, first peer of the next page (0 when this is the
+# last), then for each peer an ENTRY followed by its name
+PEERS_HEADER = struct.Struct('!II')
+ENTRY = struct.Struct('!4sHB')
+# OK: the TTL registrations last, ERROR: followed by a message
+OK = struct.Struct('!I')
+# ANNOUNCE: ADDRESS, then for each change a CHANGE, the file id and, when
+# the file is added, the sha256 of its content
+CHANGE = struct.Struct('!BB')
+DIGEST_SIZE = 32
+# LOCATE: mode, most peers, then the file id or content digest looked for
+LOCATE = struct.Struct('!BH')
+# LOCATED: peers holding it, then for each of as many as asked an ENTRY,
+# its name, the id it holds the content under and the content digest
+LOCATED_HEADER = struct.Struct('!I')
+
+MSG_REGISTER = 1
+MSG_HEARTBEAT = 2
+MSG_LEAVE = 3
+MSG_GET_PEERS = 4
+MSG_PEERS = 5
+MSG_OK = 6
+MSG_ERROR = 7
+MSG_ANNOUNCE = 8
+MSG_LOCATE = 9
+MSG_LOCATED = 10
+
+# GET_PEERS modes
+PAGE = 0
+SAMPLE = 1
+
+# ANNOUNCE changes
+DROP = 0
+ADD = 1
+
+# LOCATE modes
+BY_ID = 0
+BY_DIGEST = 1
+
+
+class TrackerError(ConnectionError):
+    """
+    TrackerError, the tracker answered but refused a request or answered
+    with something unexpected, as opposed to not answering at all
+    """
+
+
+def frame(msg_type, body=b''):
+    """
+    Forms a tracker message
+
+    :param msg_type: one of the MSG_ types
+    :type msg_type: int
+    :param body: the message body
+    :type body: bytes
+    :return: the framed message
+    :rtype: bytes
+    """
+    return FRAME.pack(len(body) + 1, msg_type) + body
+
+def encode_address(ip, port):
+    """
+    :param ip: dotted IPv4 address
+    :type ip: String
+    :param port: UDP port of the peer
+    :type port: int
+    :return: the address as carried in REGISTER, HEARTBEAT and LEAVE
+    :rtype: bytes
+    """
+    return ADDRESS.pack(socket.inet_aton(ip), port)
+
+def decode_peers(body):
+    """
+    Reads the body of a PEERS reply
+
+    :param body: the body
+    :type body: bytes-like
+    :return: (peers registered, first peer of the next page or 0, list of (ip, port, name))
+    :rtype: tuple
+    """
+    total, next_start = PEERS_HEADER.unpack_from(body)
+    offset = PEERS_HEADER.size
+    peers = []
+    while offset < len(body):
+        ip, port, name_length = ENTRY.unpack_from(body, offset)
+        offset += ENTRY.size
+        name = bytes(body[offset:offset + name_length]).decode()
+        offset += name_length
+        peers.append((socket.inet_ntoa(ip), port, name))
+    return total, next_start, peers
+
+def decode_located(body):
+    """
+    Reads the body of a LOCATED reply
+
+    :param body: the body
+    :type body: bytes-like
+    :return: (peers holding the content, list of (ip, port, name, file id, hex digest))
+    :rtype: tuple
+    """
+    total, = LOCATED_HEADER.unpack_from(body)
+    offset = LOCATED_HEADER.size
+    holders = []
+    while offset < len(body):
+        ip, port, name_length = ENTRY.unpack_from(body, offset)
+        offset += ENTRY.size
+        name = bytes(body[offset:offset + name_length]).decode()
+        offset += name_length
+        id_length = body[offset]
+        file_id = bytes(body[offset + 1:offset + 1 + id_length]).decode()
+        offset += 1 + id_length
+        digest = bytes(body[offset:offset + DIGEST_SIZE]).hex()
+        offset += DIGEST_SIZE
+        holders.append((socket.inet_ntoa(ip), port, name, file_id, digest))
+    return total, holders
+
+
+class SampleSet:
+    """
+    SampleSet, a set that can also hand out a random sample of its members
+    in time proportional to the sample, however large the set
+
+    Attributes:
+        items: the members, in no particular order
+        positions: member -> its index in items
+    """
+
+    def __init__(self):
+        self.items = []
+        self.positions = {}
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item):
+        """
+        :param item: member to add, if not already one
+        :type item: hashable
+        """
+        if item not in self.positions:
+            self.positions[item] = len(self.items)
+            self.items.append(item)
+
+    def discard(self, item):
+        """
+        :param item: member to remove, if it is one
+        :type item: hashable
+        """
+        position = self.positions.pop(item, None)
+        if position is None:
+            return
+        # Fill its place with the last member so items stays dense
+        last = self.items.pop()
+        if last != item:
+            self.items[position] = last
+            self.positions[last] = position
+
+    def sample(self, count):
+        """
+        :param count: most members to pick
+        :type count: int
+        :return: up to 'count' members picked at random
+        :rtype: list
+        """
+        return random.sample(self.items, min(count, len(self.items)))
+
+
+class Tracker:
+    """
+    Tracker, keeps the peers registered in the network and lists them to
+    each other, serving every connection from one thread with a selector
+
+    Messages are length framed, so a peer may keep its connection open and
+    send any number of requests, each answered in order. A registration
+    expires unless renewed by a heartbeat within the TTL. Registrations are
+    kept in heartbeat order, so expiring them only ever looks at the oldest.
+    Each peer's entry is encoded once when it registers, and the peers are
+    also kept in a list so a page or a random sample of them costs only
+    what is sent.
+
+    Peers announce the files they share, by id and content digest, as
+    changes since their last announcement. The tracker keeps both inverted,
+    so finding who holds a file is one LOCATE round trip that returns a
+    random sample of its holders.
+
+    With a state file, the registrations and announced content are saved
+    there every SNAPSHOT_INTERVAL they changed and when the tracker stops,
+    and loaded again when it starts, so a restarted tracker answers right
+    away rather than after every peer has registered again. Restored peers
+    get a full TTL, heartbeats could not reach the tracker while it was down.
+
+    Attributes:
+        ttl: seconds a registration lasts without a heartbeat
+        state_path: file the state is saved to, None to keep it in memory only
+        dirty: the state changed since the last snapshot
+        peers: OrderedDict of (ip, port) -> [expiry time, position in slots, encoded entry,
+            file id -> content digest], least recently renewed first
+        slots: registered (ip, port), in no particular order
+        by_id: file id -> SampleSet of the (ip, port) sharing a file under that id
+        by_digest: content digest -> SampleSet of (ip, port, file id) sharing that content
+        selector: selector every socket is registered with
+        listener: listening socket
+        running: cleared by stop() to end serve_forever
+        registrations: REGISTER messages handled
+    """
+
+    def __init__(self, host='0.0.0.0', port=TRACKER_PORT, ttl=DEFAULT_TTL, state_path=None):
+        """
+        Constructor for Tracker, restores the saved state if any and starts
+        listening right away
+
+        :param host: address to listen on
+        :type host: String
+        :param port: TCP port to listen on, 0 for any
+        :type port: int
+        :param ttl: seconds a registration lasts without a heartbeat
+        :type ttl: int
+        :param state_path: file the state is saved to and restored from, None for none
+        :type state_path: String
+        """
+        self.ttl = ttl
+        self.peers = collections.OrderedDict()
+        self.slots = []
+        self.by_id = {}
+        self.by_digest = {}
+        self.state_path = state_path
+        self.dirty = False
+        self.last_snapshot = time.monotonic()
+        if state_path is not None:
+            self.load()
+        self.selector = selectors.DefaultSelector()
+        self.listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listener.bind((host, port))
+        self.listener.listen(1024)
+        self.listener.setblocking(False)
+        self.selector.register(self.listener, selectors.EVENT_READ)
+        self.running = True
+        self.registrations = 0
+
+    def register(self, key, name, now):
+        """
+        Adds a peer, or renews it and updates its name if already registered.
+        Either way the peer starts over with no content announced.
+
+        :param key: (ip, port) of the peer
+        :type key: tuple
+        :param name: name of the peer
+        :type name: String
+        :param now: current time.monotonic()
+        :type now: float
+        """
+        # At most 255 bytes, without cutting a character in half
+        name = name.encode()[:255].decode('utf-8', 'ignore').encode()
+        entry = ENTRY.pack(socket.inet_aton(key[0]), key[1], len(name)) + name
+        peer = self.peers.get(key)
+        if peer is None:
+            self.peers[key] = [now + self.ttl, len(self.slots), entry, {}]
+            self.slots.append(key)
+            print(f"[Tracker] Registered peer: {key[0]}:{key[1]}:{name.decode()}")
+        else:
+            peer[0] = now + self.ttl
+            peer[2] = entry
+            self.withdraw(key, peer[3], list(peer[3]))
+            self.peers.move_to_end(key)
+        self.registrations += 1
+        self.dirty = True
+
+    def heartbeat(self, key, now):
+        """
+        Renews a registration
+
+        :param key: (ip, port) of the peer
+        :type key: tuple
+        :param now: current time.monotonic()
+        :type now: float
+        :return: False if the peer is not registered, e.g. it already expired
+        :rtype: bool
+        """
+        peer = self.peers.get(key)
+        if peer is None:
+            return False
+        peer[0] = now + self.ttl
+        self.peers.move_to_end(key)
+        return True
+
+    def remove(self, key):
+        """
+        Drops a peer's registration
+
+        :param key: (ip, port) of the peer
+        :type key: tuple
+        """
+        peer = self.peers.pop(key, None)
+        if peer is None:
+            return
+        self.dirty = True
+        self.withdraw(key, peer[3], list(peer[3]))
+        # Fill its slot with the last peer so slots stays dense
+        last = self.slots.pop()
+        if last != key:
+            self.slots[peer[1]] = last
+            self.peers[last][1] = peer[1]
+
+    def withdraw(self, key, content, file_ids):
+        """
+        Takes files out of a peer's announced content and the inverted indexes
+
+        :param key: (ip, port) of the peer
+        :type key: tuple
+        :param content: the peer's file id -> content digest
+        :type content: dict
+        :param file_ids: ids of the files to take out
+        :type file_ids: list
+        """
+        for file_id in file_ids:
+            digest = content.pop(file_id, None)
+            if digest is None:
+                continue
+            holders = self.by_id[file_id]
+            holders.discard(key)
+            if not holders:
+                del self.by_id[file_id]
+            holders = self.by_digest[digest]
+            holders.discard(key + (file_id,))
+            if not holders:
+                del self.by_digest[digest]
+
+    def announce(self, key, body, offset):
+        """
+        Applies the content changes of an ANNOUNCE
+
+        :param key: (ip, port) of the peer
+        :type key: tuple
+        :param body: the message body
+        :type body: bytes-like
+        :param offset: where the changes start in body
+        :type offset: int
+        :return: False if the peer is not registered
+        :rtype: bool
+        """
+        peer = self.peers.get(key)
+        if peer is None:
+            return False
+        content = peer[3]
+        while offset < len(body):
+            self.dirty = True
+            change, id_length = CHANGE.unpack_from(body, offset)
+            offset += CHANGE.size
+            file_id = bytes(body[offset:offset + id_length]).decode()
+            offset += id_length
+            # A changed file is withdrawn and added again
+            self.withdraw(key, content, [file_id])
+            if change == ADD:
+                digest = bytes(body[offset:offset + DIGEST_SIZE])
+                if len(digest) != DIGEST_SIZE:
+                    raise struct.error("truncated digest")
+                offset += DIGEST_SIZE
+                self.add_file(key, content, file_id, digest)
+        return True
+
+    def add_file(self, key, content, file_id, digest):
+        """
+        Adds a file to a peer's announced content and the inverted indexes
+
+        :param key: (ip, port) of the peer
+        :type key: tuple
+        :param content: the peer's file id -> content digest
+        :type content: dict
+        :param file_id: id of the file
+        :type file_id: String
+        :param digest: sha256 of its content
+        :type digest: bytes
+        """
+        content[file_id] = digest
+        self.by_id.setdefault(file_id, SampleSet()).add(key)
+        self.by_digest.setdefault(digest, SampleSet()).add(key + (file_id,))
+
+    def locate(self, mode, count, value):
+        """
+        Forms the body of a LOCATED reply
+
+        :param mode: BY_ID to look for a file id, BY_DIGEST for content
+        :type mode: int
+        :param count: most holders to list, capped at MAX_PAGE
+        :type count: int
+        :param value: the file id, or the content digest
+        :type value: bytes
+        :return: the body
+        :rtype: bytes
+        """
+        count = min(count, MAX_PAGE)
+        if mode == BY_DIGEST:
+            holders = self.by_digest.get(value)
+            found = [(key[:2], key[2], value) for key in holders.sample(count)] if holders else []
+        else:
+            file_id = value.decode()
+            holders = self.by_id.get(file_id)
+            found = [(key, file_id, self.peers[key][3][file_id]) for key in holders.sample(count)] if holders else []
+        parts = [LOCATED_HEADER.pack(len(holders) if holders else 0)]
+        for key, file_id, digest in found:
+            id_bytes = file_id.encode()
+            parts += [self.peers[key][2], bytes([len(id_bytes)]), id_bytes, digest]
+        return b''.join(parts)
+
+    def snapshot(self):
+        """
+        Writes the registrations and announced content to the state file,
+        replacing the old one only once the new one is complete
+        """
+        peers = [[ip, port, bytes(peer[2][ENTRY.size:]).decode(),
+                  {file_id: digest.hex() for file_id, digest in peer[3].items()}]
+                 for (ip, port), peer in self.peers.items()]
+        text = json.dumps({'format': STATE_FORMAT, 'peers': peers}, separators=(',', ':'))
+        tmp = self.state_path + ".tmp"
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.replace(tmp, self.state_path)
+        self.dirty = False
+        self.last_snapshot = time.monotonic()
+
+    def load(self):
+        """
+        Restores the state saved by an earlier run
+
+        :return: number of peers restored
+        :rtype: int
+        """
+        try:
+            with open(self.state_path, 'r') as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return 0
+        except (OSError, ValueError) as e:
+            print(f"[Tracker] Ignoring unreadable state {self.state_path}: {e}")
+            return 0
+        if saved.get('format') != STATE_FORMAT:
+            return 0
+        start = time.perf_counter()
+        expiry = time.monotonic() + self.ttl
+        for ip, port, name, files in saved['peers']:
+            key = (ip, port)
+            name = name.encode()
+            entry = ENTRY.pack(socket.inet_aton(ip), port, len(name)) + name
+            content = {}
+            self.peers[key] = [expiry, len(self.slots), entry, content]
+            self.slots.append(key)
+            for file_id, digest in files.items():
+                self.add_file(key, content, file_id, bytes.fromhex(digest))
+        print(f"[Tracker] Restored {len(self.peers)} peers and {len(self.by_digest)} files "
+              f"from {self.state_path} in {time.perf_counter() - start:.2f}s")
+        return len(self.peers)
+
+    def expire(self, now):
+        """
+        Drops every registration whose TTL ran out
+
+        :param now: current time.monotonic()
+        :type now: float
+        """
+        while self.peers:
+            key, peer = next(iter(self.peers.items()))
+            if peer[0] > now:
+                break
+            self.remove(key)
+            print(f"[Tracker] Expired peer: {key[0]}:{key[1]}")
+
+    def list_peers(self, mode, start, count):
+        """
+        Forms the body of a PEERS reply
+
+        :param mode: PAGE for the peers from 'start' on, SAMPLE for a random sample
+        :type mode: int
+        :param start: first peer of the page
+        :type start: int
+        :param count: most peers to list, capped at MAX_PAGE
+        :type count: int
+        :return: the body
+        :rtype: bytes
+        """
+        count = min(count, MAX_PAGE)
+        if mode == SAMPLE:
+            keys = random.sample(self.slots, min(count, len(self.slots)))
+            next_start = 0
+        else:
+            keys = self.slots[start:start + count]
+            next_start = start + count if start + count < len(self.slots) else 0
+        return PEERS_HEADER.pack(len(self.slots), next_start) + b''.join(self.peers[key][2] for key in keys)
+
+    def handle_message(self, msg_type, body, now):
+        """
+        Answers one message
+
+        :param msg_type: one of the MSG_ types
+        :type msg_type: int
+        :param body: the message body
+        :type body: bytes-like
+        :param now: current time.monotonic()
+        :type now: float
+        :return: the framed reply
+        :rtype: bytes
+        """
+        try:
+            if msg_type == MSG_GET_PEERS:
+                return frame(MSG_PEERS, self.list_peers(*GET_PEERS.unpack_from(body)))
+            if msg_type == MSG_LOCATE:
+                mode, count = LOCATE.unpack_from(body)
+                return frame(MSG_LOCATED, self.locate(mode, count, bytes(body[LOCATE.size:])))
+            ip, port = ADDRESS.unpack_from(body)
+            key = (socket.inet_ntoa(ip), port)
+            if msg_type == MSG_REGISTER:
+                self.register(key, bytes(body[ADDRESS.size:]).decode(), now)
+            elif msg_type == MSG_HEARTBEAT:
+                if not self.heartbeat(key, now):
+                    return frame(MSG_ERROR, b"not registered")
+            elif msg_type == MSG_ANNOUNCE:
+                if not self.announce(key, body, ADDRESS.size):
+                    return frame(MSG_ERROR, b"not registered")
+            elif msg_type == MSG_LEAVE:
+                self.remove(key)
+            else:
+                return frame(MSG_ERROR, b"unknown message")
+            return frame(MSG_OK, OK.pack(self.ttl))
+        except (struct.error, UnicodeDecodeError):
+            return frame(MSG_ERROR, b"malformed message")
+
+    def accept(self):
+        """
+        Accepts every pending connection
+        """
+        while True:
+            try:
+                conn, _ = self.listener.accept()
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as e:
+                # Out of descriptors, try again on the next round
+                print(f"[Tracker] Accept failed: {e}")
+                return
+            conn.setblocking(False)
+            self.selector.register(conn, selectors.EVENT_READ, {'in': bytearray(), 'out': bytearray()})
+
+    def close_connection(self, conn):
+        """
+        Forgets a connection and closes it
+
+        :param conn: the connection
+        :type conn: socket.socket
+        """
+        self.selector.unregister(conn)
+        conn.close()
+
+    def read(self, conn, state, now):
+        """
+        Reads what a connection sent and answers every complete message
+
+        :param conn: the connection
+        :type conn: socket.socket
+        :param state: buffers of the connection, {'in', 'out'}
+        :type state: dict
+        :param now: current time.monotonic()
+        :type now: float
+        """
+        try:
+            data = conn.recv(RECV_SIZE)
+        except (BlockingIOError, InterruptedError):
+            return
+        except OSError:
+            data = b''
+        if not data:
+            self.close_connection(conn)
+            return
+        buf = state['in']
+        buf += data
+        view = memoryview(buf)
+        offset = 0
+        while len(buf) - offset >= FRAME.size:
+            length, msg_type = FRAME.unpack_from(buf, offset)
+            if not 1 <= length <= MAX_FRAME:
+                view.release()
+                self.close_connection(conn)
+                return
+            end = offset + 4 + length
+            if end > len(buf):
+                break
+            state['out'] += self.handle_message(msg_type, view[offset + FRAME.size:end], now)
+            offset = end
+        view.release()
+        del buf[:offset]
+        self.write(conn, state)
+
+    def write(self, conn, state):
+        """
+        Sends as much of a connection's pending replies as it takes, and
+        waits for it to be writable while some remain
+
+        :param conn: the connection
+        :type conn: socket.socket
+        :param state: buffers of the connection, {'in', 'out'}
+        :type state: dict
+        """
+        out = state['out']
+        if out:
+            try:
+                sent = conn.send(out)
+            except (BlockingIOError, InterruptedError):
+                sent = 0
+            except OSError:
+                self.close_connection(conn)
+                return
+            del out[:sent]
+        events = selectors.EVENT_READ | (selectors.EVENT_WRITE if out else 0)
+        if self.selector.get_key(conn).events != events:
+            self.selector.modify(conn, events, state)
+
+    def serve_forever(self):
+        """
+        Serves connections and expires registrations until stop() is called
+        """
+        print(f"[Tracker] Running on {self.listener.getsockname()[0]}:{self.listener.getsockname()[1]}")
+        print("[Tracker] Waiting for peers to connect...")
+        try:
+            while self.running:
+                events = self.selector.select(timeout=1.0)
+                now = time.monotonic()
+                for key, mask in events:
+                    if key.data is None:
+                        self.accept()
+                        continue
+                    if mask & selectors.EVENT_READ:
+                        self.read(key.fileobj, key.data, now)
+                    if mask & selectors.EVENT_WRITE and key.fileobj.fileno() != -1:
+                        self.write(key.fileobj, key.data)
+                self.expire(now)
+                if self.state_path and self.dirty and now - self.last_snapshot >= SNAPSHOT_INTERVAL:
+                    self.snapshot()
+        finally:
+            # Also on Ctrl+C, so a restart loses nothing
+            if self.state_path and self.dirty:
+                self.snapshot()
+            for key in list(self.selector.get_map().values()):
+                key.fileobj.close()
+            self.selector.close()
+
+    def stop(self):
+        """
+        Makes serve_forever return within a second
+        """
+        self.running = False
+
+
+class TrackerClient:
+    """
+    TrackerClient, a peer's connection to the tracker, kept open between
+    requests and reopened if it breaks. Safe to use from several threads.
+
+    Attributes:
+        address: (host, port) of the tracker
+        timeout: seconds to wait for the tracker
+        sock: the connection, None while closed
+        registration: (ip, port, name) last registered, renewed by heartbeat()
+        ttl: seconds the tracker keeps a registration without a heartbeat
+        announced: file id -> hex content digest the tracker has from us
+        lock: one request at a time on the connection
+        announce_lock: one announce() at a time
+    """
+
+    def __init__(self, host='127.0.0.1', port=TRACKER_PORT, timeout=5.0):
+        """
+        Constructor for TrackerClient, connects on the first request
+
+        :param host: address of the tracker
+        :type host: String
+        :param port: TCP port of the tracker
+        :type port: int
+        :param timeout: seconds to wait for the tracker
+        :type timeout: float
+        """
+        self.address = (host, port)
+        self.timeout = timeout
+        self.sock = None
+        self.registration = None
+        self.ttl = DEFAULT_TTL
+        self.announced = {}
+        self.lock = threading.Lock()
+        self.announce_lock = threading.Lock()
+
+    def close(self):
+        """
+        Closes the connection, the next request opens a new one
+        """
+        with self.lock:
+            if self.sock is not None:
+                self.sock.close()
+                self.sock = None
+
+    def receive(self, size):
+        """
+        Reads exactly 'size' bytes of a reply
+
+        :param size: number of bytes
+        :type size: int
+        :return: the bytes
+        :rtype: bytearray
+        """
+        buf = bytearray(size)
+        view = memoryview(buf)
+        got = 0
+        while got < size:
+            n = self.sock.recv_into(view[got:])
+            if not n:
+                raise ConnectionError("tracker closed the connection")
+            got += n
+        return buf
+
+    def request(self, msg_type, body=b''):
+        """
+        Sends a message and waits for the reply, reconnecting once if the
+        connection was broken
+
+        :param msg_type: one of the MSG_ types
+        :type msg_type: int
+        :param body: the message body
+        :type body: bytes
+        :return: (reply type, reply body)
+        :rtype: tuple
+        """
+        with self.lock:
+            for attempt in range(2):
+                try:
+                    if self.sock is None:
+                        self.sock = socket.create_connection(self.address, self.timeout)
+                    self.sock.sendall(frame(msg_type, body))
+                    length, reply_type = FRAME.unpack(self.receive(FRAME.size))
+                    if not 1 <= length <= MAX_FRAME:
+                        raise ConnectionError("malformed reply from tracker")
+                    return reply_type, self.receive(length - 1)
+                except OSError:
+                    if self.sock is not None:
+                        self.sock.close()
+                        self.sock = None
+                    if attempt:
+                        raise
+
+    def expect_ok(self, reply):
+        """
+        Checks that the tracker accepted a request
+
+        :param reply: (reply type, reply body) from request()
+        :type reply: tuple
+        :return: seconds the tracker keeps a registration without a heartbeat
+        :rtype: int
+        """
+        reply_type, body = reply
+        if reply_type == MSG_ERROR:
+            raise TrackerError(f"tracker refused: {body.decode(errors='replace')}")
+        if reply_type != MSG_OK:
+            raise TrackerError("unexpected reply from tracker")
+        self.ttl = OK.unpack_from(body)[0]
+        return self.ttl
+
+    def register(self, ip, port, name):
+        """
+        Registers this peer
+
+        :param ip: dotted IPv4 address other peers reach us at
+        :type ip: String
+        :param port: our UDP port
+        :type port: int
+        :param name: our peer name
+        :type name: String
+        :return: seconds the registration lasts without a heartbeat
+        :rtype: int
+        """
+        ttl = self.expect_ok(self.request(MSG_REGISTER, encode_address(ip, port) + name.encode()))
+        self.registration = (ip, port, name)
+        # The tracker forgets what a registering peer announced before
+        self.announced = {}
+        return ttl
+
+    def heartbeat(self):
+        """
+        Renews our registration, registering again if it already expired
+
+        :return: seconds the registration lasts without a heartbeat
+        :rtype: int
+        """
+        ip, port, name = self.registration
+        reply = self.request(MSG_HEARTBEAT, encode_address(ip, port))
+        if reply[0] == MSG_ERROR:
+            return self.register(ip, port, name)
+        return self.expect_ok(reply)
+
+    def leave(self):
+        """
+        Drops our registration
+        """
+        if self.registration is not None:
+            self.expect_ok(self.request(MSG_LEAVE, encode_address(*self.registration[:2])))
+            self.registration = None
+
+    def peers(self, limit=None, sample=False):
+        """
+        Lists registered peers, a page at a time
+
+        :param limit: most peers to list, None for all
+        :type limit: int
+        :param sample: pick them at random rather than in the tracker's order,
+            at most MAX_PAGE of them
+        :type sample: bool
+        :return: list of (ip, port, name)
+        :rtype: list
+        """
+        if sample:
+            reply_type, body = self.request(MSG_GET_PEERS, GET_PEERS.pack(SAMPLE, 0, limit or MAX_PAGE))
+            if reply_type != MSG_PEERS:
+                raise TrackerError("unexpected reply from tracker")
+            return decode_peers(body)[2]
+        found = []
+        start = 0
+        while limit is None or len(found) < limit:
+            count = MAX_PAGE if limit is None else min(MAX_PAGE, limit - len(found))
+            reply_type, body = self.request(MSG_GET_PEERS, GET_PEERS.pack(PAGE, start, count))
+            if reply_type != MSG_PEERS:
+                raise TrackerError("unexpected reply from tracker")
+            _, start, page = decode_peers(body)
+            found += page
+            if not start:
+                break
+        return found
+
+    def announce(self, content):
+        """
+        Brings the tracker's record of what we share up to date with
+        'content', sending only what changed since the last announcement.
+        Everything is sent again if our registration had expired.
+
+        :param content: file id -> hex sha256 of the content of every file we serve
+        :type content: dict
+        :return: number of changes sent
+        :rtype: int
+        """
+        with self.announce_lock:
+            for attempt in range(2):
+                changes = [(file_id, digest) for file_id, digest in content.items()
+                           if self.announced.get(file_id) != digest]
+                changes += [(file_id, None) for file_id in self.announced if file_id not in content]
+                address = encode_address(*self.registration[:2])
+                for first in range(0, len(changes), ANNOUNCE_BATCH):
+                    batch = changes[first:first + ANNOUNCE_BATCH]
+                    parts = [address]
+                    for file_id, digest in batch:
+                        id_bytes = file_id.encode()
+                        parts.append(CHANGE.pack(DROP if digest is None else ADD, len(id_bytes)) + id_bytes)
+                        if digest is not None:
+                            parts.append(bytes.fromhex(digest))
+                    reply = self.request(MSG_ANNOUNCE, b''.join(parts))
+                    if reply[0] == MSG_ERROR and not attempt:
+                        break
+                    self.expect_ok(reply)
+                    for file_id, digest in batch:
+                        if digest is None:
+                            del self.announced[file_id]
+                        else:
+                            self.announced[file_id] = digest
+                else:
+                    return len(changes)
+                # Our registration expired, register again and send everything
+                self.register(*self.registration)
+
+    def locate(self, file_id=None, digest=None, limit=MAX_PAGE):
+        """
+        Asks the tracker who shares a file
+
+        :param file_id: id of the file
+        :type file_id: String
+        :param digest: hex sha256 of the content, looked for instead of file_id if given
+        :type digest: String
+        :param limit: most holders to list, picked at random when there are more
+        :type limit: int
+        :return: list of (ip, port, name, file id, hex digest)
+        :rtype: list
+        """
+        if digest is not None:
+            body = LOCATE.pack(BY_DIGEST, limit) + bytes.fromhex(digest)
+        else:
+            body = LOCATE.pack(BY_ID, limit) + file_id.encode()
+        reply_type, body = self.request(MSG_LOCATE, body)
+        if reply_type != MSG_LOCATED:
+            raise TrackerError("unexpected reply from tracker")
+        return decode_located(body)[1]
+
+
+def ring_hash(text):
+    """
+    :param text: key or tracker point to place on the ring
+    :type text: String
+    :return: its position on the ring
+    :rtype: int
+    """
+    return int.from_bytes(hashlib.sha1(text.encode()).digest()[:8], 'big')
+
+
+class TrackerRing:
+    """
+    TrackerRing, consistent hashing of keys onto a set of trackers
+
+    Each tracker is placed at RING_POINTS points of the ring, and a key is
+    owned by the tracker at the first point after it. Adding or removing a
+    tracker only moves the keys next to its own points. The trackers after
+    the owner, in ring order, take over its keys while it is down.
+
+    Attributes:
+        addresses: (host, port) of every tracker
+        points: (position, tracker address), sorted by position
+        positions: the positions alone, for bisect
+    """
+
+    def __init__(self, addresses, points=RING_POINTS):
+        """
+        Constructor for TrackerRing
+
+        :param addresses: (host, port) of every tracker
+        :type addresses: list
+        :param points: points each tracker gets on the ring
+        :type points: int
+        """
+        self.addresses = list(dict.fromkeys(addresses))
+        self.points = sorted((ring_hash(f"{host}:{port}#{i}"), (host, port))
+                             for host, port in self.addresses for i in range(points))
+        self.positions = [position for position, _ in self.points]
+
+    def owners(self, key):
+        """
+        :param key: the key
+        :type key: String
+        :return: every tracker address, in the order they are tried for key,
+            its owner first
+        :rtype: list
+        """
+        first = bisect.bisect(self.positions, ring_hash(key))
+        found = []
+        for i in range(len(self.points)):
+            address = self.points[(first + i) % len(self.points)][1]
+            if address not in found:
+                found.append(address)
+                if len(found) == len(self.addresses):
+                    break
+        return found
+
+
+class TrackerCluster:
+    """
+    TrackerCluster, a peer's connections to a set of trackers that split
+    the peers and files between them by consistent hashing, used just like
+    a TrackerClient
+
+    A peer registers with the tracker owning "peer:<ip>:<port>", and each
+    file it serves is announced to the trackers owning "id:<file id>" and
+    "digest:<hex digest>", so a LOCATE goes to a single tracker. A peer also
+    registers with every tracker it announces to, so its files expire there
+    with it. Peer lists are merged from every tracker.
+
+    A tracker that does not answer is passed over for RETRY_DOWN, its keys
+    falling to the next tracker on the ring. Once it answers again, the peer
+    registers with it again and moves its keys back.
+
+    Attributes:
+        ring: TrackerRing of the trackers
+        clients: tracker address -> TrackerClient
+        down: tracker address -> time.monotonic() it may be tried again
+        registered: addresses of the trackers we registered with
+        registration: (ip, port, name) last registered, renewed by heartbeat()
+        lock: guards down and registered
+        announce_lock: one announce() at a time
+    """
+
+    def __init__(self, addresses, timeout=5.0):
+        """
+        Constructor for TrackerCluster, connects to each tracker on its first request
+
+        :param addresses: (host, port) of every tracker
+        :type addresses: list
+        :param timeout: seconds to wait for a tracker
+        :type timeout: float
+        """
+        self.ring = TrackerRing(addresses)
+        self.clients = {address: TrackerClient(address[0], address[1], timeout) for address in self.ring.addresses}
+        self.down = {}
+        self.registered = set()
+        self.registration = None
+        self.lock = threading.Lock()
+        self.announce_lock = threading.Lock()
+
+    @property
+    def ttl(self):
+        """
+        :return: seconds the trackers keep a registration without a heartbeat
+        :rtype: int
+        """
+        return min(client.ttl for client in self.clients.values())
+
+    def live(self, key):
+        """
+        :param key: the key
+        :type key: String
+        :return: addresses of the trackers to try for key, those not known
+            to be down first, in ring order
+        :rtype: list
+        """
+        now = time.monotonic()
+        owners = self.ring.owners(key)
+        with self.lock:
+            return ([address for address in owners if self.down.get(address, 0) <= now] +
+                    [address for address in owners if self.down.get(address, 0) > now])
+
+    def failed(self, address, e):
+        """
+        Passes over a tracker that did not answer for RETRY_DOWN
+
+        :param address: (host, port) of the tracker
+        :type address: tuple
+        :param e: the error
+        :type e: OSError
+        """
+        with self.lock:
+            self.down[address] = time.monotonic() + RETRY_DOWN
+            self.registered.discard(address)
+        print(f"[Error] Tracker {address[0]}:{address[1]} did not answer, trying the next one: {e}")
+
+    def call(self, key, request):
+        """
+        Makes a request of the tracker owning key, or of the next one on the
+        ring that answers
+
+        :param key: the key
+        :type key: String
+        :param request: called with the TrackerClient to ask
+        :type request: callable
+        :return: what request returned
+        """
+        error = None
+        for address in self.live(key):
+            try:
+                return request(self.clients[address])
+            except TrackerError:
+                raise
+            except OSError as e:
+                self.failed(address, e)
+                error = e
+        raise error
+
+    def join(self, address):
+        """
+        Registers with a tracker unless we already are
+
+        :param address: (host, port) of the tracker
+        :type address: tuple
+        """
+        if address not in self.registered:
+            self.clients[address].register(*self.registration)
+            with self.lock:
+                self.registered.add(address)
+
+    def register(self, ip, port, name):
+        """
+        Registers this peer with the tracker owning it
+
+        :param ip: dotted IPv4 address other peers reach us at
+        :type ip: String
+        :param port: our UDP port
+        :type port: int
+        :param name: our peer name
+        :type name: String
+        :return: seconds the registration lasts without a heartbeat
+        :rtype: int
+        """
+        self.registration = (ip, port, name)
+        with self.lock:
+            self.registered.clear()
+
+        def home(client):
+            self.join(client.address)
+            return client.ttl
+
+        return self.call(f"peer:{ip}:{port}", home)
+
+    def heartbeat(self):
+        """
+        Renews our registration with every tracker we registered with, and
+        registers with a tracker that took over for ours while it is down
+
+        :return: seconds the registration lasts without a heartbeat
+        :rtype: int
+        """
+        for address in list(self.registered):
+            try:
+                self.clients[address].heartbeat()
+            except TrackerError:
+                raise
+            except OSError as e:
+                self.failed(address, e)
+        ip, port, _ = self.registration
+        return self.call(f"peer:{ip}:{port}", lambda client: self.join(client.address) or client.ttl)
+
+    def leave(self):
+        """
+        Drops our registration with every tracker
+        """
+        for address in list(self.registered):
+            try:
+                self.clients[address].leave()
+            except OSError:
+                pass
+        self.registered.clear()
+        self.registration = None
+
+    def peers(self, limit=None, sample=False):
+        """
+        Lists registered peers, merged from every tracker that answers
+
+        :param limit: most peers to list, None for all
+        :type limit: int
+        :param sample: pick them at random rather than in the trackers' order
+        :type sample: bool
+        :return: list of (ip, port, name)
+        :rtype: list
+        """
+        found = {}
+        error = None
+        for address, client in self.clients.items():
+            if self.down.get(address, 0) > time.monotonic():
+                continue
+            try:
+                for ip, port, name in client.peers(limit, sample):
+                    found[(ip, port)] = (ip, port, name)
+            except TrackerError:
+                raise
+            except OSError as e:
+                self.failed(address, e)
+                error = e
+        if not found and error is not None:
+            raise error
+        found = list(found.values())
+        if limit is not None and len(found) > limit:
+            found = random.sample(found, limit) if sample else found[:limit]
+        return found
+
+    def announce(self, content):
+        """
+        Brings each tracker's record of what we share up to date with
+        'content', sending only what changed since the last announcement.
+        Files whose tracker does not answer go to the next one on the ring.
+
+        :param content: file id -> hex sha256 of the content of every file we serve
+        :type content: dict
+        :return: number of changes sent
+        :rtype: int
+        """
+        with self.announce_lock:
+            sent = 0
+            for _ in self.clients:
+                shares = {}
+                for file_id, digest in content.items():
+                    for key in (f"id:{file_id}", f"digest:{digest}"):
+                        shares.setdefault(self.live(key)[0], {})[file_id] = digest
+                retry = False
+                for address, client in self.clients.items():
+                    share = shares.get(address, {})
+                    if not share and not client.announced:
+                        continue
+                    if not share and address not in self.registered:
+                        # Forgot us while it was down, nothing to take back
+                        client.announced = {}
+                        continue
+                    try:
+                        self.join(address)
+                        sent += client.announce(share)
+                    except TrackerError:
+                        raise
+                    except OSError as e:
+                        self.failed(address, e)
+                        retry = True
+                if not retry:
+                    break
+            return sent
+
+    def locate(self, file_id=None, digest=None, limit=MAX_PAGE):
+        """
+        Asks the tracker owning a file who shares it
+
+        :param file_id: id of the file
+        :type file_id: String
+        :param digest: hex sha256 of the content, looked for instead of file_id if given
+        :type digest: String
+        :param limit: most holders to list, picked at random when there are more
+        :type limit: int
+        :return: list of (ip, port, name, file id, hex digest)
+        :rtype: list
+        """
+        key = f"digest:{digest}" if digest is not None else f"id:{file_id}"
+        return self.call(key, lambda client: client.locate(file_id, digest, limit))
@@ -0,0 +1,481 @@
+import functools
+import socket
+import struct
+import zlib
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#
+# Wire format shared by every packet peers exchange:
+#
+#   checksum (4, crc32 of everything after it) | type (1) | flags (1) | body
+#
+# META     body = id length (2) | file id | metadata text
+# DATA     body = handle (2) | seq (4, signed) | chunk
+# ACK      body = handle (2) | cum_ack (4, signed) | rwnd (2) | sack length (2) | sack bitmap
+# CONTROL  body = UTF-8 text such as "EXCH_REQ:001,127.0.0.1:9999"
+# PARITY   body = handle (2) | first seq (4, signed) | n (1) | k (1) | j (1) | XOR of chunks
+#
+# Parity packets are forward error correction for a group of n DATA packets
+# starting at first seq. Parity j is the XOR of the group's uncompressed
+# chunks at positions j, j + k, j + 2k, ..., each padded with zeros to the
+# chunk size, so a receiver missing one of them rebuilds it without waiting
+# for a retransmission, and any burst of up to k lost packets is recovered.
+#
+# The flags of a META packet name the codec its stream compresses chunks
+# with, 0 for none. A DATA packet whose chunk was compressed sets
+# FLAG_COMPRESSED, chunks that would not shrink are sent as they are.
+#
+# A transfer opens with a META packet naming its file. The receiver answers
+# with an ACK carrying a small numeric handle for the stream, and from then on
+# DATA packets (including the FIN, seq -1) and ACKs only carry that handle.
+#
+# All integers are big endian. Headers are packed straight into preallocated
+# buffers and parsed from memoryviews, so the per-packet path only copies
+# chunk data once, from the file into the send buffer.
+#
+
+PACKET_DATA = 1
+PACKET_ACK = 2
+PACKET_CONTROL = 3
+PACKET_META = 4
+PACKET_PARITY = 5
+
+COMMON = struct.Struct('!IBB')
+META = struct.Struct('!IBBH')
+DATA = struct.Struct('!IBBHi')
+ACK = struct.Struct('!IBBHiHH')
+PARITY = struct.Struct('!IBBHiBBB')
+CHECKSUM = struct.Struct('!I')
+# Smallest packet of each type, anything shorter is dropped by parse_packet
+HEADER_SIZES = {
+    PACKET_DATA: DATA.size,
+    PACKET_ACK: ACK.size,
+    PACKET_CONTROL: COMMON.size,
+    PACKET_META: META.size,
+    PACKET_PARITY: PARITY.size
+}
+
+# Largest datagram a socket is read into
+MAX_DATAGRAM = 65535
+# Stream handles run from 1 to MAX_HANDLE, 0 means the stream has none
+MAX_HANDLE = 0xFFFF
+# DATA flag set when the chunk is compressed with the stream's codec
+FLAG_COMPRESSED = 0x01
+
+# Codec id -> (name, compress, decompress), see register_codec
+CODECS = {}
+
+
+def register_codec(codec_id, name, compress, decompress):
+    """
+    Makes a chunk codec available to transfers. Peers name codecs in
+    EXCH_REQ, ids only travel in META flags, so both must agree on the pair.
+
+    :param codec_id: id from 1 to 255 carried in META flags
+    :type codec_id: int
+    :param name: name peers ask for the codec by, e.g. "zlib"
+    :type name: String
+    :param compress: function from a bytes-like chunk to compressed bytes
+    :type compress: callable
+    :param decompress: function from compressed bytes and the most bytes the
+        output may take back to the chunk, raising ValueError if the data is
+        corrupt or would decompress to more, so a tiny packet cannot expand
+        to gigabytes
+    :type decompress: callable
+    """
+    CODECS[codec_id] = (name, compress, decompress)
+
+def codec_names():
+    """
+    :return: names of the available codecs, most preferred first
+    :rtype: list
+    """
+    return [CODECS[codec_id][0] for codec_id in sorted(CODECS, reverse=True)]
+
+def find_codec(name):
+    """
+    :param name: codec name from an EXCH_REQ
+    :type name: String
+    :return: id of the codec, None if it is not available here
+    :rtype: int
+    """
+    for codec_id, codec in CODECS.items():
+        if codec[0] == name:
+            return codec_id
+    return None
+
+def zlib_decompress(data, limit):
+    """
+    :param data: zlib compressed bytes
+    :type data: bytes-like
+    :param limit: most bytes the output may take
+    :type limit: int
+    :return: the decompressed bytes
+    :rtype: bytes
+    """
+    try:
+        out = zlib.decompressobj().decompress(data, limit + 1)
+    except zlib.error as e:
+        raise ValueError(str(e))
+    if len(out) > limit:
+        raise ValueError(f"decompresses to more than {limit} bytes")
+    return out
+
+def zstd_decompress(data, limit):
+    """
+    :param data: zstd compressed bytes
+    :type data: bytes-like
+    :param limit: most bytes the output may take
+    :type limit: int
+    :return: the decompressed bytes
+    :rtype: bytes
+    """
+    try:
+        # A frame that states its size is decompressed into a buffer of that size
+        if zstandard.frame_content_size(data) > limit:
+            raise ValueError(f"decompresses to more than {limit} bytes")
+        return zstandard.ZstdDecompressor().decompress(data, max_output_size=limit)
+    except zstandard.ZstdError as e:
+        raise ValueError(str(e))
+
+# zlib ships with Python, level 1 keeps up with the link far better than the default
+register_codec(1, 'zlib', functools.partial(zlib.compress, level=1), zlib_decompress)
+if zstandard is not None:
+    register_codec(2, 'zstd', zstandard.ZstdCompressor(level=3).compress, zstd_decompress)
+
+
+def encode_data_into(buf, seq_num, handle, body, flags=0):
+    """
+    Packs a DATA packet into a preallocated buffer
+
+    :param buf: buffer large enough for the packet
+    :type buf: bytearray
+    :param seq_num: sequence number of the packet
+    :type seq_num: int
+    :param handle: stream handle the receiver assigned
+    :type handle: int
+    :param body: chunk, any bytes-like object
+    :type body: Bytes
+    :param flags: flag bits for the receiver
+    :type flags: int
+    :return: length of the packet at the start of buf
+    :rtype: int
+    """
+    end = DATA.size + len(body)
+    buf[DATA.size:end] = body
+    DATA.pack_into(buf, 0, 0, PACKET_DATA, flags, handle, seq_num)
+    view = memoryview(buf)
+    CHECKSUM.pack_into(buf, 0, zlib.crc32(view[CHECKSUM.size:end]))
+    view.release()
+    return end
+
+def encode_data(seq_num, handle, body, flags=0):
+    """
+    Forms a DATA packet
+
+    :param seq_num: sequence number of the packet
+    :type seq_num: int
+    :param handle: stream handle the receiver assigned
+    :type handle: int
+    :param body: chunk, text is UTF-8 encoded
+    :type body: Bytes or String
+    :param flags: flag bits for the receiver
+    :type flags: int
+    :return: the packet
+    :rtype: bytearray
+    """
+    if isinstance(body, str):
+        body = body.encode()
+    buf = bytearray(DATA.size + len(body))
+    encode_data_into(buf, seq_num, handle, body, flags)
+    return buf
+
+def encode_meta(file_id, body, codec_id=0):
+    """
+    Forms a META packet, the metadata that opens a transfer or answers a
+    META_REQ or INDEX_REQ
+
+    :param file_id: the file id
+    :type file_id: String
+    :param body: metadata text, or bytes already encoded
+    :type body: String
+    :param codec_id: codec the stream's chunks (or the body of an index page) are compressed with, 0 for none
+    :type codec_id: int
+    :return: the packet
+    :rtype: bytearray
+    """
+    id_bytes = file_id.encode()
+    if isinstance(body, str):
+        body = body.encode()
+    start = META.size + len(id_bytes)
+    buf = bytearray(start + len(body))
+    buf[META.size:start] = id_bytes
+    buf[start:] = body
+    META.pack_into(buf, 0, 0, PACKET_META, codec_id, len(id_bytes))
+    CHECKSUM.pack_into(buf, 0, zlib.crc32(memoryview(buf)[CHECKSUM.size:]))
+    return buf
+
+def encode_ack(handle, cum_ack, sack=b'', rwnd=0):
+    """
+    Forms an ACK packet
+
+    :param handle: stream handle, or 0 if the stream has none
+    :type handle: int
+    :param cum_ack: every sequence number up to and including this one was received
+    :type cum_ack: int
+    :param sack: bitmap where bit i (most significant bit first) covers cum_ack + 2 + i
+    :type sack: Bytes
+    :param rwnd: the sender may send sequence numbers up to cum_ack + rwnd
+    :type rwnd: int
+    :return: the packet
+    :rtype: bytearray
+    """
+    buf = bytearray(ACK.size + len(sack))
+    buf[ACK.size:] = sack
+    ACK.pack_into(buf, 0, 0, PACKET_ACK, 0, handle, cum_ack, rwnd, len(sack))
+    CHECKSUM.pack_into(buf, 0, zlib.crc32(memoryview(buf)[CHECKSUM.size:]))
+    return buf
+
+def encode_control(text):
+    """
+    Forms a CONTROL packet carrying a text message
+
+    :param text: the message
+    :type text: String
+    :return: the packet
+    :rtype: bytearray
+    """
+    body = text.encode()
+    buf = bytearray(COMMON.size + len(body))
+    buf[COMMON.size:] = body
+    COMMON.pack_into(buf, 0, 0, PACKET_CONTROL, 0)
+    CHECKSUM.pack_into(buf, 0, zlib.crc32(memoryview(buf)[CHECKSUM.size:]))
+    return buf
+
+def encode_parity(handle, first_seq, n, k, j, body):
+    """
+    Forms a PARITY packet
+
+    :param handle: stream handle the receiver assigned
+    :type handle: int
+    :param first_seq: sequence number of the first packet of the group
+    :type first_seq: int
+    :param n: number of packets in the group
+    :type n: int
+    :param k: number of parity packets for the group
+    :type k: int
+    :param j: which of them this is, it covers positions j, j + k, ...
+    :type j: int
+    :param body: XOR of the covered chunks
+    :type body: Bytes
+    :return: the packet
+    :rtype: bytearray
+    """
+    buf = bytearray(PARITY.size + len(body))
+    buf[PARITY.size:] = body
+    PARITY.pack_into(buf, 0, 0, PACKET_PARITY, 0, handle, first_seq, n, k, j)
+    CHECKSUM.pack_into(buf, 0, zlib.crc32(memoryview(buf)[CHECKSUM.size:]))
+    return buf
+
+def parse_packet(data):
+    """
+    Verifies a packet's checksum and reads its type
+
+    :param data: the datagram
+    :type data: bytes-like
+    :return: (type, flags) or None if the checksum does not match or the
+             packet is too short for the header of its type
+    :rtype: tuple
+    """
+    if len(data) < COMMON.size:
+        return None
+    chksum, ptype, flags = COMMON.unpack_from(data)
+    if len(data) < HEADER_SIZES.get(ptype, COMMON.size):
+        return None
+    if zlib.crc32(memoryview(data)[CHECKSUM.size:]) != chksum:
+        return None
+    return ptype, flags
+
+def decode_meta(data):
+    """
+    Reads a META packet that passed parse_packet
+
+    :param data: the datagram
+    :type data: bytes-like
+    :return: file id and metadata text
+    :rtype: tuple
+    """
+    id_length = META.unpack_from(data)[3]
+    view = memoryview(data)
+    return (str(view[META.size:META.size + id_length], 'utf-8'),
+            str(view[META.size + id_length:], 'utf-8'))
+
+def decode_meta_raw(data):
+    """
+    Reads a META packet that passed parse_packet without decoding its body
+
+    :param data: the datagram
+    :type data: bytes-like
+    :return: file id and a memoryview of the body, only valid as long as data is
+    :rtype: tuple
+    """
+    id_length = META.unpack_from(data)[3]
+    view = memoryview(data)
+    return str(view[META.size:META.size + id_length], 'utf-8'), view[META.size + id_length:]
+
+def decode_data(data):
+    """
+    Reads a DATA packet that passed parse_packet
+
+    :param data: the datagram
+    :type data: bytes-like
+    :return: stream handle, sequence number and a memoryview of the body,
+             only valid as long as data is
+    :rtype: tuple
+    """
+    _, _, _, handle, seq_num = DATA.unpack_from(data)
+    return handle, seq_num, memoryview(data)[DATA.size:]
+
+def decode_ack(data):
+    """
+    Reads an ACK packet that passed parse_packet
+
+    :param data: the datagram
+    :type data: bytes-like
+    :return: stream handle, cum_ack, rwnd and a memoryview of the SACK
+             bitmap, only valid as long as data is
+    :rtype: tuple
+    """
+    _, _, _, handle, cum_ack, rwnd, sack_len = ACK.unpack_from(data)
+    return handle, cum_ack, rwnd, memoryview(data)[ACK.size:ACK.size + sack_len]
+
+def decode_parity(data):
+    """
+    Reads a PARITY packet that passed parse_packet
+
+    :param data: the datagram
+    :type data: bytes-like
+    :return: stream handle, first seq, n, k, j and a memoryview of the
+             parity, only valid as long as data is
+    :rtype: tuple
+    """
+    _, _, _, handle, first_seq, n, k, j = PARITY.unpack_from(data)
+    return handle, first_seq, n, k, j, memoryview(data)[PARITY.size:]
+
+def decode_control(data):
+    """
+    Reads a CONTROL packet that passed parse_packet
+
+    :param data: the datagram
+    :type data: bytes-like
+    :return: the text message
+    :rtype: String
+    """
+    return str(memoryview(data)[COMMON.size:], 'utf-8', 'replace')
+
+class DatagramTransport:
+    """
+    DatagramTransport, a minimal asyncio datagram transport that reads every
+    datagram into one reused buffer with recvfrom_into instead of allocating
+    a new bytes object per packet
+
+    The protocol is handed a memoryview of that buffer, which is only valid
+    until its datagram_received returns. Sends go straight to the socket;
+    when its buffer is full the datagram is dropped like on a congested
+    link, and retransmission takes care of it.
+
+    Attributes:
+        loop: the event loop the socket is watched from
+        sock: the non-blocking UDP socket
+        protocol: asyncio.DatagramProtocol receiving the datagrams
+        buf: the reused receive buffer
+    """
+    # Datagrams read per wakeup before other callbacks get a turn
+    batch = 64
+
+    def __init__(self, loop, sock, protocol):
+        self.loop = loop
+        self.sock = sock
+        self.protocol = protocol
+        self.buf = bytearray(MAX_DATAGRAM)
+        self.view = memoryview(self.buf)
+        self.closed = False
+        sock.setblocking(False)
+        protocol.connection_made(self)
+        loop.add_reader(sock.fileno(), self.read_ready)
+
+    def read_ready(self):
+        """
+        Reader callback, hands every queued datagram to the protocol
+        """
+        for _ in range(self.batch):
+            try:
+                nbytes, address = self.sock.recvfrom_into(self.buf)
+            except (BlockingIOError, InterruptedError):
+                return
+            except OSError as exc:
+                self.protocol.error_received(exc)
+                return
+            self.protocol.datagram_received(self.view[:nbytes], address)
+            if self.closed:
+                return
+
+    def sendto(self, data, address):
+        """
+        :param data: the datagram, any bytes-like object
+        :param address: (ip, port) to send it to
+        """
+        if self.closed:
+            return
+        try:
+            self.sock.sendto(data, address)
+        except (BlockingIOError, InterruptedError):
+            pass
+        except OSError as exc:
+            self.protocol.error_received(exc)
+
+    def get_extra_info(self, name, default=None):
+        """
+        Supports 'sockname' and 'socket' like asyncio's transports
+        """
+        if name == 'sockname':
+            return self.sock.getsockname()
+        if name == 'socket':
+            return self.sock
+        return default
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        """
+        Stops reading and closes the socket
+        """
+        if self.closed:
+            return
+        self.closed = True
+        self.loop.remove_reader(self.sock.fileno())
+        self.sock.close()
+        self.loop.call_soon(self.protocol.connection_lost, None)
+
+async def open_endpoint(loop, protocol_factory, local_addr=None, sock=None):
+    """
+    Opens a UDP endpoint like loop.create_datagram_endpoint, but with a
+    DatagramTransport
+
+    :param loop: the running event loop
+    :param protocol_factory: callable returning the protocol
+    :param local_addr: (ip, port) to bind a new socket to
+    :param sock: an already bound socket to use instead
+    :return: (transport, protocol)
+    :rtype: tuple
+    """
+    if sock is None:
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(local_addr or ('0.0.0.0', 0))
+    protocol = protocol_factory()
+    return DatagramTransport(loop, sock, protocol), protocol